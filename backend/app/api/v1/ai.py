@@ -1,24 +1,56 @@
 # app/api/v1/ai.py
 
-from fastapi import APIRouter, Depends, File, UploadFile, HTTPException, status
+from fastapi import APIRouter, Depends, File, UploadFile, HTTPException, Query, status
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, delete
-from typing import Optional, List, Set
+from typing import Awaitable, Callable, Optional, Dict, List, Set, Tuple
+import asyncio
 import os
 import uuid
 import logging
+from dataclasses import dataclass
+from functools import partial
 
 import re
 
+from app.core.config import settings
 from app.core.security import get_current_user
 from app.db.session import get_db
 from app.models.user import User
 from app.models.clothing import ClothingItem
 from app.models.ai_analysis import AIAnalysis
+from app.services.gemini_context_cache import gemini_context_cache
+from app.services.gemini_hedging import gemini_hedger
+from app.services.gemini_key_pool import gemini_key_pool
+from app.services.gemini_metrics import GeminiCall, gemini_metrics
 from app.services.gemini_service import gemini_service
+from app.services.gemini_scheduler import GeminiOverloadedError, gemini_scheduler
+from app.services.analysis_cache_service import analysis_cache_service
+from app.services.image_service import bytes_sha256, image_service
+from app.services.item_analysis_service import (
+    ANALYSIS_DONE,
+    ItemAnalysisError,
+    find_near_duplicate_analysis,
+    find_ready_item_analysis,
+    gemini_call_fields,
+    is_usable_analysis,
+    item_analysis_service,
+    latest_item_analysis,
+    reused_call_fields,
+    save_item_analysis,
+)
+from app.services.phash_index import phash_index
 from app.services.marketplace_service import marketplace_service
+from app.services.model_router import model_router
+from app.services.outfit_pipeline import PipelineRun, pipeline_metrics
+from app.services.find_similar_cache import FindSimilarEntry, find_similar_cache
+from app.services.outfit_plan_cache import outfit_plan_cache
+from app.services.search_fallback import search_fallback_predictor
 from app.schemas.ai import (
     AnalyzeImageResponse,
+    AnalyzeOutfitPhotoResponse,
+    BatchAnalyzeItemResult,
+    BatchAnalyzeResponse,
     ClothingAnalysis,
     FindSimilarRequest,
     FindSimilarResponse,
@@ -26,6 +58,7 @@ from app.schemas.ai import (
     ClothingItemInfo,
     AnalysisListResponse,
     AnalysisListItem,
+    OutfitPhotoItemResult,
     OutfitFromItemRequest,
     OutfitFromStyleRequest,
     BuildOutfitResponse,
@@ -42,15 +75,22 @@ os.makedirs(UPLOAD_DIR, exist_ok=True)
 # HELPER FUNCTIONS
 # ============================================================
 
-async def save_uploaded_file(file: UploadFile) -> str:
-    """Сохраняет загруженный файл."""
+async def save_uploaded_file(file: UploadFile) -> Tuple[str, str]:
+    """Сохраняет загруженный файл. Возвращает (путь, sha256 содержимого)."""
     file_extension = os.path.splitext(file.filename)[1]
     unique_filename = f"{uuid.uuid4()}{file_extension}"
     file_path = os.path.join(UPLOAD_DIR, unique_filename)
+    content = await file.read()
     with open(file_path, "wb") as f:
-        content = await file.read()
         f.write(content)
-    return file_path
+    return file_path, bytes_sha256(content)
+
+
+def remove_files(paths: List[Optional[str]]) -> None:
+    """Удаляет загруженные/вырезанные файлы неудавшегося запроса."""
+    for path in paths:
+        if path and os.path.exists(path):
+            os.remove(path)
 
 
 async def create_ai_analysis(
@@ -59,6 +99,9 @@ async def create_ai_analysis(
     file_path: str,
     analysis_data: dict,
     item_id: Optional[int] = None,
+    image_phash: Optional[str] = None,
+    call_fields: Optional[dict] = None,
+    image_colors: Optional[str] = None,
 ) -> AIAnalysis:
     """Создаёт запись анализа в БД."""
     ai_analysis = AIAnalysis(
@@ -66,14 +109,29 @@ async def create_ai_analysis(
         prompt=f"Analyze clothing image: {file_path}",
         response=str(analysis_data),
         analysis_data=analysis_data,
-        model_used="gemini-2.0-flash",
         clothing_item_id=item_id,
+        image_phash=image_phash,
+        image_colors=image_colors,
+        **(call_fields or gemini_call_fields()),
     )
     db.add(ai_analysis)
     await db.flush()
     return ai_analysis
 
 
+def build_clothing_item(user_id: int, file_path: str, analysis_data: dict) -> ClothingItem:
+    """Вещь гардероба из результата анализа (без добавления в сессию)."""
+    return ClothingItem(
+        user_id=user_id,
+        category=analysis_data.get("category", "unknown"),
+        color=", ".join(analysis_data.get("colors", [])),
+        brand=analysis_data.get("brand"),
+        description=analysis_data.get("description", ""),
+        image_url=file_path,
+        analysis_status=ANALYSIS_DONE,
+    )
+
+
 async def save_to_wardrobe(
     db: AsyncSession,
     user_id: int,
@@ -82,14 +140,7 @@ async def save_to_wardrobe(
 ) -> Optional[int]:
     """Сохраняет вещь в гардероб."""
     try:
-        clothing_item = ClothingItem(
-            user_id=user_id,
-            category=analysis_data.get("category", "unknown"),
-            color=", ".join(analysis_data.get("colors", [])),
-            brand=analysis_data.get("brand"),
-            description=analysis_data.get("description", ""),
-            image_url=file_path,
-        )
+        clothing_item = build_clothing_item(user_id, file_path, analysis_data)
         db.add(clothing_item)
         await db.flush()
         logger.info(f"Saved to wardrobe: user={user_id}, item={clothing_item.id}")
@@ -99,60 +150,37 @@ async def save_to_wardrobe(
         return None
 
 
+def enqueue_if_outdated(analysis: AIAnalysis, item_id: int, user_id: int) -> None:
+    """Анализ старой версии — на фоновый переанализ (ответ запроса его не ждёт)."""
+    if (
+        gemini_service
+        and gemini_service.model
+        and analysis.analysis_version != gemini_service.analysis_version
+    ):
+        item_analysis_service.enqueue(item_id, user_id, reanalysis=True)
+
+
 async def auto_analyze_item(
     db: AsyncSession,
     item: ClothingItem,
     user_id: int
 ) -> dict:
-    """Автоанализ вещи через Gemini если анализа нет."""
-    result = await db.execute(
-        select(AIAnalysis)
-        .where(AIAnalysis.clothing_item_id == item.id)
-        .order_by(AIAnalysis.created_at.desc())
-    )
-    existing = result.scalar_one_or_none()
-    if existing and existing.analysis_data:
+    """
+    Анализ вещи: существующий, идущий в фоне (ждём его) или новый.
+
+    Годится любой пригодный анализ, даже старой версии: Gemini на пути
+    запроса не вызывается, а устаревший анализ уходит на фоновый переанализ.
+    """
+    existing = await latest_item_analysis(db, item.id)
+    if existing and is_usable_analysis(existing.analysis_data):
         logger.info(f"Found existing analysis for item {item.id}")
+        enqueue_if_outdated(existing, item.id, user_id)
         return existing.analysis_data
 
-    if not item.image_url or not os.path.exists(item.image_url):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Item image not found",
-        )
-
-    logger.info(f"Auto-analyzing item {item.id}")
-    if not gemini_service or not gemini_service.model:
-        raise HTTPException(
-            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-            detail="Gemini AI service not available",
-        )
-
-    analysis_data = await gemini_service.analyze_clothing_image(item.image_url)
-    if not analysis_data:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Failed to analyze image",
-        )
-
-    ai_analysis = AIAnalysis(
-        user_id=user_id,
-        clothing_item_id=item.id,
-        prompt=f"Auto-analyze: {item.image_url}",
-        response=str(analysis_data),
-        analysis_data=analysis_data,
-        model_used="gemini-2.0-flash",
-    )
-    db.add(ai_analysis)
-
-    item.category = analysis_data.get("category") or item.category
-    item.color = ", ".join(analysis_data.get("colors", [])) or item.color
-    item.brand = analysis_data.get("brand") or item.brand
-    item.description = analysis_data.get("description") or item.description
-
-    await db.commit()
-    await db.refresh(item)
-    return analysis_data
+    try:
+        return await item_analysis_service.analyze_now(db, item, user_id)
+    except ItemAnalysisError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
 
 
 def build_search_query(item: ClothingItem, analysis_data: dict = None) -> str:
@@ -277,6 +305,69 @@ def dedupe_by_url(products: List[dict]) -> List[dict]:
     return out
 
 
+def score_products(products: List[dict], analysis_data: dict, item: ClothingItem) -> List[dict]:
+    """Проставляет similarity_score и сортирует по нему (по убыванию)."""
+    for p in products:
+        p.setdefault("rating", None)
+        p.setdefault("reviews_count", None)
+        p.setdefault("delivery", "")
+        p["similarity_score"] = round(calculate_similarity_score(p, analysis_data, item), 1)
+    return sorted(products, key=lambda x: x.get("similarity_score", 0), reverse=True)
+
+
+def count_passed(products: List[dict], min_score: float) -> int:
+    return sum(1 for p in products if float(p.get("similarity_score", 0) or 0) >= min_score)
+
+
+async def search_alternate_queries(
+    queries: List[str],
+    marketplaces: List[str],
+    max_results_per_marketplace: int,
+    analysis_data: dict,
+    item: ClothingItem,
+    min_score: float,
+    enough: int,
+) -> List[dict]:
+    """
+    Альтернативные запросы find-similar: все сразу, результаты оцениваются
+    по мере прихода. Как только прошедших порог товаров >= enough, остальные
+    поиски отменяются. Результаты склеиваются в порядке запросов, а не
+    прихода, чтобы выдача не зависела от скорости провайдеров.
+    """
+    tasks = [
+        asyncio.create_task(
+            marketplace_service.search_similar(
+                search_query=q,
+                marketplaces=marketplaces,
+                max_results_per_marketplace=max_results_per_marketplace,
+            )
+        )
+        for q in queries
+    ]
+    index_of = {task: idx for idx, task in enumerate(tasks)}
+    results: Dict[int, List[dict]] = {}
+    passed = 0
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    products = score_products(task.result() or [], analysis_data, item)
+                except Exception as e:
+                    logger.warning(f"Alternate query '{queries[index_of[task]]}' failed: {e}")
+                    products = []
+                results[index_of[task]] = products
+                passed += count_passed(products, min_score)
+            if passed >= enough and pending:
+                logger.info(f"Alternate queries: {passed} passed, cancelling {len(pending)} pending searches")
+                break
+    finally:
+        for task in pending:
+            task.cancel()
+    return [p for idx in sorted(results) for p in results[idx]]
+
+
 def is_category_mismatch(product_name: str, source_category: str) -> bool:
     """Проверяет категорийное соответствие."""
     product_lower = product_name.lower()
@@ -404,6 +495,583 @@ def is_base_item_category(slot_type: str, base_category: str) -> bool:
     return False
 
 
+# ============================================================
+# OUTFIT PIPELINE HELPERS
+# ============================================================
+
+def build_slot_search_query(slot_data: dict) -> str:
+    """Поисковый запрос слота с минус-словами из must_not_have."""
+    search_query = slot_data.get("search_query", "")
+    must_not = slot_data.get("must_not_have", [])
+    if must_not:
+        minus_words = " ".join([f"-{word.replace(' ', '')}" for word in must_not])
+        search_query = f"{search_query} {minus_words}"
+    return search_query
+
+
+def filter_slot_products(raw_products: List[dict], must_not: List[str]) -> List[dict]:
+    """Убирает поисковые ссылки и товары с запрещёнными словами."""
+    clean_products = [
+        p for p in raw_products
+        if p.get("url") and "google.com/search" not in p["url"]
+    ]
+    if must_not and clean_products:
+        before_count = len(clean_products)
+        clean_products = [
+            p for p in clean_products
+            if not any(
+                bad_word.lower() in p.get("name", "").lower()
+                for bad_word in must_not
+            )
+        ]
+        if len(clean_products) < before_count:
+            logger.info(f"Filtered out {before_count - len(clean_products)} by must_not_have")
+    return clean_products
+
+
+def require_slot_keywords(products: List[dict], must_have: List[str]) -> List[dict]:
+    """Оставляет товары, в названии которых есть хотя бы одно слово из must_have."""
+    if not must_have:
+        return products
+    return [
+        p for p in products
+        if any(keyword.lower() in p.get("name", "").lower() for keyword in must_have)
+    ]
+
+
+def rank_slot_products(products: List[dict], slot_data: dict) -> List[dict]:
+    """Порядок кандидатов слота; по умолчанию — как вернул поиск."""
+    return products
+
+
+def dedupe_slot_products(products: List[dict], seen_urls: Set[str]) -> List[dict]:
+    """Убирает товары, уже попавшие в предыдущие слоты (seen_urls пополняется)."""
+    unique_products = []
+    for p in products:
+        url = p.get("url", "")
+        if url and url not in seen_urls:
+            unique_products.append(p)
+            seen_urls.add(url)
+    return unique_products
+
+
+async def search_marketplaces(
+    search_query: str,
+    marketplaces: Optional[List[str]],
+    max_results_per_marketplace: int,
+) -> List[dict]:
+    return await marketplace_service.search_similar(
+        search_query=search_query,
+        marketplaces=marketplaces,
+        max_results_per_marketplace=max_results_per_marketplace,
+    )
+
+
+@dataclass
+class OutfitStages:
+    """
+    Реализации этапов подбора товаров для слотов образов. Любую можно
+    подменить (другой источник товаров, ранжирование и т.п.): порядок
+    этапов, лимиты параллельности и замеры остаются за пайплайном.
+    """
+    query_build: Callable[[dict], str] = build_slot_search_query
+    search: Callable[..., Awaitable[List[dict]]] = search_marketplaces
+    exclude: Callable[[List[dict], List[str]], List[dict]] = filter_slot_products
+    require: Callable[[List[dict], List[str]], List[dict]] = require_slot_keywords
+    rank: Callable[[List[dict], dict], List[dict]] = rank_slot_products
+    dedupe: Callable[[List[dict], Set[str]], List[dict]] = dedupe_slot_products
+
+
+outfit_stages = OutfitStages()
+
+
+def new_outfit_run(name: str) -> PipelineRun:
+    """Прогон пайплайна образов с лимитами параллельности этапов из настроек."""
+    return PipelineRun(name, limits={"search": settings.OUTFIT_SLOT_SEARCH_CONCURRENCY})
+
+
+class SlotSearches:
+    """
+    Задачи поиска товаров по слотам плана, запускаемые по мере готовности
+    слотов. gender/base_category можно уточнить по ходу (совмещённый режим
+    узнаёт их из анализа, пришедшего в том же потоке).
+
+    Все поиски запроса идут параллельно, но не больше
+    OUTFIT_SLOT_SEARCH_CONCURRENCY одновременно (лимит этапа search в run);
+    одинаковые запросы разных слотов (частые для fallback-запросов)
+    выполняются один раз.
+    """
+
+    def __init__(
+        self,
+        gender: str,
+        base_category: Optional[str],
+        marketplaces: List[str],
+        max_results_per_slot: int,
+        run: PipelineRun,
+        stages: Optional[OutfitStages] = None,
+    ) -> None:
+        self.gender = gender
+        self.base_category = base_category
+        self.marketplaces = marketplaces
+        self.max_results_per_slot = max_results_per_slot
+        self.run = run
+        self.stages = stages or outfit_stages
+        self.tasks: Dict[Tuple[int, int], asyncio.Task] = {}
+        self._searches: Dict[Tuple[str, Tuple[str, ...], int], asyncio.Task] = {}
+        self._waiters: Dict[asyncio.Task, int] = {}
+
+    async def _limited_search(
+        self,
+        search_query: str,
+        marketplaces: Optional[List[str]],
+        max_results_per_marketplace: int,
+    ) -> List[dict]:
+        async with self.run.stage("search", items_in=1) as span:
+            products = await self.stages.search(
+                search_query=search_query,
+                marketplaces=marketplaces,
+                max_results_per_marketplace=max_results_per_marketplace,
+            )
+            span.items_out = len(products or [])
+            return products or []
+
+    async def search(
+        self,
+        search_query: str,
+        marketplaces: Optional[List[str]] = None,
+        max_results_per_marketplace: int = 10,
+    ) -> List[dict]:
+        """Поиск на маркетплейсах под лимитом этапа, с общим результатом для одинаковых запросов."""
+        key = (
+            " ".join(search_query.lower().split()),
+            tuple(marketplaces or ()),
+            max_results_per_marketplace,
+        )
+        task = self._searches.get(key)
+        if task is None:
+            task = self._searches[key] = asyncio.create_task(
+                self._limited_search(search_query, marketplaces, max_results_per_marketplace)
+            )
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            # Отмена одного слота не должна обрывать поиск, который ждут другие
+            return list(await asyncio.shield(task))
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+                if not task.done():
+                    # Ждать больше некому (например, выброшен спекулятивный fallback)
+                    task.cancel()
+                    self._searches.pop(key, None)
+
+    async def search_slot(self, slot_data: dict) -> List[dict]:
+        """
+        Товары-кандидаты для одного слота: запрос -> поиск -> must_not ->
+        fallback -> must_have -> ранжирование. Дедупликация между слотами
+        делается позже, в порядке плана (collect_outfits).
+        """
+        stages, run = self.stages, self.run
+        slot_type = slot_data.get("slot_type")
+        must_not = slot_data.get("must_not_have", [])
+        must_have = slot_data.get("must_have", [])
+
+        with run.stage("query_build", items_in=1) as span:
+            search_query = stages.query_build(slot_data)
+            fallback_query = " ".join(search_query.split()[:2]) + f" {self.gender}"
+            span.items_out = 1
+
+        logger.info(f"Searching '{slot_type}': {search_query}")
+
+        fallback_search = partial(
+            self.search,
+            search_query=fallback_query,
+            marketplaces=["google_shopping"],
+            max_results_per_marketplace=self.max_results_per_slot + 5,
+        )
+        speculative = None
+        if search_fallback_predictor.should_speculate("outfit_slot", slot_type or "", search_query):
+            speculative = asyncio.create_task(fallback_search())
+
+        try:
+            raw_products = await self.search(
+                search_query=search_query,
+                marketplaces=self.marketplaces,
+                max_results_per_marketplace=self.max_results_per_slot,
+            )
+            with run.stage("filter", items_in=len(raw_products)) as span:
+                clean_products = stages.exclude(raw_products, must_not)
+                span.items_out = len(clean_products)
+            search_fallback_predictor.record("outfit_slot", slot_type or "", search_query, empty=not clean_products)
+
+            if not clean_products:
+                logger.warning(f"No products for '{slot_type}', trying fallback")
+                logger.info(f"Fallback: '{fallback_query}'")
+
+                if speculative is not None:
+                    search_fallback_predictor.record_speculation(used=True)
+                    raw_products, speculative = await speculative, None
+                else:
+                    raw_products = await fallback_search()
+                with run.stage("filter", items_in=len(raw_products)) as span:
+                    clean_products = stages.exclude(raw_products, must_not)
+                    span.items_out = len(clean_products)
+                    span.counters["fallbacks"] += 1
+        finally:
+            if speculative is not None:
+                speculative.cancel()
+                search_fallback_predictor.record_speculation(used=False)
+
+        if must_have and clean_products:
+            with run.stage("filter", items_in=len(clean_products)) as span:
+                clean_products = stages.require(clean_products, must_have)
+                span.items_out = len(clean_products)
+
+        with run.stage("rank", items_in=len(clean_products)) as span:
+            ranked = stages.rank(clean_products, slot_data)
+            span.items_out = len(ranked)
+        return ranked
+
+    def launch(self, outfit_idx: int, slot_idx: int, slot_data: dict) -> None:
+        if (outfit_idx, slot_idx) in self.tasks or not isinstance(slot_data, dict):
+            return
+        if self.base_category and is_base_item_category(slot_data.get("slot_type") or "", self.base_category):
+            return
+        self.tasks[(outfit_idx, slot_idx)] = asyncio.create_task(self.search_slot(slot_data))
+
+    def launch_plan(self, plan: dict) -> None:
+        for outfit_idx, outfit_data in enumerate(plan.get("outfits", [])):
+            for slot_idx, slot_data in enumerate(outfit_data.get("slots", [])):
+                self.launch(outfit_idx, slot_idx, slot_data)
+
+    def cancel_all(self) -> None:
+        for task in [*self.tasks.values(), *self._searches.values()]:
+            task.cancel()
+        self.tasks.clear()
+        self._searches.clear()
+
+
+async def plan_and_search_outfits(
+    style: str,
+    gender: str,
+    season: Optional[str],
+    outfits_count: int,
+    budget: Optional[str],
+    base_item_analysis: Optional[dict],
+    base_category: Optional[str],
+    marketplaces: List[str],
+    max_results_per_slot: int,
+    user_id: int,
+    run: PipelineRun,
+) -> Tuple[Optional[dict], Dict[Tuple[int, int], asyncio.Task]]:
+    """
+    План образов (из кэша или потоком из Gemini) + запуск поиска по слотам.
+
+    Поиск слота стартует, как только слот закрылся в потоке JSON, поэтому
+    время ответа ≈ max(генерация, поиск), а не их сумма.
+
+    Returns:
+        (outfit_plan, {(outfit_index, slot_index): задача поиска})
+    """
+    searches = SlotSearches(gender, base_category, marketplaces, max_results_per_slot, run)
+
+    cache_key = outfit_plan_cache.make_key(
+        gemini_service.outfit_prompt_version,
+        style, gender, season, outfits_count, budget, base_item_analysis,
+    )
+    with run.stage("plan") as span:
+        outfit_plan = outfit_plan_cache.get(cache_key)
+        from_cache = bool(outfit_plan)
+        if from_cache:
+            logger.info(f"Outfit plan cache hit: {cache_key}")
+            span.counters["cache_hits"] += 1
+        else:
+            try:
+                async for event in gemini_service.stream_outfit_plan(
+                    style=style,
+                    gender=gender,
+                    season=season,
+                    outfits_count=outfits_count,
+                    base_item_analysis=base_item_analysis,
+                    budget=budget,
+                    user_id=user_id,
+                ):
+                    if event[0] == "slot":
+                        _, outfit_idx, slot_idx, slot_data = event
+                        searches.launch(outfit_idx, slot_idx, slot_data)
+                    else:
+                        outfit_plan = event[1]
+            except BaseException:
+                searches.cancel_all()
+                raise
+        span.items_out = len((outfit_plan or {}).get("outfits") or [])
+
+    if from_cache:
+        searches.launch_plan(outfit_plan)
+        return outfit_plan, searches.tasks
+
+    if outfit_plan and outfit_plan.get("outfits"):
+        outfit_plan_cache.put(cache_key, outfit_plan)
+        # Слоты, которые парсер не отдал по ходу стрима
+        searches.launch_plan(outfit_plan)
+        return outfit_plan, searches.tasks
+
+    # Генерация не удалась — лучше отдать уже виденный план, чем 500
+    searches.cancel_all()
+    outfit_plan = outfit_plan_cache.get(cache_key, allow_partial=True)
+    if outfit_plan:
+        searches.launch_plan(outfit_plan)
+    return outfit_plan, searches.tasks
+
+
+def outfit_params_from_analysis(
+    requested_style: Optional[str],
+    analysis_data: dict,
+) -> Tuple[str, Optional[str], str]:
+    """(style, season, gender) образов вокруг вещи по её анализу."""
+    style = requested_style or analysis_data.get("style") or "casual"
+    season = analysis_data.get("season")
+    gender = (analysis_data.get("target_audience") or "men").lower()
+    return style, season, gender
+
+
+async def analyze_plan_and_search_outfits(
+    item: ClothingItem,
+    style: Optional[str],
+    outfits_count: int,
+    budget: Optional[str],
+    marketplaces: List[str],
+    max_results_per_slot: int,
+    user_id: int,
+    call: GeminiCall,
+    run: PipelineRun,
+) -> Tuple[Optional[dict], Optional[dict], Dict[Tuple[int, int], asyncio.Task]]:
+    """
+    Анализ вещи и план образов вокруг неё одним потоковым вызовом Gemini.
+
+    Анализ приходит в потоке раньше слотов, поэтому поиск слотов стартует
+    по ходу генерации, как и в plan_and_search_outfits. План кладётся в
+    кэш под тем же ключом, что построит обычный путь по этому анализу.
+
+    Returns:
+        (analysis_data, outfit_plan, задачи поиска); анализ может прийти без плана
+    """
+    searches = SlotSearches("men", item.category or "", marketplaces, max_results_per_slot, run)
+    analysis_data: Optional[dict] = None
+    outfit_plan: Optional[dict] = None
+    # Анализ идёт в том же вызове, поэтому весь поток считается этапом plan
+    with run.stage("plan", items_in=1) as span:
+        span.counters["with_analysis"] += 1
+        try:
+            async for event in gemini_service.stream_outfit_plan(
+                style=style,
+                gender=None,
+                outfits_count=outfits_count,
+                budget=budget,
+                user_id=user_id,
+                base_image_path=item.image_url,
+                call_info=call,
+            ):
+                if event[0] == "analysis":
+                    analysis_data = event[1]
+                    searches.gender = outfit_params_from_analysis(style, analysis_data)[2]
+                    searches.base_category = analysis_data.get("category") or searches.base_category
+                elif event[0] == "slot":
+                    _, outfit_idx, slot_idx, slot_data = event
+                    searches.launch(outfit_idx, slot_idx, slot_data)
+                else:
+                    outfit_plan = event[1]
+        except BaseException:
+            searches.cancel_all()
+            raise
+        span.items_out = len((outfit_plan or {}).get("outfits") or [])
+
+    if not analysis_data or not outfit_plan or not outfit_plan.get("outfits"):
+        searches.cancel_all()
+        return analysis_data, None, {}
+
+    plan_style, season, gender = outfit_params_from_analysis(style, analysis_data)
+    outfit_plan_cache.put(
+        outfit_plan_cache.make_key(
+            gemini_service.outfit_prompt_version,
+            plan_style, gender, season, outfits_count, budget, analysis_data,
+        ),
+        outfit_plan,
+    )
+    searches.launch_plan(outfit_plan)
+    return analysis_data, outfit_plan, searches.tasks
+
+
+async def analyze_item_with_outfit_plan(
+    db: AsyncSession,
+    item: ClothingItem,
+    request: OutfitFromItemRequest,
+    user_id: int,
+    run: PipelineRun,
+) -> Tuple[Optional[dict], Optional[dict], Dict[Tuple[int, int], asyncio.Task]]:
+    """
+    Совмещённый путь from-item для вещи без анализа: вместо анализа и
+    плана двумя последовательными вызовами — один (см.
+    analyze_plan_and_search_outfits). Анализ сохраняется обычной строкой
+    AIAnalysis и попадает в кэш анализов.
+
+    Не применяется, если анализ уже есть, его делает фоновый воркер или он
+    находится без Gemini (похожее фото, кэш по хэшу) — тогда план строится
+    обычным путём. Returns (analysis_data, outfit_plan, задачи поиска);
+    analysis_data None — анализировать обычным путём.
+    """
+    if not settings.OUTFIT_FUSED_ANALYSIS_ENABLED or not gemini_service or not gemini_service.model:
+        return None, None, {}
+    if not item.image_url or not os.path.exists(item.image_url):
+        return None, None, {}
+
+    existing = await latest_item_analysis(db, item.id)
+    if existing and is_usable_analysis(existing.analysis_data):
+        return None, None, {}
+    if item_analysis_service.is_running(item.id):
+        return None, None, {}
+
+    analysis_data, call_fields, image_phash, image_colors, content_hash = await find_ready_item_analysis(
+        db, item, user_id
+    )
+    if analysis_data:
+        await save_item_analysis(db, item, user_id, analysis_data, call_fields, image_phash, image_colors)
+        return analysis_data, None, {}
+
+    logger.info(f"Fused analysis + outfit plan for item {item.id}")
+    job = item_analysis_service.claim(item.id)
+    call = GeminiCall()
+    slot_tasks: Dict[Tuple[int, int], asyncio.Task] = {}
+    try:
+        analysis_data, outfit_plan, slot_tasks = await analyze_plan_and_search_outfits(
+            item,
+            style=request.style,
+            outfits_count=request.outfits_count,
+            budget=request.budget,
+            marketplaces=request.marketplaces,
+            max_results_per_slot=request.max_results_per_slot,
+            user_id=user_id,
+            call=call,
+            run=run,
+        )
+        if analysis_data:
+            await save_item_analysis(
+                db, item, user_id, analysis_data, gemini_call_fields(call), image_phash, image_colors
+            )
+            await analysis_cache_service.put(
+                content_hash, gemini_service.analysis_version, analysis_data, model_used=call.model
+            )
+    except BaseException:
+        for task in slot_tasks.values():
+            task.cancel()
+        item_analysis_service.release(job, None)
+        raise
+
+    item_analysis_service.release(job, analysis_data)
+    return analysis_data, outfit_plan, slot_tasks
+
+
+async def collect_outfits(
+    outfit_plan: dict,
+    slot_tasks: Dict[Tuple[int, int], asyncio.Task],
+    max_results_per_slot: int,
+    run: PipelineRun,
+    base_item: Optional[ClothingItem] = None,
+    stages: Optional[OutfitStages] = None,
+) -> Tuple[List[SingleOutfit], int]:
+    """
+    Дожидается поиска по слотам и собирает образы.
+
+    Уникальность товаров между слотами разрешается в порядке плана,
+    поэтому результат не зависит от того, какой поиск завершился первым.
+    """
+    stages = stages or outfit_stages
+    if slot_tasks:
+        await asyncio.gather(*slot_tasks.values(), return_exceptions=True)
+
+    outfits = outfit_plan["outfits"]
+
+    def is_base_slot(slot_data: dict) -> bool:
+        return base_item is not None and is_base_item_category(
+            slot_data.get("slot_type") or "", base_item.category or ""
+        )
+
+    slot_products: Dict[Tuple[int, int], List[dict]] = {}
+    with run.stage("dedupe") as span:
+        seen_product_urls: Set[str] = set()
+        for outfit_idx, outfit_data in enumerate(outfits):
+            for slot_idx, slot_data in enumerate(outfit_data.get("slots", [])):
+                if is_base_slot(slot_data):
+                    continue
+                task = slot_tasks.get((outfit_idx, slot_idx))
+                candidates: List[dict] = []
+                if task is not None and not task.cancelled():
+                    if task.exception() is not None:
+                        logger.error(f"Search failed for '{slot_data.get('slot_type')}': {task.exception()}")
+                        span.counters["failed_slots"] += 1
+                    else:
+                        candidates = task.result()
+                span.items_in += len(candidates)
+                unique_products = stages.dedupe(candidates, seen_product_urls)
+                slot_products[(outfit_idx, slot_idx)] = unique_products[:max_results_per_slot]
+                span.items_out += len(slot_products[(outfit_idx, slot_idx)])
+
+    outfits_result: List[SingleOutfit] = []
+    total_products = 0
+
+    with run.stage("assemble", items_in=len(outfits)) as span:
+        for outfit_idx, outfit_data in enumerate(outfits):
+            logger.info(f"Processing outfit {outfit_idx + 1}: {outfit_data.get('outfit_name')}")
+            slots_with_products = []
+
+            for slot_idx, slot_data in enumerate(outfit_data.get("slots", [])):
+                slot_type = slot_data.get("slot_type")
+
+                if is_base_slot(slot_data):
+                    logger.info(f"Skipping '{slot_type}' slot - base item IS this category")
+                    slots_with_products.append(
+                        OutfitSlot(
+                            slot_type=slot_type,
+                            description=f"Your {base_item.category} (base item)",
+                            search_query="",
+                            must_have=[],
+                            must_not_have=[],
+                            color_palette=[],
+                            products=[],
+                        )
+                    )
+                    continue
+
+                products = [SimilarProduct(**p) for p in slot_products.get((outfit_idx, slot_idx), [])]
+                logger.info(f"Found {len(products)} unique products")
+
+                slots_with_products.append(
+                    OutfitSlot(
+                        slot_type=slot_type,
+                        description=slot_data.get("description"),
+                        search_query=stages.query_build(slot_data),
+                        must_have=slot_data.get("must_have", []),
+                        must_not_have=slot_data.get("must_not_have", []),
+                        color_palette=slot_data.get("color_palette", []),
+                        products=products,
+                    )
+                )
+                total_products += len(products)
+
+            outfits_result.append(
+                SingleOutfit(
+                    outfit_name=outfit_data.get("outfit_name"),
+                    description=outfit_data.get("description"),
+                    slots=slots_with_products,
+                    total_products_found=sum(len(s.products) for s in slots_with_products),
+                )
+            )
+        span.items_out = len(outfits_result)
+
+    return outfits_result, total_products
+
+
 # ============================================================
 # ENDPOINTS
 # ============================================================
@@ -412,10 +1080,18 @@ def is_base_item_category(slot_type: str, base_category: str) -> bool:
 async def analyze_image(
     file: UploadFile = File(...),
     save_to_wardrobe_flag: bool = False,
+    reuse_similar: bool = True,
     current_user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db),
 ):
-    """Анализ изображения одежды через Gemini AI."""
+    """
+    Анализ изображения одежды через Gemini AI.
+
+    Если у пользователя уже есть анализ почти такого же фото (перцептивный
+    хэш в пределах PHASH_MAX_DISTANCE и близкие цвета), он переиспользуется
+    без вызова Gemini.
+    reuse_similar=false принудительно запускает новый анализ.
+    """
     if not file.content_type or not file.content_type.startswith("image/"):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -424,20 +1100,36 @@ async def analyze_image(
 
     file_path: Optional[str] = None
     try:
-        file_path = await save_uploaded_file(file)
+        file_path, content_hash = await save_uploaded_file(file)
+        image_phash, image_colors = await image_service.fingerprint(file_path)
 
-        if not gemini_service or not gemini_service.model:
-            raise HTTPException(
-                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                detail="Gemini AI service not available",
+        near_duplicate = None
+        if reuse_similar and image_phash:
+            near_duplicate = await find_near_duplicate_analysis(
+                db, current_user.id, image_phash, image_colors
             )
 
-        analysis_data = await gemini_service.analyze_clothing_image(file_path)
-        if not analysis_data:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Failed to analyze image",
+        if near_duplicate:
+            analysis_data = near_duplicate[0].analysis_data
+            cache_hit = True
+            call_fields = reused_call_fields(near_duplicate[0])
+        else:
+            if not gemini_service or not gemini_service.model:
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Gemini AI service not available",
+                )
+
+            call = GeminiCall()
+            analysis_data, cache_hit = await analysis_cache_service.get_or_analyze(
+                file_path, content_hash=content_hash, user_id=current_user.id, call_info=call
             )
+            call_fields = gemini_call_fields(call, source="cached" if cache_hit else "shared")
+            if not analysis_data:
+                raise HTTPException(
+                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                    detail="Failed to analyze image",
+                )
 
         item_id: Optional[int] = None
         if save_to_wardrobe_flag:
@@ -446,10 +1138,12 @@ async def analyze_image(
             )
 
         ai_analysis = await create_ai_analysis(
-            db, current_user.id, file_path, analysis_data, item_id
+            db, current_user.id, file_path, analysis_data, item_id, image_phash, call_fields, image_colors
         )
 
         await db.commit()
+        if image_phash:
+            phash_index.add(current_user.id, image_phash, ai_analysis.id)
 
         return AnalyzeImageResponse(
             success=True,
@@ -459,9 +1153,12 @@ async def analyze_image(
             clothing=ClothingAnalysis(**analysis_data),
             image_path=file_path,
             created_at=ai_analysis.created_at,
+            cached=cache_hit,
+            reused_analysis_id=near_duplicate[0].id if near_duplicate else None,
+            phash_distance=near_duplicate[1] if near_duplicate else None,
         )
 
-    except HTTPException:
+    except (HTTPException, GeminiOverloadedError):
         raise
     except Exception as e:
         logger.error(f"Analysis error: {e}")
@@ -474,52 +1171,298 @@ async def analyze_image(
         )
 
 
-@router.post("/find-similar", response_model=FindSimilarResponse)
-async def find_similar_products(
-    request: FindSimilarRequest,
+@router.post("/analyze-batch", response_model=BatchAnalyzeResponse)
+async def analyze_batch(
+    files: List[UploadFile] = File(...),
+    save_to_wardrobe_flag: bool = True,
+    pack_size: int = Query(1, ge=1, le=settings.BATCH_ANALYZE_MAX_PACK_SIZE),
+    reuse_similar: bool = True,
     current_user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db),
 ):
-    """Поиск похожих товаров с автоанализом, фильтрацией и fallback."""
+    """
+    Пакетный анализ для онбординга гардероба.
+
+    Картинки анализируются параллельно (не больше BATCH_ANALYZE_CONCURRENCY
+    запросов к Gemini одновременно), pack_size > 1 отправляет несколько
+    картинок в одном промпте. Все вещи и анализы пишутся одной транзакцией,
+    статус возвращается по каждому файлу.
+    """
+    if len(files) > settings.BATCH_ANALYZE_MAX_FILES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Too many files (max {settings.BATCH_ANALYZE_MAX_FILES})",
+        )
 
-    result = await db.execute(
-        select(ClothingItem).where(
-            ClothingItem.id == request.item_id,
-            ClothingItem.user_id == current_user.id,
+    if not gemini_service or not gemini_service.model:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Gemini AI service not available",
         )
+
+    results = [BatchAnalyzeItemResult(filename=f.filename, status="pending") for f in files]
+    saved: List[Tuple[int, str, str]] = []  # (index, file_path, content_hash)
+
+    for idx, file in enumerate(files):
+        if not file.content_type or not file.content_type.startswith("image/"):
+            results[idx].status = "invalid"
+            results[idx].error = "File must be an image"
+            continue
+        file_path, content_hash = await save_uploaded_file(file)
+        results[idx].image_path = file_path
+        saved.append((idx, file_path, content_hash))
+
+    fingerprints = await asyncio.gather(*(image_service.fingerprint(path) for _, path, _ in saved))
+
+    # idx -> (analysis_data, cache_hit)
+    analyses: Dict[int, Tuple[dict, bool, dict]] = {}
+    to_analyze: List[Tuple[int, str, str]] = []
+    for (idx, file_path, content_hash), (image_phash, image_colors) in zip(saved, fingerprints):
+        near_duplicate = None
+        if reuse_similar and image_phash:
+            near_duplicate = await find_near_duplicate_analysis(
+                db, current_user.id, image_phash, image_colors
+            )
+        if near_duplicate:
+            analyses[idx] = (
+                near_duplicate[0].analysis_data,
+                True,
+                reused_call_fields(near_duplicate[0]),
+            )
+            results[idx].reused_analysis_id = near_duplicate[0].id
+        else:
+            to_analyze.append((idx, file_path, content_hash))
+
+    outcomes = await analysis_cache_service.analyze_batch(
+        [(path, content_hash) for _, path, content_hash in to_analyze],
+        pack_size=pack_size,
+        concurrency=settings.BATCH_ANALYZE_CONCURRENCY,
+        user_id=current_user.id,
     )
-    item = result.scalar_one_or_none()
+    for (idx, _, _), outcome in zip(to_analyze, outcomes):
+        if isinstance(outcome, BaseException):
+            results[idx].status = "failed"
+            results[idx].error = str(outcome) or outcome.__class__.__name__
+        elif not outcome[0]:
+            results[idx].status = "failed"
+            results[idx].error = "Failed to analyze image"
+        else:
+            analysis_data, cache_hit, call = outcome
+            analyses[idx] = (
+                analysis_data,
+                cache_hit,
+                gemini_call_fields(call, source="cached" if cache_hit else "shared"),
+            )
 
-    if not item:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Item not found")
+    # Все строки — одной транзакцией
+    created: List[Tuple[int, AIAnalysis, Optional[ClothingItem], Optional[str]]] = []
+    try:
+        for (idx, file_path, _), (image_phash, image_colors) in zip(saved, fingerprints):
+            if idx not in analyses:
+                continue
+            analysis_data, _, call_fields = analyses[idx]
+            clothing_item = (
+                build_clothing_item(current_user.id, file_path, analysis_data)
+                if save_to_wardrobe_flag else None
+            )
+            ai_analysis = AIAnalysis(
+                user_id=current_user.id,
+                prompt=f"Batch analyze clothing image: {file_path}",
+                response=str(analysis_data),
+                analysis_data=analysis_data,
+                clothing_item=clothing_item,
+                image_phash=image_phash,
+                image_colors=image_colors,
+                **call_fields,
+            )
+            if clothing_item is not None:
+                db.add(clothing_item)
+            db.add(ai_analysis)
+            created.append((idx, ai_analysis, clothing_item, image_phash))
 
-    result = await db.execute(
-        select(AIAnalysis)
-        .where(AIAnalysis.clothing_item_id == item.id)
-        .order_by(AIAnalysis.created_at.desc())
+        await db.commit()
+    except Exception as e:
+        logger.error(f"Batch analysis DB error: {e}", exc_info=True)
+        await db.rollback()
+        for _, file_path, _ in saved:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Batch analysis failed: {str(e)}",
+        )
+
+    for idx, ai_analysis, clothing_item, image_phash in created:
+        analysis_data, cache_hit, _ = analyses[idx]
+        results[idx].status = "ok"
+        results[idx].analysis_id = ai_analysis.id
+        results[idx].item_id = clothing_item.id if clothing_item is not None else None
+        results[idx].cached = cache_hit
+        results[idx].clothing = ClothingAnalysis(**analysis_data)
+        if image_phash:
+            phash_index.add(current_user.id, image_phash, ai_analysis.id)
+
+    for result in results:
+        if result.status == "failed" and result.image_path and os.path.exists(result.image_path):
+            os.remove(result.image_path)
+            result.image_path = None
+
+    succeeded = sum(1 for r in results if r.status == "ok")
+    logger.info(f"Batch analysis for user {current_user.id}: {succeeded}/{len(results)} ok")
+
+    return BatchAnalyzeResponse(
+        success=succeeded > 0,
+        total=len(results),
+        succeeded=succeeded,
+        failed=len(results) - succeeded,
+        results=results,
     )
-    existing_analysis = result.scalar_one_or_none()
 
-    analysis_data = None
-    if existing_analysis and existing_analysis.analysis_data:
-        analysis_data = existing_analysis.analysis_data
-        logger.info(f"Loaded existing analysis for item {item.id}")
 
-    if not isinstance(analysis_data, dict) or not analysis_data.get("tags"):
-        logger.info(f"Analyzing (or re-analyzing) item {item.id}")
-        analysis_data = await auto_analyze_item(db, item, current_user.id)
+@router.post("/analyze-outfit", response_model=AnalyzeOutfitPhotoResponse)
+async def analyze_outfit_photo(
+    file: UploadFile = File(...),
+    save_to_wardrobe_flag: bool = True,
+    max_items: int = Query(
+        settings.OUTFIT_DETECTION_MAX_ITEMS, ge=1, le=settings.OUTFIT_DETECTION_MAX_ITEMS
+    ),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Разбор фото образа целиком на отдельные вещи гардероба.
 
-    if not analysis_data:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to analyze item")
+    Один запрос к Gemini возвращает все вещи с рамками и анализами,
+    Pillow вырезает каждую вещь в свой файл, а вещи и анализы пишутся
+    одной транзакцией. Вместо 4-6 вызовов на образ — один.
+    """
+    if not file.content_type or not file.content_type.startswith("image/"):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="File must be an image",
+        )
 
-    search_query = build_search_query(item, analysis_data)
-    logger.info(f"Search query: '{search_query}'")
+    if not gemini_service or not gemini_service.model:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Gemini AI service not available",
+        )
+
+    file_path, _ = await save_uploaded_file(file)
+    crop_paths: List[Optional[str]] = []
+    try:
+        call = GeminiCall()
+        detected = await gemini_service.detect_clothing_items(
+            file_path, max_items, user_id=current_user.id, call_info=call
+        )
+        if not detected:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="No clothing items detected in the photo",
+            )
+
+        crop_paths = await image_service.crop_regions(
+            file_path, [entry["box_2d"] for entry in detected], UPLOAD_DIR
+        )
+        image_paths = [crop or file_path for crop in crop_paths]
+        fingerprints = await asyncio.gather(*(image_service.fingerprint(p) for p in image_paths))
+
+        # Токены и латентность вызова — на первой строке, остальные помечены shared
+        created: List[Tuple[dict, str, AIAnalysis, Optional[ClothingItem]]] = []
+        for position, (entry, image_path, (image_phash, image_colors)) in enumerate(
+            zip(detected, image_paths, fingerprints)
+        ):
+            is_crop = image_path != file_path
+            analysis_data = {k: v for k, v in entry.items() if k != "box_2d"}
+            clothing_item = (
+                build_clothing_item(current_user.id, image_path, analysis_data)
+                if save_to_wardrobe_flag else None
+            )
+            ai_analysis = AIAnalysis(
+                user_id=current_user.id,
+                prompt=f"Detect clothing items in outfit photo: {file_path}",
+                response=str(analysis_data),
+                analysis_data=analysis_data,
+                clothing_item=clothing_item,
+                # Фото образа целиком не должно совпадать по хэшу с одной вещью
+                image_phash=image_phash if is_crop else None,
+                image_colors=image_colors if is_crop else None,
+                **(
+                    gemini_call_fields(call, source="shared")
+                    if position == 0
+                    else gemini_call_fields(source="shared", model_used=call.model)
+                ),
+            )
+            if clothing_item is not None:
+                db.add(clothing_item)
+            db.add(ai_analysis)
+            created.append((entry, image_path, ai_analysis, clothing_item))
+
+        await db.commit()
+
+    except (HTTPException, GeminiOverloadedError):
+        await db.rollback()
+        remove_files([file_path, *crop_paths])
+        raise
+    except Exception as e:
+        logger.error(f"Outfit photo analysis error: {e}", exc_info=True)
+        await db.rollback()
+        remove_files([file_path, *crop_paths])
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Outfit photo analysis failed: {str(e)}",
+        )
+
+    items: List[OutfitPhotoItemResult] = []
+    for entry, image_path, ai_analysis, clothing_item in created:
+        if ai_analysis.image_phash:
+            phash_index.add(current_user.id, ai_analysis.image_phash, ai_analysis.id)
+        items.append(
+            OutfitPhotoItemResult(
+                analysis_id=ai_analysis.id,
+                item_id=clothing_item.id if clothing_item is not None else None,
+                box_2d=entry["box_2d"],
+                clothing=ClothingAnalysis(**ai_analysis.analysis_data),
+                image_path=image_path,
+            )
+        )
+
+    logger.info(f"Outfit photo for user {current_user.id}: {len(items)} items from one Gemini call")
+
+    return AnalyzeOutfitPhotoResponse(
+        success=True,
+        total=len(items),
+        source_image_path=file_path,
+        saved_to_wardrobe=save_to_wardrobe_flag,
+        items=items,
+    )
 
-    category = (analysis_data.get("category") or item.category or "").lower()
-    subcategory = (analysis_data.get("subcategory") or "").lower()
-    desc = ((analysis_data.get("description") or "") + " " + (item.description or "")).lower()
-    analysis_text = " ".join([category, subcategory, desc])
-    is_source_varsity = any(t in analysis_text for t in ["varsity", "letterman", "college jacket", "university jacket"])
+
+async def search_scored_similar(
+    item: ClothingItem,
+    analysis_data: dict,
+    search_query: str,
+    category: str,
+    request: FindSimilarRequest,
+) -> Tuple[Optional[List[dict]], bool]:
+    """
+    Основной поиск find-similar (+ fallback по категории и цвету), очистка и
+    оценка. Returns (оценённые товары по убыванию score или None, если поиск
+    ничего не нашёл; fallback_used).
+    """
+    fallback_query = analysis_data.get("category", "clothing")
+    colors = analysis_data.get("colors") or []
+    if colors:
+        fallback_query = f"{colors[0]} {fallback_query}"
+    fallback_search = partial(
+        marketplace_service.search_similar,
+        search_query=fallback_query,
+        marketplaces=request.marketplaces,
+        max_results_per_marketplace=request.max_results_per_marketplace + 10,
+    )
+    speculative = None
+    if search_fallback_predictor.should_speculate("find_similar", category, search_query):
+        speculative = asyncio.create_task(fallback_search())
 
     try:
         raw_products = await marketplace_service.search_similar(
@@ -528,66 +1471,142 @@ async def find_similar_products(
             max_results_per_marketplace=request.max_results_per_marketplace,
         )
         logger.info(f"Found {len(raw_products)} raw products")
+        search_fallback_predictor.record("find_similar", category, search_query, empty=not raw_products)
 
         fallback_used = False
 
+        if raw_products and speculative is not None:
+            speculative.cancel()
+            speculative = None
+            search_fallback_predictor.record_speculation(used=False)
+
         if not raw_products:
             logger.warning("No products found, trying fallback with simplified query")
-            fallback_query = analysis_data.get("category", "clothing")
-            colors = analysis_data.get("colors") or []
-            if colors:
-                fallback_query = f"{colors[0]} {fallback_query}"
 
-            raw_products = await marketplace_service.search_similar(
-                search_query=fallback_query,
-                marketplaces=request.marketplaces,
-                max_results_per_marketplace=request.max_results_per_marketplace + 10,
-            )
+            if speculative is not None:
+                search_fallback_predictor.record_speculation(used=True)
+                raw_products, speculative = await speculative, None
+            else:
+                raw_products = await fallback_search()
             fallback_used = len(raw_products) > 0
             logger.info(f"Fallback returned {len(raw_products)} products")
+    finally:
+        if speculative is not None:
+            speculative.cancel()
+            search_fallback_predictor.record_speculation(used=False)
 
-        if not raw_products:
-            return FindSimilarResponse(
-                success=True,
-                item=ClothingItemInfo(
-                    id=item.id,
-                    category=item.category,
-                    color=item.color,
-                    brand=item.brand,
-                    description=item.description,
-                    image_url=item.image_url,
-                ),
-                similar_products=[],
-                total_found=0,
-                search_query=search_query,
-                min_score_filter=request.min_similarity_score,
-                fallback_used=False,
-            )
+    if not raw_products:
+        return None, False
 
-        clean_products = [
-            p for p in raw_products
-            if p.get("url") and "google.com/search" not in (p.get("url") or "")
-        ]
+    clean_products = [
+        p for p in raw_products
+        if p.get("url") and "google.com/search" not in (p.get("url") or "")
+    ]
+
+    minus_terms = extract_minus_terms(search_query)
+    if minus_terms and clean_products:
+        before = len(clean_products)
+        clean_products = [p for p in clean_products if not name_contains_any_term(p.get("name", ""), minus_terms)]
+        removed = before - len(clean_products)
+        if removed > 0:
+            logger.info(f"Removed {removed} products by minus-words: {minus_terms}")
+
+    return score_products(clean_products, analysis_data, item), fallback_used
+
+
+@router.post("/find-similar", response_model=FindSimilarResponse)
+async def find_similar_products(
+    request: FindSimilarRequest,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Поиск похожих товаров с автоанализом, фильтрацией и fallback.
+    Оценённый список кэшируется (find_similar_cache), поэтому повторное
+    открытие вещи и другой min_similarity_score не повторяют поиск.
+    """
 
-        minus_terms = extract_minus_terms(search_query)
-        if minus_terms and clean_products:
-            before = len(clean_products)
-            clean_products = [p for p in clean_products if not name_contains_any_term(p.get("name", ""), minus_terms)]
-            removed = before - len(clean_products)
-            if removed > 0:
-                logger.info(f"Removed {removed} products by minus-words: {minus_terms}")
+    result = await db.execute(
+        select(ClothingItem).where(
+            ClothingItem.id == request.item_id,
+            ClothingItem.user_id == current_user.id,
+        )
+    )
+    item = result.scalar_one_or_none()
 
-        scored_products = []
-        for product in clean_products:
-            product.setdefault("rating", None)
-            product.setdefault("reviews_count", None)
-            product.setdefault("delivery", "")
+    if not item:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Item not found")
+
+    def cache_key_for(analysis_id: int) -> str:
+        return find_similar_cache.make_key(
+            item.id,
+            analysis_id,
+            (item.category, item.color, item.brand, item.description),
+            request.marketplaces,
+            request.max_results_per_marketplace,
+        )
+
+    # Готовый анализ — сначала кэш: при попадании ни анализ, ни поиск не нужны
+    cache_key: Optional[str] = None
+    entry: Optional[FindSimilarEntry] = None
+    latest = await latest_item_analysis(db, item.id)
+    if latest and is_usable_analysis(latest.analysis_data):
+        cache_key = cache_key_for(latest.id)
+        entry = find_similar_cache.get(cache_key)
+
+    if entry is not None:
+        logger.info(f"Find-similar cache hit for item {item.id}")
+        enqueue_if_outdated(latest, item.id, current_user.id)
+        analysis_data = latest.analysis_data
+    else:
+        analysis_data = await auto_analyze_item(db, item, current_user.id)
 
-            score = calculate_similarity_score(product, analysis_data, item)
-            product["similarity_score"] = round(score, 1)
-            scored_products.append(product)
+        if not analysis_data:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to analyze item")
+
+        if cache_key is None:
+            latest = await latest_item_analysis(db, item.id)
+            cache_key = cache_key_for(latest.id) if latest else None
+
+    search_query = entry.search_query if entry else build_search_query(item, analysis_data)
+    logger.info(f"Search query: '{search_query}'")
+
+    category = (analysis_data.get("category") or item.category or "").lower()
+    subcategory = (analysis_data.get("subcategory") or "").lower()
+    desc = ((analysis_data.get("description") or "") + " " + (item.description or "")).lower()
+    analysis_text = " ".join([category, subcategory, desc])
+    is_source_varsity = any(t in analysis_text for t in ["varsity", "letterman", "college jacket", "university jacket"])
+
+    try:
+        if entry is None:
+            scored_products, fallback_used = await search_scored_similar(
+                item, analysis_data, search_query, category, request
+            )
+            if scored_products is None:
+                return FindSimilarResponse(
+                    success=True,
+                    item=ClothingItemInfo(
+                        id=item.id,
+                        category=item.category,
+                        color=item.color,
+                        brand=item.brand,
+                        description=item.description,
+                        image_url=item.image_url,
+                    ),
+                    similar_products=[],
+                    total_found=0,
+                    search_query=search_query,
+                    min_score_filter=request.min_similarity_score,
+                    fallback_used=False,
+                )
+            entry = FindSimilarEntry(
+                search_query=search_query, products=scored_products, fallback_used=fallback_used
+            )
+            if cache_key and scored_products:
+                find_similar_cache.put(cache_key, entry)
 
-        scored_products.sort(key=lambda x: x.get("similarity_score", 0), reverse=True)
+        scored_products = entry.products
+        fallback_used = entry.fallback_used
 
         effective_min_score = float(request.min_similarity_score)
         passed = [p for p in scored_products if float(p.get("similarity_score", 0) or 0) >= effective_min_score]
@@ -595,50 +1614,46 @@ async def find_similar_products(
         logger.info(f"After filter (>={effective_min_score}): {len(passed)}/{len(scored_products)}")
 
         if not passed and scored_products:
-            logger.warning("No products passed filter; trying alternate queries before relaxing threshold")
-
-            colors = analysis_data.get("colors") or []
-            color0 = (colors[0].lower() if colors else "").strip()
-
-            alt_queries = []
-            if is_source_varsity:
-                alt_queries = [
-                    f"{color0} letterman jacket leather sleeves men".strip(),
-                    f"{color0} college jacket wool leather men".strip(),
-                    f"{color0} varsity jacket leather sleeves men".strip(),
-                ]
-            else:
-                alt_queries = [
-                    f"{color0} {category} men".strip(),
-                    f"{category} men".strip(),
-                ]
+            alternate_products = entry.alternate_products.get(effective_min_score)
+            if alternate_products is None:
+                logger.warning("No products passed filter; trying alternate queries before relaxing threshold")
+
+                colors = analysis_data.get("colors") or []
+                color0 = (colors[0].lower() if colors else "").strip()
+
+                alt_queries = []
+                if is_source_varsity:
+                    alt_queries = [
+                        f"{color0} letterman jacket leather sleeves men".strip(),
+                        f"{color0} college jacket wool leather men".strip(),
+                        f"{color0} varsity jacket leather sleeves men".strip(),
+                    ]
+                else:
+                    alt_queries = [
+                        f"{color0} {category} men".strip(),
+                        f"{category} men".strip(),
+                    ]
 
-            alt_queries = [q for q in alt_queries if q and len(q) > 3]
+                alt_queries = [q for q in alt_queries if q and len(q) > 3]
 
-            extra = []
-            for q in alt_queries[:3]:
-                more = await marketplace_service.search_similar(
-                    search_query=q,
+                extra = await search_alternate_queries(
+                    alt_queries[:3],
                     marketplaces=request.marketplaces,
                     max_results_per_marketplace=max(request.max_results_per_marketplace, 25),
+                    analysis_data=analysis_data,
+                    item=item,
+                    min_score=effective_min_score,
+                    enough=settings.FIND_SIMILAR_ALT_ENOUGH,
                 )
-                extra.extend(more or [])
-
-            merged = dedupe_by_url(scored_products + extra)
 
-            rescored = []
-            for p in merged:
-                p.setdefault("rating", None)
-                p.setdefault("reviews_count", None)
-                p.setdefault("delivery", "")
-                score = calculate_similarity_score(p, analysis_data, item)
-                p["similarity_score"] = round(score, 1)
-                rescored.append(p)
-
-            rescored.sort(key=lambda x: x.get("similarity_score", 0), reverse=True)
+                alternate_products = score_products(
+                    dedupe_by_url(scored_products + extra), analysis_data, item
+                )
+                if cache_key:
+                    find_similar_cache.put_alternates(cache_key, effective_min_score, alternate_products)
 
-            passed = [p for p in rescored if float(p.get("similarity_score", 0) or 0) >= effective_min_score]
-            scored_products = rescored
+            scored_products = alternate_products
+            passed = [p for p in scored_products if float(p.get("similarity_score", 0) or 0) >= effective_min_score]
             fallback_used = True
 
             logger.info(f"After ALT SEARCH filter (>={effective_min_score}): {len(passed)}/{len(scored_products)}")
@@ -714,20 +1729,27 @@ async def re_analyze_item(
             detail="Gemini AI not available"
         )
 
-    analysis_data = await gemini_service.analyze_clothing_image(item.image_url)
+    # Кэш не читаем, но обновляем свежим результатом
+    call = GeminiCall()
+    analysis_data, _ = await analysis_cache_service.get_or_analyze(
+        item.image_url, force=True, user_id=current_user.id, call_info=call, task="reanalysis"
+    )
     if not analysis_data:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Analysis failed"
         )
 
+    image_phash, image_colors = await image_service.fingerprint(item.image_url)
     ai_analysis = AIAnalysis(
         user_id=current_user.id,
         clothing_item_id=item.id,
         prompt=f"Force re-analyze: {item.image_url}",
         response=str(analysis_data),
         analysis_data=analysis_data,
-        model_used="gemini-2.0-flash",
+        image_phash=image_phash,
+        image_colors=image_colors,
+        **gemini_call_fields(call, source="shared"),
     )
     db.add(ai_analysis)
 
@@ -735,8 +1757,12 @@ async def re_analyze_item(
     item.color = ", ".join(analysis_data.get("colors", [])) or item.color
     item.brand = analysis_data.get("brand") or item.brand
     item.description = analysis_data.get("description") or item.description
+    item.analysis_status = ANALYSIS_DONE
 
     await db.commit()
+    if image_phash:
+        phash_index.add(current_user.id, image_phash, ai_analysis.id)
+    find_similar_cache.invalidate_item(item.id)
 
     tags = analysis_data.get("tags", [])
     search_query = " ".join(tags[:5]) if tags else "unknown"
@@ -755,6 +1781,31 @@ async def re_analyze_item(
     }
 
 
+@router.post("/reanalyze-outdated")
+async def reanalyze_outdated_items(
+    limit: int = Query(200, ge=1, le=1000),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Ставит на фоновый переанализ вещи пользователя, у которых нет анализа
+    текущей версии (промпт/схема/модель менялись). Вещи без анализа и уже
+    актуальные не трогаются.
+    """
+    if not gemini_service or not gemini_service.model:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Gemini AI not available"
+        )
+
+    queued = await item_analysis_service.enqueue_outdated(db, user_id=current_user.id, limit=limit)
+    return {
+        "success": True,
+        "queued": queued,
+        "analysis_version": gemini_service.analysis_version,
+    }
+
+
 @router.delete("/clear-analysis/{item_id}")
 async def clear_old_analysis(
     item_id: int,
@@ -775,7 +1826,10 @@ async def clear_old_analysis(
     await db.execute(
         delete(AIAnalysis).where(AIAnalysis.clothing_item_id == item_id)
     )
+    item.analysis_status = None
     await db.commit()
+    phash_index.invalidate_user(current_user.id)
+    find_similar_cache.invalidate_item(item_id)
 
     logger.info(f"Cleared all analyses for item {item_id}")
     return {"success": True, "message": f"Cleared analyses for item {item_id}"}
@@ -798,11 +1852,14 @@ async def get_user_analyses(
     )
     analyses = result.scalars().all()
 
+    current_version = gemini_service.analysis_version if gemini_service else None
     analyses_list = [
         AnalysisListItem(
             id=a.id,
             clothing=ClothingAnalysis(**a.analysis_data) if a.analysis_data else None,
             saved_to_wardrobe=a.clothing_item_id is not None,
+            analysis_version=a.analysis_version,
+            outdated=current_version is not None and a.analysis_version != current_version,
             created_at=a.created_at,
         )
         for a in analyses
@@ -812,6 +1869,40 @@ async def get_user_analyses(
     return AnalysisListResponse(total=len(analyses_list), analyses=analyses_list)
 
 
+@router.get("/gemini/stats")
+async def get_gemini_stats(
+    current_user: User = Depends(get_current_user),
+):
+    """
+    Метрики вызовов Gemini: очередь планировщика, кэш планов образов,
+    токены/латентность/стоимость по операциям, моделям и эндпоинтам,
+    состояние моделей маршрутизатора и ключей пула (квота, ошибки, cool-down),
+    хеджирование (задержки, число дубликатов и побед, расход бюджета),
+    а также спекулятивный fallback поиска, этапы пайплайна образов и кэш
+    find-similar.
+    Общие метрики — только пользователям из GEMINI_STATS_ADMIN_USER_IDS
+    (разбивка по всем пользователям — ещё и при GEMINI_METRICS_EXPOSE_USERS),
+    остальные видят только свой расход (my_usage).
+    """
+    my_usage = gemini_metrics.user_stats(current_user.id)
+    if current_user.id not in settings.GEMINI_STATS_ADMIN_USER_IDS:
+        return {"my_usage": my_usage}
+    return {
+        "scheduler": gemini_scheduler.stats(),
+        "outfit_plan_cache": outfit_plan_cache.stats(),
+        "item_analysis": item_analysis_service.stats(),
+        "usage": gemini_metrics.stats(include_users=settings.GEMINI_METRICS_EXPOSE_USERS),
+        "my_usage": my_usage,
+        "models": model_router.stats(),
+        "context_cache": gemini_context_cache.stats(),
+        "api_keys": gemini_key_pool.stats(),
+        "hedging": gemini_hedger.stats(),
+        "search_fallback": search_fallback_predictor.stats(),
+        "outfit_pipeline": pipeline_metrics.stats(),
+        "find_similar_cache": find_similar_cache.stats(),
+    }
+
+
 # ============================================================
 # OUTFIT GENERATION
 # ============================================================
@@ -836,214 +1927,77 @@ async def build_outfits_from_item(
             detail="Item not found",
         )
 
-    result = await db.execute(
-        select(AIAnalysis)
-        .where(AIAnalysis.clothing_item_id == item.id)
-        .order_by(AIAnalysis.created_at.desc())
-    )
-    existing_analysis = result.scalar_one_or_none()
-    if existing_analysis and existing_analysis.analysis_data:
-        analysis_data = existing_analysis.analysis_data
-        logger.info(f"Loaded existing analysis for item {item.id}")
-    else:
-        logger.info(f"No analysis, analyzing item {item.id}")
-        analysis_data = await auto_analyze_item(db, item, current_user.id)
-
-    if not analysis_data:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Failed to analyze item"
+    with new_outfit_run("outfits_from_item") as run:
+        # Вещь без анализа: анализ и план одним вызовом, если это возможно
+        analysis_data, outfit_plan, slot_tasks = await analyze_item_with_outfit_plan(
+            db, item, request, current_user.id, run
         )
+        if analysis_data is None:
+            with run.stage("analysis", items_in=1) as span:
+                analysis_data = await auto_analyze_item(db, item, current_user.id)
+                span.items_out = int(bool(analysis_data))
 
-    style = request.style or analysis_data.get("style", "casual")
-    season = analysis_data.get("season")
-    gender = analysis_data.get("target_audience", "men").lower()
-
-    logger.info(f"Building {request.outfits_count} outfits around item {item.id}")
-    logger.info(f"Style: {style}, Season: {season}, Gender: {gender}")
-
-    if not gemini_service or not gemini_service.model:
-        raise HTTPException(
-            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-            detail="Gemini AI service not available",
-        )
-
-    outfit_plan = await gemini_service.generate_outfit_plan(
-        style=style,
-        gender=gender,
-        season=season,
-        outfits_count=request.outfits_count,
-        base_item_analysis=analysis_data,
-        budget=request.budget,
-    )
-
-    if not outfit_plan or "outfits" not in outfit_plan:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Failed to generate outfit plan"
-        )
-
-    logger.info(f"Gemini generated {len(outfit_plan['outfits'])} outfit plans")
-
-    outfits_result = []
-    total_products = 0
-    seen_product_urls: Set[str] = set()
-    base_category = item.category or ""
-
-    for outfit_idx, outfit_data in enumerate(outfit_plan["outfits"]):
-        logger.info(f"Processing outfit {outfit_idx + 1}: {outfit_data.get('outfit_name')}")
-
-        slots_with_products = []
-
-        for slot_data in outfit_data.get("slots", []):
-            slot_type = slot_data.get("slot_type")
-
-            if is_base_item_category(slot_type, base_category):
-                logger.info(f"Skipping '{slot_type}' slot - base item IS this category")
-                slots_with_products.append(
-                    OutfitSlot(
-                        slot_type=slot_type,
-                        description=f"Your {item.category} (base item)",
-                        search_query="",
-                        must_have=[],
-                        must_not_have=[],
-                        color_palette=[],
-                        products=[],
-                    )
-                )
-                continue
-
-            search_query = slot_data.get("search_query", "")
-            must_not = slot_data.get("must_not_have", [])
-            must_have = slot_data.get("must_have", [])
+        if not analysis_data:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Failed to analyze item"
+            )
 
-            if must_not:
-                minus_words = " ".join([f"-{word.replace(' ', '')}" for word in must_not])
-                search_query = f"{search_query} {minus_words}"
+        style, season, gender = outfit_params_from_analysis(request.style, analysis_data)
 
-            logger.info(f"Searching '{slot_type}': {search_query}")
+        logger.info(f"Building {request.outfits_count} outfits around item {item.id}")
+        logger.info(f"Style: {style}, Season: {season}, Gender: {gender}")
 
-            try:
-                raw_products = await marketplace_service.search_similar(
-                    search_query=search_query,
-                    marketplaces=request.marketplaces,
-                    max_results_per_marketplace=request.max_results_per_slot,
-                )
-
-                clean_products = [
-                    p for p in raw_products
-                    if p.get("url") and "google.com/search" not in p["url"]
-                ]
-
-                if must_not and clean_products:
-                    before_count = len(clean_products)
-                    clean_products = [
-                        p for p in clean_products
-                        if not any(
-                            bad_word.lower() in p.get("name", "").lower()
-                            for bad_word in must_not
-                        )
-                    ]
-                    if len(clean_products) < before_count:
-                        logger.info(f"Filtered out {before_count - len(clean_products)} by must_not_have")
-
-                if not clean_products:
-                    logger.warning(f"No products for '{slot_type}', trying fallback")
-                    fallback_query = " ".join(search_query.split()[:2]) + f" {gender}"
-                    logger.info(f"Fallback: '{fallback_query}'")
-
-                    raw_products = await marketplace_service.search_similar(
-                        search_query=fallback_query,
-                        marketplaces=["google_shopping"],
-                        max_results_per_marketplace=request.max_results_per_slot + 5,
-                    )
-                    clean_products = [
-                        p for p in raw_products
-                        if p.get("url") and "google.com/search" not in p["url"]
-                    ]
-                    if must_not:
-                        clean_products = [
-                            p for p in clean_products
-                            if not any(
-                                bad_word.lower() in p.get("name", "").lower()
-                                for bad_word in must_not
-                            )
-                        ]
-
-                if must_have and clean_products:
-                    filtered = []
-                    for p in clean_products:
-                        name_lower = p.get("name", "").lower()
-                        if any(keyword.lower() in name_lower for keyword in must_have):
-                            filtered.append(p)
-                    clean_products = filtered
-
-                unique_products = []
-                for p in clean_products:
-                    url = p.get("url", "")
-                    if url and url not in seen_product_urls:
-                        unique_products.append(p)
-                        seen_product_urls.add(url)
-
-                products = [
-                    SimilarProduct(**p) 
-                    for p in unique_products[:request.max_results_per_slot]
-                ]
+        if not gemini_service or not gemini_service.model:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Gemini AI service not available",
+            )
 
-                logger.info(f"Found {len(products)} unique products")
+        if outfit_plan is None:
+            outfit_plan, slot_tasks = await plan_and_search_outfits(
+                style=style,
+                gender=gender,
+                season=season,
+                outfits_count=request.outfits_count,
+                budget=request.budget,
+                base_item_analysis=analysis_data,
+                base_category=item.category or "",
+                marketplaces=request.marketplaces,
+                max_results_per_slot=request.max_results_per_slot,
+                user_id=current_user.id,
+                run=run,
+            )
 
-                slots_with_products.append(
-                    OutfitSlot(
-                        slot_type=slot_type,
-                        description=slot_data.get("description"),
-                        search_query=search_query,
-                        must_have=must_have,
-                        must_not_have=must_not,
-                        color_palette=slot_data.get("color_palette", []),
-                        products=products,
-                    )
-                )
-                total_products += len(products)
+        if not outfit_plan or "outfits" not in outfit_plan:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Failed to generate outfit plan"
+            )
 
-            except Exception as e:
-                logger.error(f"Search failed for '{slot_type}': {e}")
-                slots_with_products.append(
-                    OutfitSlot(
-                        slot_type=slot_type,
-                        description=slot_data.get("description"),
-                        search_query=search_query,
-                        must_have=must_have,
-                        must_not_have=must_not,
-                        color_palette=slot_data.get("color_palette", []),
-                        products=[],
-                    )
-                )
+        logger.info(f"Gemini generated {len(outfit_plan['outfits'])} outfit plans")
 
-        outfit = SingleOutfit(
-            outfit_name=outfit_data.get("outfit_name"),
-            description=outfit_data.get("description"),
-            slots=slots_with_products,
-            total_products_found=sum(len(s.products) for s in slots_with_products),
+        outfits_result, total_products = await collect_outfits(
+            outfit_plan, slot_tasks, request.max_results_per_slot, run, base_item=item
         )
-        outfits_result.append(outfit)
 
-    logger.info(f"Built {len(outfits_result)} outfits with {total_products} total unique products")
+        logger.info(f"Built {len(outfits_result)} outfits with {total_products} total unique products")
 
-    return BuildOutfitResponse(
-        success=True,
-        base_item=ClothingItemInfo(
-            id=item.id,
-            category=item.category,
-            color=item.color,
-            brand=item.brand,
-            description=item.description,
-            image_url=item.image_url,
-        ),
-        style=style,
-        outfits=outfits_result,
-        total_outfits=len(outfits_result),
-        total_products_found=total_products,
-    )
+        return BuildOutfitResponse(
+            success=True,
+            base_item=ClothingItemInfo(
+                id=item.id,
+                category=item.category,
+                color=item.color,
+                brand=item.brand,
+                description=item.description,
+                image_url=item.image_url,
+            ),
+            style=style,
+            outfits=outfits_result,
+            total_outfits=len(outfits_result),
+            total_products_found=total_products,
+        )
 
 
 @router.post("/outfits/from-style", response_model=BuildOutfitResponse)
@@ -1053,156 +2007,49 @@ async def build_outfits_from_style(
     db: AsyncSession = Depends(get_db),
 ):
     """Генерирует N образов с нуля по заданному стилю."""
-    logger.info(f"Building {request.outfits_count} outfits from scratch")
-    logger.info(f"Style: {request.style}, Gender: {request.gender}, Season: {request.season}")
+    with new_outfit_run("outfits_from_style") as run:
+        logger.info(f"Building {request.outfits_count} outfits from scratch")
+        logger.info(f"Style: {request.style}, Gender: {request.gender}, Season: {request.season}")
 
-    if not gemini_service or not gemini_service.model:
-        raise HTTPException(
-            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-            detail="Gemini AI service not available",
-        )
-
-    outfit_plan = await gemini_service.generate_outfit_plan(
-        style=request.style,
-        gender=request.gender,
-        season=request.season,
-        outfits_count=request.outfits_count,
-        base_item_analysis=None,
-        budget=request.budget,
-    )
+        if not gemini_service or not gemini_service.model:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Gemini AI service not available",
+            )
 
-    if not outfit_plan or "outfits" not in outfit_plan:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Failed to generate outfit plan"
+        outfit_plan, slot_tasks = await plan_and_search_outfits(
+            style=request.style,
+            gender=request.gender,
+            season=request.season,
+            outfits_count=request.outfits_count,
+            budget=request.budget,
+            base_item_analysis=None,
+            base_category=None,
+            marketplaces=request.marketplaces,
+            max_results_per_slot=request.max_results_per_slot,
+            user_id=current_user.id,
+            run=run,
         )
 
-    logger.info(f"Gemini generated {len(outfit_plan['outfits'])} outfit plans")
-
-    outfits_result = []
-    total_products = 0
-    seen_product_urls: Set[str] = set()
-
-    for outfit_data in outfit_plan["outfits"]:
-        slots_with_products = []
-
-        for slot_data in outfit_data.get("slots", []):
-            search_query = slot_data.get("search_query", "")
-            must_not = slot_data.get("must_not_have", [])
-            must_have = slot_data.get("must_have", [])
-
-            if must_not:
-                minus_words = " ".join([f"-{word.replace(' ', '')}" for word in must_not])
-                search_query = f"{search_query} {minus_words}"
-
-            logger.info(f"Searching '{slot_data.get('slot_type')}': {search_query}")
-
-            try:
-                raw_products = await marketplace_service.search_similar(
-                    search_query=search_query,
-                    marketplaces=request.marketplaces,
-                    max_results_per_marketplace=request.max_results_per_slot,
-                )
-
-                clean_products = [
-                    p for p in raw_products
-                    if p.get("url") and "google.com/search" not in p["url"]
-                ]
-
-                if must_not and clean_products:
-                    clean_products = [
-                        p for p in clean_products
-                        if not any(
-                            bad_word.lower() in p.get("name", "").lower()
-                            for bad_word in must_not
-                        )
-                    ]
-
-                if not clean_products:
-                    logger.warning("Empty, trying fallback")
-                    fallback_query = " ".join(search_query.split()[:2]) + f" {request.gender}"
-                    raw_products = await marketplace_service.search_similar(
-                        search_query=fallback_query,
-                        marketplaces=["google_shopping"],
-                        max_results_per_marketplace=request.max_results_per_slot + 5,
-                    )
-                    clean_products = [
-                        p for p in raw_products
-                        if p.get("url") and "google.com/search" not in p["url"]
-                    ]
-                    if must_not:
-                        clean_products = [
-                            p for p in clean_products
-                            if not any(
-                                bad_word.lower() in p.get("name", "").lower()
-                                for bad_word in must_not
-                            )
-                        ]
-
-                if must_have and clean_products:
-                    filtered = []
-                    for p in clean_products:
-                        name_lower = p.get("name", "").lower()
-                        if any(keyword.lower() in name_lower for keyword in must_have):
-                            filtered.append(p)
-                    clean_products = filtered
-
-                unique_products = []
-                for p in clean_products:
-                    url = p.get("url", "")
-                    if url and url not in seen_product_urls:
-                        unique_products.append(p)
-                        seen_product_urls.add(url)
-
-                products = [
-                    SimilarProduct(**p) 
-                    for p in unique_products[:request.max_results_per_slot]
-                ]
-
-                logger.info(f"Found {len(products)} products")
-
-                slots_with_products.append(
-                    OutfitSlot(
-                        slot_type=slot_data.get("slot_type"),
-                        description=slot_data.get("description"),
-                        search_query=search_query,
-                        must_have=must_have,
-                        must_not_have=must_not,
-                        color_palette=slot_data.get("color_palette", []),
-                        products=products,
-                    )
-                )
-                total_products += len(products)
+        if not outfit_plan or "outfits" not in outfit_plan:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Failed to generate outfit plan"
+            )
 
-            except Exception as e:
-                logger.error(f"Search failed: {e}")
-                slots_with_products.append(
-                    OutfitSlot(
-                        slot_type=slot_data.get("slot_type"),
-                        description=slot_data.get("description"),
-                        search_query=search_query,
-                        must_have=must_have,
-                        must_not_have=must_not,
-                        color_palette=slot_data.get("color_palette", []),
-                        products=[],
-                    )
-                )
+        logger.info(f"Gemini generated {len(outfit_plan['outfits'])} outfit plans")
 
-        outfit = SingleOutfit(
-            outfit_name=outfit_data.get("outfit_name"),
-            description=outfit_data.get("description"),
-            slots=slots_with_products,
-            total_products_found=sum(len(s.products) for s in slots_with_products),
+        outfits_result, total_products = await collect_outfits(
+            outfit_plan, slot_tasks, request.max_results_per_slot, run
         )
-        outfits_result.append(outfit)
 
-    logger.info(f"Built {len(outfits_result)} outfits with {total_products} total products")
+        logger.info(f"Built {len(outfits_result)} outfits with {total_products} total products")
 
-    return BuildOutfitResponse(
-        success=True,
-        base_item=None,
-        style=request.style,
-        outfits=outfits_result,
-        total_outfits=len(outfits_result),
-        total_products_found=total_products,
-    )
+        return BuildOutfitResponse(
+            success=True,
+            base_item=None,
+            style=request.style,
+            outfits=outfits_result,
+            total_outfits=len(outfits_result),
+            total_products_found=total_products,
+        )
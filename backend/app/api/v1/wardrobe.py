@@ -11,6 +11,8 @@ from app.core.security import get_current_user
 from app.models.user import User
 from app.schemas.clothing import ClothingItemResponse, ClothingItemCreate
 from app.services.clothing_service import clothing_service
+from app.services.gemini_service import gemini_service
+from app.services.item_analysis_service import item_analysis_service, ANALYSIS_PENDING
 
 router = APIRouter()
 
@@ -33,6 +35,7 @@ async def upload_clothing(
     color: Optional[str] = None,
     brand: Optional[str] = None,
     description: Optional[str] = None,
+    analyze: bool = Query(True, description="Сразу поставить вещь в очередь на AI-анализ"),
     current_user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db),
 ):
@@ -54,12 +57,17 @@ async def upload_clothing(
         description=description,
     )
 
+    # Анализ идёт в фоне; AI-эндпоинты дождутся его, а не запустят повторно
+    analyze = analyze and gemini_service is not None and gemini_service.model is not None
     item = await clothing_service.create_clothing_item(
         db=db,
         user_id=current_user.id,
         image_url=str(file_path),
         data=clothing_data,
+        analysis_status=ANALYSIS_PENDING if analyze else None,
     )
+    if analyze:
+        item_analysis_service.enqueue(item.id, current_user.id)
 
     return item
 
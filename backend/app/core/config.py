@@ -1,5 +1,5 @@
 from pydantic_settings import BaseSettings
-from typing import List
+from typing import Dict, List
 
 
 class Settings(BaseSettings):
@@ -17,7 +17,137 @@ class Settings(BaseSettings):
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
     
     GEMINI_API_KEY: str = ""
+    # Дополнительные ключи (другие проекты) для пула: квота считается по каждому
+    # ключу отдельно, ключ с 429 остывает GEMINI_KEY_QUOTA_COOLDOWN_SECONDS;
+    # GEMINI_KEY_RPM_LIMIT / GEMINI_KEY_TPM_LIMIT — мягкие лимиты запросов и
+    # токенов в минуту на ключ (0 — без лимита)
+    GEMINI_API_KEYS: List[str] = []
+    GEMINI_KEY_QUOTA_COOLDOWN_SECONDS: float = 60.0
+    GEMINI_KEY_RPM_LIMIT: int = 0
+    GEMINI_KEY_TPM_LIMIT: int = 0
+    # Маршрутизация моделей: запасные модели при 429/квоте основной (GEMINI_MODEL),
+    # более дешёвая модель для переанализа, явные маршруты по задачам.
+    # Запасные модели по умолчанию — того же ценового уровня, что и основная
+    # (flash-lite): при исчерпании квоты трафик уходит на них целиком, и модель
+    # дороже (gemini-2.0-flash, gemini-2.5-flash) кратно увеличит счёт за эти
+    # запросы. Более дорогие модели добавлять только осознанно; [] — без failover
+    GEMINI_FALLBACK_MODELS: List[str] = ["gemini-2.0-flash-lite"]
+    GEMINI_REANALYSIS_MODEL: str = "gemini-2.0-flash-lite"
+    GEMINI_MODEL_ROUTES: Dict[str, List[str]] = {}
+    # Тег версии анализа (см. GeminiService.analysis_version): смена тега помечает
+    # все анализы устаревшими, например после смены GEMINI_MODEL
+    GEMINI_ANALYSIS_VERSION_TAG: str = ""
+    GEMINI_MODEL_QUOTA_COOLDOWN_SECONDS: float = 60.0
+    GEMINI_MODEL_ERROR_COOLDOWN_SECONDS: float = 15.0
+    GEMINI_MODEL_ERROR_THRESHOLD: int = 3
+    # Хеджирование: если ответа (у стрима плана образов — первого куска) нет
+    # дольше GEMINI_HEDGE_PERCENTILE латентности (задача + модель, не меньше
+    # MIN_DELAY, после MIN_SAMPLES ответов), уходит дубликат — на другой ключ
+    # пула или, с ALTERNATE_MODEL, на следующую модель маршрута. Дубликатов не
+    # больше BUDGET_RATIO от числа запросов
+    GEMINI_HEDGE_ENABLED: bool = False
+    GEMINI_HEDGE_PERCENTILE: float = 0.95
+    GEMINI_HEDGE_MIN_DELAY_SECONDS: float = 1.0
+    GEMINI_HEDGE_MIN_SAMPLES: int = 20
+    GEMINI_HEDGE_BUDGET_RATIO: float = 0.05
+    GEMINI_HEDGE_ALTERNATE_MODEL: bool = False
+    GEMINI_UPLOAD_WORKERS: int = 4
+    GEMINI_UPLOAD_CACHE_SIZE: int = 256
+    # Files API хранит файлы 48 часов
+    GEMINI_FILE_TTL_SECONDS: int = 47 * 3600
+    GEMINI_FILE_EXPIRY_MARGIN_SECONDS: int = 300
+    # Серверный кэш статических системных инструкций (CachedContent):
+    # TTL, за сколько до истечения продлевать, пауза после неудачного создания.
+    # Выключен по умолчанию: текущие инструкции меньше минимального размера
+    # CachedContent. Инструкции короче MIN_TOKENS не кэшируются и при включении
+    GEMINI_CONTEXT_CACHE_ENABLED: bool = False
+    GEMINI_CONTEXT_CACHE_MIN_TOKENS: int = 4096
+    GEMINI_CONTEXT_CACHE_TTL_SECONDS: int = 3600
+    GEMINI_CONTEXT_CACHE_REFRESH_MARGIN_SECONDS: int = 300
+    GEMINI_CONTEXT_CACHE_RETRY_SECONDS: int = 3600
     
+    # Планировщик вызовов Gemini: общий лимит и порог ожидания в очереди
+    GEMINI_MAX_CONCURRENCY: int = 8
+    GEMINI_MAX_QUEUE_WAIT_SECONDS: float = 20.0
+    GEMINI_BACKGROUND_MAX_QUEUE_WAIT_SECONDS: float = 600.0
+
+    # Пакетный анализ (/ai/analyze-batch)
+    BATCH_ANALYZE_MAX_FILES: int = 50
+    BATCH_ANALYZE_CONCURRENCY: int = 4
+    BATCH_ANALYZE_MAX_PACK_SIZE: int = 4
+
+    # Разбор фото образа на отдельные вещи (/ai/analyze-outfit):
+    # максимум вещей с одного фото и поле вокруг рамки (доля её стороны)
+    OUTFIT_DETECTION_MAX_ITEMS: int = 8
+    OUTFIT_DETECTION_CROP_PADDING: float = 0.05
+
+    # Кэш планов образов: TTL, сколько разных планов держать на ключ, лимит ключей
+    OUTFIT_PLAN_CACHE_TTL_SECONDS: int = 6 * 3600
+    OUTFIT_PLAN_CACHE_VARIETY: int = 3
+    OUTFIT_PLAN_CACHE_MAX_KEYS: int = 500
+    # from-item для ещё не проанализированной вещи: анализ и план образов
+    # одним мультимодальным вызовом вместо двух последовательных
+    OUTFIT_FUSED_ANALYSIS_ENABLED: bool = True
+    # План из нескольких образов — отдельным небольшим вызовом на каждый образ
+    # (параллельно, с разными концепциями): время ≈ одного образа, а обрезанный
+    # ответ теряет один образ, а не все
+    OUTFIT_PLAN_PARALLEL: bool = False
+    # Поиск товаров по слотам образов: сколько поисков (каждый — по всем
+    # маркетплейсам) одного запроса идут одновременно
+    OUTFIT_SLOT_SEARCH_CONCURRENCY: int = 6
+
+    # /ai/find-similar: если ничего не прошло порог, альтернативные запросы идут
+    # параллельно; оставшиеся отменяются, когда прошло столько товаров
+    FIND_SIMILAR_ALT_ENOUGH: int = 5
+    # Кэш оценённых результатов /ai/find-similar (на вещь + её последний анализ)
+    FIND_SIMILAR_CACHE_TTL_SECONDS: int = 30 * 60
+    FIND_SIMILAR_CACHE_MAX_ENTRIES: int = 1000
+    # Спекулятивный fallback-поиск (find-similar и слоты образов): если по истории
+    # основной запрос такой формы/категории часто пустой (>= порога, после
+    # MIN_SAMPLES исходов), fallback стартует сразу, параллельно с основным
+    SEARCH_SPECULATIVE_FALLBACK_ENABLED: bool = True
+    SEARCH_SPECULATIVE_FALLBACK_THRESHOLD: float = 0.5
+    SEARCH_SPECULATIVE_FALLBACK_MIN_SAMPLES: int = 10
+
+    IMAGE_WORKERS: int = 4
+    # Препроцессинг перед Gemini: длинная сторона, формат (JPEG/WEBP), качество
+    GEMINI_IMAGE_MAX_EDGE: int = 1024
+    GEMINI_IMAGE_FORMAT: str = "JPEG"
+    GEMINI_IMAGE_QUALITY: int = 85
+    # До этого размера картинка уходит inline в запросе, без Files API
+    GEMINI_INLINE_MAX_BYTES: int = 4 * 1024 * 1024
+    # Порог расстояния Хэмминга (из 64 бит) для "той же вещи"
+    PHASH_MAX_DISTANCE: int = 6
+    # ...и наибольшая разница цвета (0–255 по каналу) в ячейках 3x3 миниатюр
+    PHASH_MAX_COLOR_DIFFERENCE: int = 32
+    PHASH_INDEX_MAX_USERS: int = 1000
+
+    # Учёт вызовов Gemini: цена за 1M токенов [вход, выход] в USD по моделям
+    GEMINI_PRICES_PER_1M_TOKENS: Dict[str, List[float]] = {
+        "gemini-2.5-flash-lite": [0.10, 0.40],
+        "gemini-2.5-flash": [0.30, 2.50],
+        "gemini-2.0-flash": [0.10, 0.40],
+        "gemini-2.0-flash-lite": [0.075, 0.30],
+    }
+    # Входные токены из кэша контекста тарифицируются долей обычной цены
+    GEMINI_CACHED_INPUT_PRICE_RATIO: float = 0.25
+    GEMINI_METRICS_MAX_USERS: int = 1000
+    # Пользователи (id), которым /ai/gemini/stats отдаёт общие метрики сервиса
+    # (очередь, ключи, модели, кэши); остальные видят только свой расход
+    GEMINI_STATS_ADMIN_USER_IDS: List[int] = []
+    # Отдавать этим пользователям и разбивку по всем пользователям
+    GEMINI_METRICS_EXPOSE_USERS: bool = False
+    # Фоновый анализ вещей после загрузки в гардероб (число воркеров)
+    ITEM_ANALYSIS_WORKERS: int = 2
+    # Gemini перегружен: через сколько вернуть задачу в очередь (растёт с каждой
+    # попыткой) и сколько раз откладывать, прежде чем пометить анализ failed
+    ITEM_ANALYSIS_OVERLOAD_RETRY_SECONDS: float = 30.0
+    ITEM_ANALYSIS_OVERLOAD_MAX_RETRIES: int = 5
+    # python -m app.services.analysis_backfill: размер пачки, параллельность, лимит запросов в минуту
+    BACKFILL_BATCH_SIZE: int = 50
+    BACKFILL_CONCURRENCY: int = 4
+    BACKFILL_REQUESTS_PER_MINUTE: float = 60.0
+
     RAPIDAPI_KEY: str = ""
     PRICESCOUT_HOST: str = "pricescout.p.rapidapi.com"
     ASOS_HOST: str = "asos2.p.rapidapi.com"
@@ -29,6 +159,11 @@ class Settings(BaseSettings):
 
     BACKEND_CORS_ORIGINS: List[str] = ["http://localhost:3000"]
     
+    @property
+    def gemini_api_keys(self) -> List[str]:
+        """Все ключи Gemini: GEMINI_API_KEY первым, затем GEMINI_API_KEYS, без повторов."""
+        return list(dict.fromkeys(k for k in [self.GEMINI_API_KEY, *self.GEMINI_API_KEYS] if k))
+
     class Config:
         env_file = ".env"
         case_sensitive = True
@@ -1,7 +1,13 @@
+import logging
+from typing import List
+
+from sqlalchemy import inspect, text
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker, declarative_base
 from app.core.config import settings
 
+logger = logging.getLogger(__name__)
+
 # Создаём базовый класс для моделей
 Base = declarative_base()
 
@@ -29,11 +35,55 @@ async def get_db():
             await session.close()
 
 
+def add_missing_columns(sync_conn) -> List[str]:
+    """
+    Досоздаёт колонки, которых нет в уже существующих таблицах.
+
+    create_all создаёт только новые таблицы и не меняет старые, поэтому
+    колонки, добавленные в модели позже (например, ai_analyses.image_phash),
+    в старой базе добавляются здесь через ALTER TABLE ... ADD COLUMN вместе
+    с их индексами. Только nullable колонки: для NOT NULL нужно значение
+    для старых строк — это уже ручная миграция. Возвращает добавленные
+    "таблица.колонка".
+    """
+    inspector = inspect(sync_conn)
+    existing_tables = set(inspector.get_table_names())
+    preparer = sync_conn.dialect.identifier_preparer
+    added: List[str] = []
+
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        present = {column["name"] for column in inspector.get_columns(table.name)}
+        new_columns = set()
+        for column in table.columns:
+            if column.name in present:
+                continue
+            if not column.nullable:
+                logger.warning(f"[DB] Column {table.name}.{column.name} is NOT NULL, add it manually")
+                continue
+            column_type = column.type.compile(dialect=sync_conn.dialect)
+            sync_conn.execute(text(
+                f"ALTER TABLE {preparer.format_table(table)} "
+                f"ADD COLUMN {preparer.format_column(column)} {column_type}"
+            ))
+            new_columns.add(column.name)
+            added.append(f"{table.name}.{column.name}")
+        for index in table.indexes:
+            if any(column.name in new_columns for column in index.columns):
+                index.create(sync_conn, checkfirst=True)
+
+    return added
+
+
 async def create_db_and_tables():
-    """Создаёт все таблицы в базе данных"""
-    from app.models import user, clothing, ai_analysis
+    """Создаёт все таблицы в базе данных и досоздаёт новые колонки в старых"""
+    from app.models import user, clothing, ai_analysis, analysis_cache, backfill_checkpoint
     
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        added = await conn.run_sync(add_missing_columns)
     
+    if added:
+        logger.info(f"[DB] Added columns: {', '.join(added)}")
     print("✓ Database tables created successfully")
\ No newline at end of file
@@ -1,22 +1,33 @@
 # app/main.py
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 
 from app.api.v1 import auth, wardrobe, ai
 from app.db.session import create_db_and_tables
 from app.core.config import settings
+from app.services.gemini_metrics import set_current_endpoint
+from app.services.gemini_service import gemini_service
+from app.services.gemini_scheduler import GeminiOverloadedError
+from app.services.image_service import image_service
+from app.services.item_analysis_service import item_analysis_service
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     print("--- Application startup ---")
     await create_db_and_tables()
+    item_analysis_service.start()
     print("Database and services ready")
     yield
     print("--- Application shutdown ---")
+    await item_analysis_service.shutdown()
+    if gemini_service:
+        await gemini_service.shutdown()
+    image_service.shutdown()
 
 
 app = FastAPI(
@@ -40,6 +51,23 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def gemini_endpoint_context(request: Request, call_next):
+    # Для разбивки метрик Gemini по эндпоинтам
+    set_current_endpoint(request.method, request.url.path)
+    return await call_next(request)
+
+
+@app.exception_handler(GeminiOverloadedError)
+async def gemini_overloaded_handler(request: Request, exc: GeminiOverloadedError):
+    # Load shedding планировщика Gemini -> 503 с подсказкой, когда повторить
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(max(1, int(exc.retry_after)))},
+    )
+
+
 # API v1 routers
 app.include_router(auth.router, prefix=settings.API_V1_STR + "/auth", tags=["auth"])
 app.include_router(wardrobe.router, prefix=settings.API_V1_STR + "/wardrobe", tags=["wardrobe"])
@@ -1,5 +1,7 @@
 from app.models.user import User
 from app.models.clothing import ClothingItem
 from app.models.ai_analysis import AIAnalysis
+from app.models.analysis_cache import AnalysisCacheEntry
+from app.models.backfill_checkpoint import BackfillCheckpoint
 
-__all__ = ["User", "ClothingItem", "AIAnalysis"]
+__all__ = ["User", "ClothingItem", "AIAnalysis", "AnalysisCacheEntry", "BackfillCheckpoint"]
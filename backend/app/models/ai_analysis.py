@@ -25,6 +25,24 @@ class AIAnalysis(Base):
     response = Column(Text, nullable=False)
     analysis_data = Column(JSON, nullable=True)
     model_used = Column(String(100), default="gemini-2.5-flash-lite")
+    # Версия анализа (хэш промпта:хэш схемы[:тег], см. GeminiService.analysis_version);
+    # по ней находятся устаревшие после смены промпта анализы
+    analysis_version = Column(String(100), nullable=True, index=True)
+
+    # Учёт вызова Gemini (пусто, если анализ взят из кэша или похожего фото)
+    prompt_tokens = Column(Integer, nullable=True)
+    response_tokens = Column(Integer, nullable=True)
+    latency_ms = Column(Integer, nullable=True)
+    gemini_retries = Column(Integer, nullable=True)
+    # ok / fallback / failed / quota / cached / reused / shared
+    gemini_outcome = Column(String(20), nullable=True)
+
+    # Перцептивный хэш (dHash, hex) проанализированного изображения —
+    # для переиспользования анализа на почти одинаковых фото
+    image_phash = Column(String(16), nullable=True, index=True)
+    # Средний цвет ячеек 3x3 того же изображения (hex): без него похожее
+    # по хэшу фото другого цвета не переиспользуется
+    image_colors = Column(String(64), nullable=True)
 
     # Метаданные
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
@@ -0,0 +1,27 @@
+# app/models/analysis_cache.py
+from datetime import datetime
+
+from sqlalchemy import Column, Integer, String, DateTime, JSON, UniqueConstraint
+
+from app.db.session import Base
+
+
+class AnalysisCacheEntry(Base):
+    """Кэш результатов Gemini по SHA-256 содержимого изображения."""
+
+    __tablename__ = "analysis_cache"
+    __table_args__ = (
+        UniqueConstraint("content_hash", "analysis_version", name="uq_analysis_cache_hash_version"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+
+    # Ключ: хэш байтов картинки + версия промпта/модели
+    content_hash = Column(String(64), nullable=False, index=True)
+    analysis_version = Column(String(100), nullable=False)
+
+    analysis_data = Column(JSON, nullable=False)
+    model_used = Column(String(100), nullable=True)
+
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = Column(DateTime, onupdate=datetime.utcnow)
@@ -0,0 +1,34 @@
+# app/models/backfill_checkpoint.py
+from datetime import datetime
+
+from sqlalchemy import Column, Integer, String, DateTime, JSON
+
+from app.db.session import Base
+
+
+class BackfillCheckpoint(Base):
+    """Прогресс фонового (пере)анализа гардеробов — чтобы продолжить после падения."""
+
+    __tablename__ = "backfill_checkpoints"
+
+    # Имя задания (например, "analysis")
+    name = Column(String(50), primary_key=True)
+
+    # Версия анализа, под которую идёт проход; смена версии начинает проход заново
+    analysis_version = Column(String(100), nullable=True)
+
+    # Какие вещи и каким маршрутом обходит проход (task, all_items, user_id);
+    # продолжить незавершённый проход можно только с теми же параметрами
+    scope = Column(JSON, nullable=True)
+
+    # Keyset-курсор: последний обработанный ClothingItem.id
+    last_item_id = Column(Integer, nullable=False, default=0)
+
+    processed = Column(Integer, nullable=False, default=0)
+    analyzed = Column(Integer, nullable=False, default=0)
+    cached = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+
+    started_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
@@ -18,6 +18,8 @@ class ClothingItem(Base):
     color = Column(String(100))
     brand = Column(String(100))
     description = Column(Text)
+    # Фоновый AI-анализ: pending / processing / done / failed (None — не запускался)
+    analysis_status = Column(String(20), nullable=True, index=True)
 
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
     updated_at = Column(DateTime, onupdate=datetime.utcnow)
@@ -1,5 +1,6 @@
 from app.models.user import User
 from app.models.clothing import ClothingItem
 from app.models.ai_analysis import AIAnalysis
+from app.models.analysis_cache import AnalysisCacheEntry
 
-__all__ = ["User", "ClothingItem", "AIAnalysis"]
+__all__ = ["User", "ClothingItem", "AIAnalysis", "AnalysisCacheEntry"]
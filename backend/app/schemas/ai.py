@@ -28,6 +28,29 @@ class ClothingAnalysis(BaseModel):
     tags: Optional[List[str]] = Field(None, description="Specific search tags")
 
 
+class IndexedClothingAnalysis(ClothingAnalysis):
+    """Анализ одной картинки из запроса с несколькими изображениями."""
+    image_index: int = Field(..., description="1-based index of the image")
+
+
+class ClothingAnalysisBatch(BaseModel):
+    """Ответ Gemini на анализ нескольких картинок одним запросом."""
+    items: List[IndexedClothingAnalysis] = Field(default_factory=list)
+
+
+class DetectedClothingItem(ClothingAnalysis):
+    """Вещь, найденная на фото образа целиком, с её рамкой."""
+    box_2d: List[int] = Field(
+        ...,
+        description="Bounding box [ymin, xmin, ymax, xmax] normalized to 0-1000",
+    )
+
+
+class OutfitDetection(BaseModel):
+    """Ответ Gemini на разбор фото образа на отдельные вещи."""
+    items: List[DetectedClothingItem] = Field(default_factory=list)
+
+
 class AnalyzeImageResponse(BaseModel):
     success: bool
     analysis_id: int
@@ -36,6 +59,56 @@ class AnalyzeImageResponse(BaseModel):
     clothing: ClothingAnalysis
     image_path: str
     created_at: datetime
+    cached: bool = Field(
+        default=False,
+        description="Анализ взят из кэша по хэшу изображения"
+    )
+    reused_analysis_id: Optional[int] = Field(
+        default=None,
+        description="ID анализа почти такого же фото, который был переиспользован"
+    )
+    phash_distance: Optional[int] = Field(
+        default=None,
+        description="Расстояние Хэмминга до переиспользованного анализа (0-64)"
+    )
+
+
+class BatchAnalyzeItemResult(BaseModel):
+    """Результат анализа одного файла из пакета."""
+    filename: Optional[str] = None
+    status: str = Field(..., description="ok / invalid / failed")
+    error: Optional[str] = None
+    analysis_id: Optional[int] = None
+    item_id: Optional[int] = None
+    cached: bool = False
+    reused_analysis_id: Optional[int] = None
+    clothing: Optional[ClothingAnalysis] = None
+    image_path: Optional[str] = None
+
+
+class BatchAnalyzeResponse(BaseModel):
+    success: bool
+    total: int
+    succeeded: int
+    failed: int
+    results: List[BatchAnalyzeItemResult]
+
+
+class OutfitPhotoItemResult(BaseModel):
+    """Одна вещь, вырезанная из фото образа."""
+    analysis_id: int
+    item_id: Optional[int] = None
+    box_2d: List[int] = Field(..., description="[ymin, xmin, ymax, xmax], 0-1000")
+    clothing: ClothingAnalysis
+    image_path: str = Field(..., description="Вырезанная вещь (или всё фото, если рамка негодная)")
+
+
+class AnalyzeOutfitPhotoResponse(BaseModel):
+    success: bool
+    total: int
+    source_image_path: str
+    saved_to_wardrobe: bool
+    items: List[OutfitPhotoItemResult]
 
 
 class FindSimilarRequest(BaseModel):
@@ -105,6 +178,8 @@ class AnalysisListItem(BaseModel):
     id: int
     clothing: Optional[ClothingAnalysis]
     saved_to_wardrobe: bool
+    analysis_version: Optional[str] = None
+    outdated: bool = False
     created_at: datetime
 
 
@@ -149,6 +224,34 @@ class OutfitSlot(BaseModel):
     )
 
 
+class OutfitPlanSlot(BaseModel):
+    """Слот в плане образа от Gemini (до поиска товаров)."""
+    slot_type: str = Field(..., description="top, bottom, shoes, outerwear or accessory")
+    description: str = Field("", description="Ideal item for this slot")
+    search_query: str = Field(..., description="Marketplace search phrase")
+    must_have: List[str] = Field(default_factory=list, description="Required keywords")
+    must_not_have: List[str] = Field(default_factory=list, description="Excluded keywords")
+    color_palette: List[str] = Field(default_factory=list, description="Suitable colors")
+
+
+class OutfitPlanOutfit(BaseModel):
+    """Один образ в плане от Gemini."""
+    outfit_name: str = Field(..., description="Outfit name")
+    description: str = Field("", description="Outfit concept")
+    slots: List[OutfitPlanSlot] = Field(..., description="Outfit slots")
+
+
+class OutfitPlan(BaseModel):
+    """План образов, который возвращает Gemini."""
+    outfits: List[OutfitPlanOutfit] = Field(..., description="Outfit plans")
+
+
+class ItemAnalysisWithOutfitPlan(BaseModel):
+    """Анализ базовой вещи и план образов вокруг неё одним ответом Gemini."""
+    analysis: ClothingAnalysis = Field(..., description="Analysis of the base item in the image")
+    outfits: List[OutfitPlanOutfit] = Field(..., description="Outfit plans around the base item")
+
+
 class SingleOutfit(BaseModel):
     """Один полный образ."""
     outfit_name: str = Field(..., description="Название образа")
@@ -29,6 +29,7 @@ class ClothingItemResponse(ClothingItemBase):
     id: int
     user_id: int
     image_url: str
+    analysis_status: Optional[str] = None
     created_at: datetime
 
     class Config:
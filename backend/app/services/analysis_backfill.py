@@ -0,0 +1,369 @@
+# app/services/analysis_backfill.py
+"""
+(Пере)анализ всех вещей гардеробов: после импорта старых данных или смены
+промпта/схемы.
+
+    python -m app.services.analysis_backfill [--batch-size 50] [--concurrency 4]
+        [--rpm 60] [--max-calls 1000] [--task reanalysis] [--all] [--force]
+        [--user-id 42] [--restart] [--name analysis]
+
+Вещи обходятся keyset-пачками по id; прогресс после каждой пачки пишется в
+backfill_checkpoints (запись --name) в той же транзакции, что и результаты,
+поэтому после падения задание продолжает с последней записанной пачки.
+Продолжить можно только с теми же --task/--all/--user-id: с другими
+запуск отказывается — нужен --restart или другое --name.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional, Dict, Any, List, Tuple
+
+from sqlalchemy import func, insert, select, update
+
+from app.core.config import settings
+from app.db.session import async_session, create_db_and_tables
+from app.models.ai_analysis import AIAnalysis
+from app.models.backfill_checkpoint import BackfillCheckpoint
+from app.models.clothing import ClothingItem
+from app.services.analysis_cache_service import analysis_cache_service
+from app.services.gemini_metrics import GeminiCall
+from app.services.gemini_scheduler import GeminiOverloadedError, Priority
+from app.services.gemini_service import gemini_service
+from app.services.image_service import file_sha256, image_service
+from app.services.item_analysis_service import (
+    ANALYSIS_DONE,
+    ANALYSIS_FAILED,
+    gemini_call_fields,
+    outdated_item_filter,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class BackfillScopeMismatch(Exception):
+    """Незавершённый checkpoint записан с другими параметрами прохода."""
+
+
+@dataclass
+class BackfillOptions:
+    batch_size: int = settings.BACKFILL_BATCH_SIZE
+    concurrency: int = settings.BACKFILL_CONCURRENCY
+    requests_per_minute: float = settings.BACKFILL_REQUESTS_PER_MINUTE
+    # Бюджет вызовов Gemini на запуск (None — без ограничения)
+    max_calls: Optional[int] = None
+    task: str = "analysis"
+    # Все вещи, а не только без анализа текущей версии
+    all_items: bool = False
+    # Не читать кэш анализов по содержимому
+    force: bool = False
+    user_id: Optional[int] = None
+    # Начать проход заново, игнорируя checkpoint
+    restart: bool = False
+    # Имя checkpoint: разные имена — независимые проходы
+    name: str = "analysis"
+
+    def scope(self) -> Dict[str, Any]:
+        """Параметры, от которых зависит, какие вещи и как обходит проход."""
+        return {"task": self.task, "all_items": self.all_items, "user_id": self.user_id}
+
+
+class _RateLimiter:
+    """Равномерно распределяет вызовы: не больше requests_per_minute в минуту."""
+
+    def __init__(self, requests_per_minute: float) -> None:
+        self.interval = 60.0 / requests_per_minute if requests_per_minute > 0 else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class AnalysisBackfill:
+    """Возобновляемый пакетный (пере)анализ вещей с ограничением квоты."""
+
+    def __init__(self, options: BackfillOptions) -> None:
+        self.options = options
+        self.version = gemini_service.analysis_version
+        self.limiter = _RateLimiter(options.requests_per_minute)
+        self.semaphore = asyncio.Semaphore(max(options.concurrency, 1))
+        self.calls = 0
+
+    def _filters(self) -> List[Any]:
+        filters: List[Any] = []
+        if not self.options.all_items:
+            filters.extend(outdated_item_filter(self.version, include_unanalyzed=True))
+        if self.options.user_id is not None:
+            filters.append(ClothingItem.user_id == self.options.user_id)
+        return filters
+
+    async def _load_checkpoint(self, db: Any) -> BackfillCheckpoint:
+        """
+        Checkpoint прохода: продолжение незавершённого или новый проход.
+
+        Raises:
+            BackfillScopeMismatch: незавершённый проход начат с другими
+                task/all_items/user_id (курсор к этим параметрам не подходит)
+        """
+        scope = self.options.scope()
+        checkpoint = await db.get(BackfillCheckpoint, self.options.name)
+        if checkpoint is None:
+            checkpoint = BackfillCheckpoint(name=self.options.name)
+            db.add(checkpoint)
+        elif (
+            self.options.restart
+            or checkpoint.finished_at is not None
+            or checkpoint.analysis_version != self.version
+        ):
+            # Новый проход: завершённый, принудительный или под другую версию
+            checkpoint.started_at = datetime.utcnow()
+            checkpoint.finished_at = None
+        elif checkpoint.scope != scope:
+            raise BackfillScopeMismatch(
+                f"Checkpoint '{checkpoint.name}' is an unfinished run with {checkpoint.scope}, "
+                f"not {scope}: pass --restart to start over or --name for a separate run"
+            )
+        else:
+            logger.info(
+                f"[BACKFILL] Resuming after item {checkpoint.last_item_id} "
+                f"({checkpoint.processed} processed)"
+            )
+            return checkpoint
+
+        checkpoint.analysis_version = self.version
+        checkpoint.scope = scope
+        checkpoint.last_item_id = 0
+        checkpoint.processed = checkpoint.analyzed = checkpoint.cached = checkpoint.failed = 0
+        await db.commit()
+        return checkpoint
+
+    async def _analyze(self, item: ClothingItem, content_hash: str) -> Tuple[Optional[Dict[str, Any]], dict]:
+        """Анализ одной вещи; при исчерпании квоты всех моделей ждёт и повторяет."""
+        async with self.semaphore:
+            while True:
+                await self.limiter.acquire()
+                call = GeminiCall()
+                try:
+                    analysis_data, cache_hit = await analysis_cache_service.get_or_analyze(
+                        item.image_url,
+                        content_hash=content_hash,
+                        force=self.options.force,
+                        user_id=item.user_id,
+                        priority=Priority.BACKGROUND,
+                        call_info=call,
+                        task=self.options.task,
+                    )
+                except GeminiOverloadedError as e:
+                    logger.warning(f"[BACKFILL] Gemini overloaded, waiting {e.retry_after:.0f}s")
+                    await asyncio.sleep(e.retry_after)
+                    continue
+                return analysis_data, gemini_call_fields(call, source="cached" if cache_hit else "shared")
+
+    async def _process_batch(
+        self,
+        items: List[ClothingItem],
+    ) -> Tuple[List[ClothingItem], List[Dict[str, Any]], List[Dict[str, Any]], int, int]:
+        """
+        Анализирует пачку. Возвращает (обработанные вещи, строки AIAnalysis,
+        обновления ClothingItem, число новых вызовов Gemini, попаданий в кэш).
+        Пачка обрезается, если на неё не хватает бюджета вызовов.
+        """
+        paths = [item.image_url if item.image_url and os.path.exists(item.image_url) else None for item in items]
+        hashes = await asyncio.gather(
+            *(asyncio.to_thread(file_sha256, path) if path else asyncio.sleep(0, None) for path in paths)
+        )
+        cached: Dict[str, Dict[str, Any]] = {}
+        if not self.options.force:
+            cached = await analysis_cache_service.get_many([h for h in hashes if h], self.version)
+
+        # Попадания в кэш бюджет не тратят; остальное — пока хватает бюджета
+        budget = None if self.options.max_calls is None else self.options.max_calls - self.calls
+        selected: List[Tuple[ClothingItem, Optional[str]]] = []
+        misses = 0
+        for item, content_hash in zip(items, hashes):
+            if content_hash and content_hash not in cached:
+                if budget is not None and misses >= budget:
+                    break
+                misses += 1
+            selected.append((item, content_hash))
+
+        async def run(item: ClothingItem, content_hash: Optional[str]) -> Tuple[Optional[Dict[str, Any]], dict]:
+            if not content_hash:
+                return None, {}
+            if content_hash in cached:
+                return cached[content_hash], gemini_call_fields(source="cached")
+            return await self._analyze(item, content_hash)
+
+        outcomes = await asyncio.gather(*(run(i, h) for i, h in selected), return_exceptions=True)
+        fingerprints = await asyncio.gather(
+            *(image_service.fingerprint(i.image_url) if h else asyncio.sleep(0, (None, None)) for i, h in selected)
+        )
+
+        rows: List[Dict[str, Any]] = []
+        updates: List[Dict[str, Any]] = []
+        for (item, _), outcome, (image_phash, image_colors) in zip(selected, outcomes, fingerprints):
+            if isinstance(outcome, BaseException) or not outcome[0]:
+                if isinstance(outcome, BaseException):
+                    logger.warning(f"[BACKFILL] Item {item.id} failed: {outcome}")
+                updates.append({"id": item.id, "analysis_status": ANALYSIS_FAILED})
+                continue
+
+            analysis_data, call_fields = outcome
+            rows.append({
+                "user_id": item.user_id,
+                "clothing_item_id": item.id,
+                "prompt": f"Backfill analyze: {item.image_url}",
+                "response": str(analysis_data),
+                "analysis_data": analysis_data,
+                "image_phash": image_phash,
+                "image_colors": image_colors,
+                **call_fields,
+            })
+            updates.append({
+                "id": item.id,
+                "category": analysis_data.get("category") or item.category,
+                "color": ", ".join(analysis_data.get("colors", [])) or item.color,
+                "brand": analysis_data.get("brand") or item.brand,
+                "description": analysis_data.get("description") or item.description,
+                "analysis_status": ANALYSIS_DONE,
+            })
+
+        hits = sum(1 for _, h in selected if h in cached)
+        return [i for i, _ in selected], rows, updates, misses, hits
+
+    async def run(self) -> Dict[str, Any]:
+        """Проходит все подходящие вещи; возвращает итог прохода."""
+        async with async_session() as db:
+            checkpoint = await self._load_checkpoint(db)
+            total = (
+                await db.execute(
+                    select(func.count(ClothingItem.id)).where(
+                        ClothingItem.id > checkpoint.last_item_id, *self._filters()
+                    )
+                )
+            ).scalar_one()
+            logger.info(f"[BACKFILL] {total} items to process (version {self.version})")
+
+            started = time.monotonic()
+            done_this_run = 0
+            while True:
+                if self.options.max_calls is not None and self.calls >= self.options.max_calls:
+                    logger.info(f"[BACKFILL] Call budget ({self.options.max_calls}) exhausted, stopping")
+                    break
+
+                items = (
+                    await db.execute(
+                        select(ClothingItem)
+                        .where(ClothingItem.id > checkpoint.last_item_id, *self._filters())
+                        .order_by(ClothingItem.id)
+                        .limit(self.options.batch_size)
+                    )
+                ).scalars().all()
+                if not items:
+                    checkpoint.finished_at = datetime.utcnow()
+                    await db.commit()
+                    logger.info("[BACKFILL] Finished")
+                    break
+
+                processed, rows, updates, calls, hits = await self._process_batch(items)
+                if not processed:
+                    break
+                self.calls += calls
+
+                # Результаты пачки и курсор — одной транзакцией
+                if rows:
+                    await db.execute(insert(AIAnalysis), rows)
+                if updates:
+                    await db.execute(update(ClothingItem), updates)
+                checkpoint.last_item_id = processed[-1].id
+                checkpoint.processed += len(processed)
+                checkpoint.analyzed += len(rows)
+                checkpoint.cached += hits
+                checkpoint.failed += len(processed) - len(rows)
+                await db.commit()
+
+                done_this_run += len(processed)
+                elapsed = time.monotonic() - started
+                rate = done_this_run / elapsed if elapsed > 0 else 0.0
+                eta = (total - done_this_run) / rate if rate > 0 else 0.0
+                logger.info(
+                    f"[BACKFILL] {done_this_run}/{total} items, {rate:.2f} items/s, "
+                    f"ETA {eta / 60:.1f} min (cursor={checkpoint.last_item_id}, "
+                    f"gemini calls={self.calls}, cache hits={checkpoint.cached}, failed={checkpoint.failed})"
+                )
+
+            return {
+                "version": self.version,
+                "processed": checkpoint.processed,
+                "analyzed": checkpoint.analyzed,
+                "cached": checkpoint.cached,
+                "failed": checkpoint.failed,
+                "last_item_id": checkpoint.last_item_id,
+                "finished": checkpoint.finished_at is not None,
+                "gemini_calls": self.calls,
+                "elapsed_seconds": round(time.monotonic() - started, 1),
+            }
+
+
+def parse_args(argv: Optional[List[str]] = None) -> BackfillOptions:
+    parser = argparse.ArgumentParser(description="(Re)analyze wardrobe items with Gemini")
+    parser.add_argument("--batch-size", type=int, default=settings.BACKFILL_BATCH_SIZE)
+    parser.add_argument("--concurrency", type=int, default=settings.BACKFILL_CONCURRENCY)
+    parser.add_argument("--rpm", type=float, default=settings.BACKFILL_REQUESTS_PER_MINUTE,
+                        help="Gemini requests per minute (0 = unlimited)")
+    parser.add_argument("--max-calls", type=int, default=None, help="Gemini call budget for this run")
+    parser.add_argument("--task", choices=["analysis", "reanalysis"], default="analysis",
+                        help="Model route (reanalysis = cheaper model first)")
+    parser.add_argument("--all", dest="all_items", action="store_true",
+                        help="Process every item, not only those without a current analysis")
+    parser.add_argument("--force", action="store_true", help="Ignore the analysis cache")
+    parser.add_argument("--user-id", type=int, default=None)
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and start over")
+    parser.add_argument("--name", default="analysis",
+                        help="Checkpoint name (separate names are independent runs)")
+    args = parser.parse_args(argv)
+    return BackfillOptions(
+        batch_size=args.batch_size,
+        concurrency=args.concurrency,
+        requests_per_minute=args.rpm,
+        max_calls=args.max_calls,
+        task=args.task,
+        all_items=args.all_items,
+        force=args.force,
+        user_id=args.user_id,
+        restart=args.restart,
+        name=args.name,
+    )
+
+
+async def main(argv: Optional[List[str]] = None) -> None:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    options = parse_args(argv)
+    if not gemini_service or not gemini_service.model:
+        raise SystemExit("Gemini AI service not available (check GEMINI_API_KEY)")
+
+    await create_db_and_tables()
+    try:
+        summary = await AnalysisBackfill(options).run()
+        logger.info(f"[BACKFILL] Summary: {summary}")
+    except BackfillScopeMismatch as e:
+        raise SystemExit(str(e))
+    finally:
+        await gemini_service.shutdown()
+        image_service.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,251 @@
+# app/services/analysis_cache_service.py
+
+import asyncio
+import logging
+from typing import Optional, Dict, Any, List, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from app.db.session import async_session
+from app.models.analysis_cache import AnalysisCacheEntry
+from app.services.gemini_metrics import GeminiCall
+from app.services.gemini_service import gemini_service
+from app.services.image_service import file_sha256
+
+logger = logging.getLogger(__name__)
+
+
+class AnalysisCacheService:
+    """
+    Кэш анализов одежды по SHA-256 содержимого изображения.
+
+    Одинаковые байты (повторная загрузка, другой пользователь, ретрай клиента)
+    не отправляются в Gemini повторно. Параллельные запросы с одним хэшем
+    ждут единственный анализ, который уже выполняется.
+    """
+
+    def __init__(self) -> None:
+        # (content_hash, analysis_version) -> задача анализа
+        self._inflight: Dict[Tuple[str, str], asyncio.Task] = {}
+
+    @staticmethod
+    def _is_cacheable(analysis_data: Optional[Dict[str, Any]]) -> bool:
+        """Fallback-ответы ("unknown") не кэшируем — их лучше переанализировать."""
+        if not analysis_data:
+            return False
+        return (analysis_data.get("category") or "unknown") != "unknown"
+
+    async def get(self, content_hash: str, analysis_version: str) -> Optional[Dict[str, Any]]:
+        """Возвращает закэшированный анализ или None."""
+        async with async_session() as session:
+            result = await session.execute(
+                select(AnalysisCacheEntry).where(
+                    AnalysisCacheEntry.content_hash == content_hash,
+                    AnalysisCacheEntry.analysis_version == analysis_version,
+                )
+            )
+            entry = result.scalar_one_or_none()
+            return entry.analysis_data if entry else None
+
+    async def get_many(
+        self,
+        content_hashes: List[str],
+        analysis_version: str,
+    ) -> Dict[str, Dict[str, Any]]:
+        """Один запрос на пачку хэшей: content_hash -> analysis_data."""
+        if not content_hashes:
+            return {}
+        async with async_session() as session:
+            result = await session.execute(
+                select(AnalysisCacheEntry).where(
+                    AnalysisCacheEntry.content_hash.in_(set(content_hashes)),
+                    AnalysisCacheEntry.analysis_version == analysis_version,
+                )
+            )
+            return {entry.content_hash: entry.analysis_data for entry in result.scalars().all()}
+
+    async def put(
+        self,
+        content_hash: str,
+        analysis_version: str,
+        analysis_data: Dict[str, Any],
+        model_used: Optional[str] = None,
+    ) -> None:
+        """Сохраняет (или перезаписывает) анализ в кэше."""
+        async with async_session() as session:
+            try:
+                result = await session.execute(
+                    select(AnalysisCacheEntry).where(
+                        AnalysisCacheEntry.content_hash == content_hash,
+                        AnalysisCacheEntry.analysis_version == analysis_version,
+                    )
+                )
+                entry = result.scalar_one_or_none()
+                if entry:
+                    entry.analysis_data = analysis_data
+                    entry.model_used = model_used
+                else:
+                    session.add(
+                        AnalysisCacheEntry(
+                            content_hash=content_hash,
+                            analysis_version=analysis_version,
+                            analysis_data=analysis_data,
+                            model_used=model_used,
+                        )
+                    )
+                await session.commit()
+            except IntegrityError:
+                # Параллельный воркер успел записать тот же ключ
+                await session.rollback()
+            except Exception as e:
+                await session.rollback()
+                logger.warning(f"[ANALYSIS CACHE] Failed to store {content_hash[:12]}: {e}")
+
+    async def get_or_analyze(
+        self,
+        image_path: str,
+        content_hash: Optional[str] = None,
+        force: bool = False,
+        **analyze_kwargs: Any,
+    ) -> Tuple[Optional[Dict[str, Any]], bool]:
+        """
+        Анализ с кэшем и дедупликацией параллельных запросов.
+
+        Args:
+            image_path: Путь к изображению
+            content_hash: SHA-256 байтов (если уже посчитан при загрузке)
+            force: Не читать кэш (принудительный переанализ), но обновить его
+            analyze_kwargs: Пробрасываются в gemini_service.analyze_clothing_image
+
+        Returns:
+            (analysis_data, cache_hit)
+        """
+        if content_hash is None:
+            content_hash = await asyncio.to_thread(file_sha256, image_path)
+
+        version = gemini_service.analysis_version
+        key = (content_hash, version)
+
+        if not force:
+            cached = await self.get(content_hash, version)
+            if cached:
+                logger.info(f"[ANALYSIS CACHE] Hit {content_hash[:12]} ({version})")
+                return cached, True
+
+        task = self._inflight.get(key)
+        if task is not None and not force:
+            logger.info(f"[ANALYSIS CACHE] Awaiting in-flight analysis {content_hash[:12]}")
+            return await asyncio.shield(task), False
+
+        # Анализ запускаем отдельной задачей: отмена запроса-инициатора
+        # не должна обрывать анализ для тех, кто его ждёт.
+        task = asyncio.create_task(
+            self._analyze_and_store(image_path, content_hash, version, **analyze_kwargs)
+        )
+        self._inflight[key] = task
+
+        def _forget(done: asyncio.Task) -> None:
+            if self._inflight.get(key) is done:
+                self._inflight.pop(key, None)
+
+        task.add_done_callback(_forget)
+        return await asyncio.shield(task), False
+
+    async def analyze_batch(
+        self,
+        images: List[Tuple[str, str]],
+        pack_size: int = 1,
+        concurrency: int = 4,
+        **analyze_kwargs: Any,
+    ) -> List[Any]:
+        """
+        Пакетный анализ с кэшем.
+
+        Args:
+            images: Список (image_path, content_hash)
+            pack_size: Сколько картинок отправлять в одном запросе Gemini
+            concurrency: Сколько запросов к Gemini держать одновременно
+
+        Returns:
+            Список той же длины: (analysis_data, cache_hit, GeminiCall или None)
+            или исключение для картинки, анализ которой упал. При pack_size > 1
+            токены общего запроса делятся поровну между картинками пачки.
+        """
+        version = gemini_service.analysis_version
+        cached = await self.get_many([h for _, h in images], version)
+
+        results: List[Any] = [None] * len(images)
+        misses: List[int] = []
+        for idx, (_, content_hash) in enumerate(images):
+            if content_hash in cached:
+                results[idx] = (cached[content_hash], True, None)
+            else:
+                misses.append(idx)
+
+        logger.info(f"[ANALYSIS CACHE] Batch: {len(images) - len(misses)} hits, {len(misses)} misses")
+        if not misses:
+            return results
+
+        semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+        if pack_size <= 1:
+            async def analyze_one(idx: int) -> Tuple[Optional[Dict[str, Any]], bool, GeminiCall]:
+                path, content_hash = images[idx]
+                call = GeminiCall()
+                async with semaphore:
+                    analysis_data, cache_hit = await self.get_or_analyze(
+                        path, content_hash=content_hash, call_info=call, **analyze_kwargs
+                    )
+                return analysis_data, cache_hit, call
+
+            outcomes = await asyncio.gather(*(analyze_one(i) for i in misses), return_exceptions=True)
+            for idx, outcome in zip(misses, outcomes):
+                results[idx] = outcome
+            return results
+
+        packs = [misses[i:i + pack_size] for i in range(0, len(misses), pack_size)]
+
+        async def analyze_pack(pack: List[int]) -> Tuple[List[Optional[Dict[str, Any]]], GeminiCall]:
+            call = GeminiCall()
+            async with semaphore:
+                analyses = await gemini_service.analyze_clothing_images(
+                    [images[i][0] for i in pack], call_info=call, **analyze_kwargs
+                )
+            return analyses, call
+
+        pack_outcomes = await asyncio.gather(*(analyze_pack(p) for p in packs), return_exceptions=True)
+        for pack, outcome in zip(packs, pack_outcomes):
+            if isinstance(outcome, BaseException):
+                for idx in pack:
+                    results[idx] = outcome
+                continue
+            analyses, call = outcome
+            for idx, analysis_data in zip(pack, analyses):
+                results[idx] = (analysis_data, False, call.share(len(pack)))
+                if self._is_cacheable(analysis_data):
+                    await self.put(
+                        images[idx][1], version, analysis_data,
+                        model_used=call.model or gemini_service.model_name,
+                    )
+
+        return results
+
+    async def _analyze_and_store(
+        self,
+        image_path: str,
+        content_hash: str,
+        version: str,
+        **analyze_kwargs: Any,
+    ) -> Optional[Dict[str, Any]]:
+        # Модель могла смениться маршрутизатором — в кэш пишем фактическую
+        call = analyze_kwargs.pop("call_info", None) or GeminiCall()
+        analysis_data = await gemini_service.analyze_clothing_image(
+            image_path, call_info=call, **analyze_kwargs
+        )
+        if self._is_cacheable(analysis_data):
+            await self.put(content_hash, version, analysis_data, model_used=call.model or gemini_service.model_name)
+        return analysis_data
+
+
+analysis_cache_service = AnalysisCacheService()
@@ -23,6 +23,7 @@ class ClothingService:
         user_id: int,
         image_url: str,
         data: ClothingItemCreate,
+        analysis_status: Optional[str] = None,
     ) -> ClothingItem:
         """
         Создать вещь в гардеробе пользователя.
@@ -34,6 +35,7 @@ class ClothingService:
             color=data.color,
             brand=data.brand,
             description=data.description,
+            analysis_status=analysis_status,
         )
 
         db.add(item)
@@ -0,0 +1,120 @@
+# app/services/find_similar_cache.py
+
+import copy
+import dataclasses
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional, Dict, Any, List, Sequence
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class FindSimilarEntry:
+    """Результат поиска похожих до фильтра по порогу."""
+    search_query: str
+    # Все оценённые товары, по убыванию similarity_score
+    products: List[Dict[str, Any]]
+    fallback_used: bool
+    # Порог -> products + товары альтернативных запросов (для порогов, которые
+    # не прошёл ни один товар). Альтернативные поиски останавливаются, когда
+    # порог прошло достаточно товаров, поэтому список годен только для своего порога
+    alternate_products: Dict[float, List[Dict[str, Any]]] = field(default_factory=dict)
+    created_at: float = field(default_factory=time.monotonic)
+
+
+class FindSimilarCache:
+    """
+    In-memory кэш /ai/find-similar: оценённый список товаров на
+    (вещь, последний анализ, поля вещи, маркетплейсы, лимит). Порог
+    min_similarity_score в ключ не входит — другой порог фильтрует тот же
+    список. Новый анализ меняет ключ; re-analyze и clear-analysis к тому
+    же явно сбрасывают записи вещи.
+    """
+
+    def __init__(self, ttl_seconds: int, max_entries: int) -> None:
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, FindSimilarEntry]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(
+        item_id: int,
+        analysis_id: Optional[int],
+        item_fields: Sequence[Optional[str]],
+        marketplaces: Sequence[str],
+        max_results_per_marketplace: int,
+    ) -> str:
+        # Категория/цвет/описание вещи участвуют в запросе и оценке
+        fields_hash = hashlib.sha256(
+            json.dumps(list(item_fields), ensure_ascii=False, default=str).encode("utf-8")
+        ).hexdigest()[:12]
+        return "|".join([
+            str(item_id),
+            str(analysis_id or "-"),
+            fields_hash,
+            ",".join(m.lower() for m in marketplaces),
+            str(max_results_per_marketplace),
+        ])
+
+    def get(self, key: str) -> Optional[FindSimilarEntry]:
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry.created_at >= self.ttl_seconds:
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return copy.deepcopy(entry)
+
+    def put(self, key: str, entry: FindSimilarEntry) -> None:
+        self._entries[key] = copy.deepcopy(entry)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def put_alternates(self, key: str, min_score: float, products: List[Dict[str, Any]]) -> None:
+        """
+        Добавляет к записи ключа альтернативную выдачу для порога min_score.
+        Запись заменяется новой, поэтому параллельные запросы с другими
+        порогами не теряют выдачу друг друга.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        self._entries[key] = dataclasses.replace(
+            entry,
+            alternate_products={**entry.alternate_products, min_score: copy.deepcopy(products)},
+        )
+
+    def invalidate_item(self, item_id: int) -> int:
+        prefix = f"{item_id}|"
+        stale = [key for key in self._entries if key.startswith(prefix)]
+        for key in stale:
+            del self._entries[key]
+        if stale:
+            logger.info(f"Find-similar cache: dropped {len(stale)} entries for item {item_id}")
+        return len(stale)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+find_similar_cache = FindSimilarCache(
+    ttl_seconds=settings.FIND_SIMILAR_CACHE_TTL_SECONDS,
+    max_entries=settings.FIND_SIMILAR_CACHE_MAX_ENTRIES,
+)
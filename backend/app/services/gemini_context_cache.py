@@ -0,0 +1,171 @@
+# app/services/gemini_context_cache.py
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Optional, Dict, Any, Tuple
+
+import google.generativeai as genai
+from google.generativeai import caching
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _CacheEntry:
+    cached: Any
+    model: Any
+    expires_at: float
+
+
+class GeminiContextCache:
+    """
+    Серверный кэш Gemini (CachedContent) для статических системных инструкций.
+
+    Ключ — (модель, имя инструкции): кэш привязан к модели, поэтому у каждой
+    модели маршрута свой. TTL продлевается заранее, за refresh_margin секунд
+    до истечения. Если создать кэш нельзя (модель не поддерживает) — ключ
+    помечается на retry_after секунд, и вызывающий работает с обычной
+    system_instruction.
+
+    Инструкция короче min_tokens (минимальный размер CachedContent) в кэш
+    не отправляется: размер считается один раз через count_tokens, после
+    этого ключ больше не проверяется. min_tokens=0 — без проверки.
+    """
+
+    def __init__(self, ttl: float, refresh_margin: float, retry_after: float, min_tokens: int = 0) -> None:
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.retry_after = retry_after
+        self.min_tokens = min_tokens
+        self._entries: Dict[Tuple[str, str], _CacheEntry] = {}
+        self._unsupported: Dict[Tuple[str, str], float] = {}
+        self._locks: Dict[Tuple[str, str], asyncio.Lock] = {}
+        self._too_small: Dict[Tuple[str, str], int] = {}
+        self.created = 0
+        self.refreshed = 0
+        self.failures = 0
+
+    async def get_model(self, model_name: str, name: str, instruction: str) -> Optional[Any]:
+        """GenerativeModel поверх кэша инструкции или None (кэш недоступен)."""
+        key = (model_name, name)
+        if key in self._too_small or self._unsupported.get(key, 0.0) > time.monotonic():
+            return None
+
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() + self.refresh_margin < entry.expires_at:
+            return entry.model
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            entry = self._entries.get(key)
+            now = time.monotonic()
+            if entry is not None and now + self.refresh_margin < entry.expires_at:
+                return entry.model
+            if entry is not None and now < entry.expires_at and await self._refresh(key, entry):
+                return entry.model
+            if key in self._too_small or not await self._large_enough(key, instruction):
+                return None
+            return await self._create(key, instruction)
+
+    async def _large_enough(self, key: Tuple[str, str], instruction: str) -> bool:
+        """Хватает ли инструкции на минимальный CachedContent (считается один раз)."""
+        if self.min_tokens <= 0:
+            return True
+        model_name, name = key
+        loop = asyncio.get_running_loop()
+        try:
+            tokens = await loop.run_in_executor(
+                None,
+                lambda: genai.GenerativeModel(f"models/{model_name}").count_tokens(instruction).total_tokens,
+            )
+        except Exception as e:
+            # Не посчитали — пробуем создать, сервер сам откажет при малом размере
+            logger.warning(f"[GEMINI CACHE] count_tokens failed for {name} on {model_name}: {e}")
+            return True
+        if tokens >= self.min_tokens:
+            return True
+        self._too_small[key] = tokens
+        logger.info(
+            f"[GEMINI CACHE] {name} instruction is {tokens} tokens, below the "
+            f"{self.min_tokens}-token minimum; not caching it for {model_name}"
+        )
+        return False
+
+    async def _refresh(self, key: Tuple[str, str], entry: _CacheEntry) -> bool:
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(
+                None, lambda: entry.cached.update(ttl=timedelta(seconds=self.ttl))
+            )
+        except Exception as e:
+            logger.warning(f"[GEMINI CACHE] Failed to refresh {key[1]} cache for {key[0]}: {e}")
+            self._entries.pop(key, None)
+            return False
+        entry.expires_at = time.monotonic() + self.ttl
+        self.refreshed += 1
+        logger.info(f"[GEMINI CACHE] Refreshed {key[1]} cache for {key[0]}")
+        return True
+
+    async def _create(self, key: Tuple[str, str], instruction: str) -> Optional[Any]:
+        model_name, name = key
+        loop = asyncio.get_running_loop()
+        try:
+            cached = await loop.run_in_executor(
+                None,
+                lambda: caching.CachedContent.create(
+                    model=f"models/{model_name}",
+                    display_name=f"stylistai-{name}",
+                    system_instruction=instruction,
+                    ttl=timedelta(seconds=self.ttl),
+                ),
+            )
+            model = genai.GenerativeModel.from_cached_content(cached)
+        except Exception as e:
+            self.failures += 1
+            self._entries.pop(key, None)
+            self._unsupported[key] = time.monotonic() + self.retry_after
+            logger.warning(
+                f"[GEMINI CACHE] {name} cache unavailable for {model_name}, "
+                f"using plain system instruction: {e}"
+            )
+            return None
+
+        self._entries[key] = _CacheEntry(cached, model, time.monotonic() + self.ttl)
+        self.created += 1
+        logger.info(f"[GEMINI CACHE] Created {name} cache for {model_name}: {cached.name}")
+        return model
+
+    async def shutdown(self) -> None:
+        """Удаляет кэши на сервере (хранение кэша платное)."""
+        loop = asyncio.get_running_loop()
+        entries, self._entries = list(self._entries.values()), {}
+        for entry in entries:
+            try:
+                await loop.run_in_executor(None, entry.cached.delete)
+            except Exception as e:
+                logger.warning(f"[GEMINI CACHE] Failed to delete cache: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "enabled": settings.GEMINI_CONTEXT_CACHE_ENABLED,
+            "active": [f"{model}:{name}" for model, name in self._entries],
+            "unsupported": [f"{model}:{name}" for (model, name), until in self._unsupported.items() if until > now],
+            "too_small": {f"{model}:{name}": tokens for (model, name), tokens in self._too_small.items()},
+            "created": self.created,
+            "refreshed": self.refreshed,
+            "failures": self.failures,
+        }
+
+
+gemini_context_cache = GeminiContextCache(
+    ttl=settings.GEMINI_CONTEXT_CACHE_TTL_SECONDS,
+    refresh_margin=settings.GEMINI_CONTEXT_CACHE_REFRESH_MARGIN_SECONDS,
+    retry_after=settings.GEMINI_CONTEXT_CACHE_RETRY_SECONDS,
+    min_tokens=settings.GEMINI_CONTEXT_CACHE_MIN_TOKENS,
+)
@@ -0,0 +1,109 @@
+# app/services/gemini_hedging.py
+
+import logging
+from collections import deque
+from typing import Optional, Dict, Any, Deque, Tuple
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних латентностей держать на пару (задача, модель)
+_LATENCY_WINDOW = 200
+# Потолок накопленного бюджета: после простоя не выстреливаем пачкой хеджей
+_MAX_BUDGET_TOKENS = 3.0
+
+
+class GeminiHedger:
+    """
+    Хеджирование запросов к Gemini: если ответа нет дольше перцентиля
+    латентности (задача + модель), отправляется дубликат, и побеждает
+    первый валидный ответ.
+
+    Бюджет — токен-бакет: каждый обычный запрос добавляет budget_ratio
+    токена, хедж тратит один. Так дубликаты не превышают budget_ratio
+    от числа запросов (и квоты) даже при деградации модели.
+    """
+
+    def __init__(
+        self,
+        enabled: bool,
+        percentile: float,
+        min_delay: float,
+        min_samples: int,
+        budget_ratio: float,
+    ) -> None:
+        self.enabled = enabled
+        self.percentile = min(max(percentile, 0.5), 0.999)
+        self.min_delay = min_delay
+        self.min_samples = max(min_samples, 1)
+        self.budget_ratio = max(budget_ratio, 0.0)
+        self._latencies: Dict[Tuple[str, str], Deque[float]] = {}
+        self._tokens = 0.0
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.denied = 0
+
+    def observe(self, task: str, model: str, latency: float) -> None:
+        """Латентность успешного ответа модели (без ожидания в очереди)."""
+        window = self._latencies.get((task, model))
+        if window is None:
+            window = self._latencies[(task, model)] = deque(maxlen=_LATENCY_WINDOW)
+        window.append(latency)
+
+    def delay(self, task: str, model: str) -> Optional[float]:
+        """
+        Через сколько секунд после старта запроса слать дубликат.
+        None — хеджирование выключено или статистики пока мало.
+        """
+        if not self.enabled:
+            return None
+        window = self._latencies.get((task, model))
+        if not window or len(window) < self.min_samples:
+            return None
+        ordered = sorted(window)
+        value = ordered[min(len(ordered) - 1, int(self.percentile * len(ordered)))]
+        return max(value, self.min_delay)
+
+    def record_request(self) -> None:
+        """Обычный (не хеджирующий) запрос пополняет бюджет."""
+        self.requests += 1
+        self._tokens = min(self._tokens + self.budget_ratio, _MAX_BUDGET_TOKENS)
+
+    def try_acquire(self) -> bool:
+        """Списывает бюджет на один хедж; False — бюджет исчерпан."""
+        if self._tokens < 1.0:
+            self.denied += 1
+            return False
+        self._tokens -= 1.0
+        self.hedges += 1
+        return True
+
+    def record_win(self) -> None:
+        self.hedge_wins += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "requests": self.requests,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "denied_by_budget": self.denied,
+            "hedge_rate": round(self.hedges / self.requests, 4) if self.requests else 0.0,
+            "budget_tokens": round(self._tokens, 2),
+            "delays_ms": {
+                f"{task}:{model}": round(delay * 1000, 1)
+                for (task, model) in self._latencies
+                if (delay := self.delay(task, model)) is not None
+            },
+        }
+
+
+gemini_hedger = GeminiHedger(
+    enabled=settings.GEMINI_HEDGE_ENABLED,
+    percentile=settings.GEMINI_HEDGE_PERCENTILE,
+    min_delay=settings.GEMINI_HEDGE_MIN_DELAY_SECONDS,
+    min_samples=settings.GEMINI_HEDGE_MIN_SAMPLES,
+    budget_ratio=settings.GEMINI_HEDGE_BUDGET_RATIO,
+)
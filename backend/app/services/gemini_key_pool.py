@@ -0,0 +1,217 @@
+# app/services/gemini_key_pool.py
+
+import logging
+import time
+from collections import deque
+from typing import Optional, Dict, Any, Deque, List, Tuple
+
+from google.ai import generativelanguage as glm
+from google.api_core import client_options as client_options_lib
+from google.generativeai import protos
+from google.generativeai.types import content_types, generation_types
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Окно учёта запросов/токенов на ключ (RPM/TPM квоты Gemini — поминутные)
+_WINDOW_SECONDS = 60.0
+
+
+class GeminiKey:
+    """Один ключ (проект) пула и его учёт квоты."""
+
+    def __init__(self, index: int, api_key: str) -> None:
+        self.index = index
+        self.api_key = api_key
+        # В логах и статистике — только номер ключа, без его символов
+        self.label = f"key{index}"
+        self.in_flight = 0
+        self.requests = 0
+        self.quota_errors = 0
+        self.errors = 0
+        # Модель -> до какого момента ключ остывает после 429 (квота — на проект и модель)
+        self.cooldown_until: Dict[str, float] = {}
+        self._requests: Deque[float] = deque()
+        self._tokens: Deque[Tuple[float, int]] = deque()
+        self._async_client: Any = None
+
+    @property
+    def is_default(self) -> bool:
+        """Ключ, которым сконфигурирован genai (Files API, кэш контекста)."""
+        return self.index == 0
+
+    def _trim(self, now: float) -> None:
+        while self._requests and now - self._requests[0] > _WINDOW_SECONDS:
+            self._requests.popleft()
+        while self._tokens and now - self._tokens[0][0] > _WINDOW_SECONDS:
+            self._tokens.popleft()
+
+    def requests_last_minute(self, now: float) -> int:
+        self._trim(now)
+        return len(self._requests)
+
+    def tokens_last_minute(self, now: float) -> int:
+        self._trim(now)
+        return sum(tokens for _, tokens in self._tokens)
+
+    def available(self, model: str, now: float, rpm_limit: int, tpm_limit: int = 0) -> bool:
+        if self.cooldown_until.get(model, 0.0) > now:
+            return False
+        if rpm_limit and self.requests_last_minute(now) >= rpm_limit:
+            return False
+        return not tpm_limit or self.tokens_last_minute(now) < tpm_limit
+
+    def async_client(self) -> Any:
+        """Асинхронный клиент GenerativeService с этим ключом (создаётся один раз)."""
+        if self._async_client is None:
+            self._async_client = glm.GenerativeServiceAsyncClient(
+                client_options=client_options_lib.ClientOptions(api_key=self.api_key)
+            )
+        return self._async_client
+
+    def generative_model(self, model_name: str, system_instruction: str) -> "KeyGenerativeModel":
+        return KeyGenerativeModel(model_name, system_instruction, self)
+
+    def as_dict(self, now: float) -> Dict[str, Any]:
+        return {
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "requests_last_minute": self.requests_last_minute(now),
+            "tokens_last_minute": self.tokens_last_minute(now),
+            "quota_errors": self.quota_errors,
+            "errors": self.errors,
+            "cooling_models": {
+                model: round(until - now, 1)
+                for model, until in self.cooldown_until.items()
+                if until > now
+            },
+        }
+
+
+class KeyGenerativeModel:
+    """
+    Модель на ключе пула. GenerativeModel SDK ходит только через глобальный
+    клиент genai.configure (основной ключ), поэтому для остальных ключей
+    запрос собирается из публичных типов SDK и уходит клиентом
+    GenerativeService этого ключа. Повторяет ту часть
+    GenerativeModel.generate_content_async, которой пользуется сервис.
+    """
+
+    def __init__(self, model_name: str, system_instruction: str, key: GeminiKey) -> None:
+        self.model_name = model_name if "/" in model_name else f"models/{model_name}"
+        self.key = key
+        self._system_instruction = content_types.to_content(system_instruction)
+
+    async def generate_content_async(
+        self,
+        contents: Any,
+        *,
+        generation_config: Optional[Dict[str, Any]] = None,
+        stream: bool = False,
+    ) -> Any:
+        request = protos.GenerateContentRequest(
+            model=self.model_name,
+            contents=content_types.to_contents(contents),
+            generation_config=generation_types.to_generation_config_dict(generation_config),
+            system_instruction=self._system_instruction,
+        )
+        if request.contents and not request.contents[-1].role:
+            request.contents[-1].role = "user"
+
+        client = self.key.async_client()
+        if stream:
+            with generation_types.rewrite_stream_error():
+                iterator = await client.stream_generate_content(request)
+            return await generation_types.AsyncGenerateContentResponse.from_aiterator(iterator)
+        response = await client.generate_content(request)
+        return generation_types.AsyncGenerateContentResponse.from_response(response)
+
+
+class GeminiKeyPool:
+    """
+    Пул ключей Gemini (разных проектов) с учётом квоты по каждому.
+
+    Для запроса выбирается наименее загруженный ключ: меньше запросов в
+    полёте, затем меньше запросов и токенов за последнюю минуту. Ключ,
+    исчерпавший мягкий RPM/TPM-лимит, пропускается до конца окна; ключ,
+    вернувший 429 на модели, остывает quota_cooldown секунд только для
+    этой модели.
+    """
+
+    def __init__(
+        self, api_keys: List[str], quota_cooldown: float, rpm_limit: int, tpm_limit: int = 0
+    ) -> None:
+        self.keys = [GeminiKey(i, k) for i, k in enumerate(api_keys)]
+        self.quota_cooldown = quota_cooldown
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def pick(
+        self,
+        model: str,
+        default_only: bool = False,
+        exclude: Optional[GeminiKey] = None,
+    ) -> Optional[GeminiKey]:
+        """
+        Наименее загруженный доступный ключ для модели или None.
+        default_only — только основной ключ (запрос ссылается на файл
+        Files API, а файлы видны лишь в своём проекте); exclude — кроме
+        этого ключа (хедж на другой проект).
+        """
+        now = time.monotonic()
+        candidates = [
+            key for key in self.keys[: 1 if default_only else None]
+            if key is not exclude and key.available(model, now, self.rpm_limit, self.tpm_limit)
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda k: (
+            k.in_flight, k.requests_last_minute(now), k.tokens_last_minute(now), k.index,
+        ))
+
+    def exhausted(self, model: str) -> bool:
+        """Квота модели кончилась на всех ключах (а не просто мягкий RPM/TPM-лимит)."""
+        now = time.monotonic()
+        return all(key.cooldown_until.get(model, 0.0) > now for key in self.keys)
+
+    def start(self, key: GeminiKey) -> None:
+        key.in_flight += 1
+        key.requests += 1
+        key._requests.append(time.monotonic())
+
+    def finish(self, key: GeminiKey) -> None:
+        key.in_flight = max(key.in_flight - 1, 0)
+
+    def add_tokens(self, key: GeminiKey, tokens: int) -> None:
+        if tokens > 0:
+            key._tokens.append((time.monotonic(), tokens))
+
+    def report_quota(self, key: GeminiKey, model: str) -> None:
+        key.quota_errors += 1
+        key.cooldown_until[model] = time.monotonic() + self.quota_cooldown
+        logger.warning(
+            f"[GEMINI KEYS] {key.label} hit quota on {model}, cooling down {self.quota_cooldown:.0f}s"
+        )
+
+    def report_error(self, key: GeminiKey) -> None:
+        key.errors += 1
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "keys": {key.label: key.as_dict(now) for key in self.keys},
+            "rpm_limit": self.rpm_limit,
+            "tpm_limit": self.tpm_limit,
+        }
+
+
+gemini_key_pool = GeminiKeyPool(
+    api_keys=settings.gemini_api_keys,
+    quota_cooldown=settings.GEMINI_KEY_QUOTA_COOLDOWN_SECONDS,
+    rpm_limit=settings.GEMINI_KEY_RPM_LIMIT,
+    tpm_limit=settings.GEMINI_KEY_TPM_LIMIT,
+)
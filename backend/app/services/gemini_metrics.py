@@ -0,0 +1,264 @@
+# app/services/gemini_metrics.py
+
+import logging
+import re
+import time
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field, replace
+from typing import Optional, Dict, Any, Deque, Iterator
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Эндпоинт текущего HTTP-запроса (выставляет middleware в main.py)
+_current_endpoint: ContextVar[Optional[str]] = ContextVar("gemini_endpoint", default=None)
+
+_ID_SEGMENT_RE = re.compile(r"/\d+(?=/|$)")
+
+
+def set_current_endpoint(method: str, path: str) -> None:
+    """Запоминает эндпоинт запроса; числовые id в пути схлопываются в {id}."""
+    _current_endpoint.set(f"{method} {_ID_SEGMENT_RE.sub('/{id}', path)}")
+
+
+def current_endpoint() -> Optional[str]:
+    return _current_endpoint.get()
+
+
+def estimate_cost(
+    model: str,
+    prompt_tokens: int,
+    response_tokens: int,
+    cached_tokens: int = 0,
+) -> float:
+    """
+    Оценка стоимости вызова в USD по GEMINI_PRICES_PER_1M_TOKENS.
+    cached_tokens — часть prompt_tokens из кэша контекста (дешевле).
+    """
+    prices = settings.GEMINI_PRICES_PER_1M_TOKENS.get(model)
+    if not prices:
+        return 0.0
+    input_price, output_price = prices
+    cached_tokens = min(cached_tokens, prompt_tokens)
+    input_cost = (
+        (prompt_tokens - cached_tokens) * input_price
+        + cached_tokens * input_price * settings.GEMINI_CACHED_INPUT_PRICE_RATIO
+    )
+    return (input_cost + response_tokens * output_price) / 1_000_000
+
+
+@dataclass
+class GeminiCall:
+    """
+    Учёт одного вызова GeminiService (все попытки вместе).
+
+    latency_ms — полное время вызова, включая очередь и паузы между
+    попытками; model_ms — только время ответа модели.
+    Пустой GeminiCall() можно передать в сервис как out-параметр.
+    """
+    operation: str = ""
+    model: str = ""
+    user_id: Optional[int] = None
+    endpoint: Optional[str] = None
+    attempts: int = 0
+    # Хеджирующие дубликаты (в attempts не входят)
+    hedges: int = 0
+    prompt_tokens: int = 0
+    response_tokens: int = 0
+    cached_tokens: int = 0
+    queue_wait_ms: float = 0.0
+    model_ms: float = 0.0
+    latency_ms: float = 0.0
+    outcome: Optional[str] = None
+    started_at: float = field(default_factory=time.monotonic)
+
+    @property
+    def retries(self) -> int:
+        return max(self.attempts - 1, 0)
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.response_tokens
+
+    @property
+    def cost_usd(self) -> float:
+        return estimate_cost(self.model, self.prompt_tokens, self.response_tokens, self.cached_tokens)
+
+    @contextmanager
+    def attempt(self, queue_wait: float = 0.0) -> Iterator[None]:
+        """Оборачивает одну попытку запроса к модели (внутри слота планировщика)."""
+        self.attempts += 1
+        self.queue_wait_ms += queue_wait * 1000
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.model_ms += (time.monotonic() - started) * 1000
+
+    def add_usage(self, response: Any) -> None:
+        """Токены из response.usage_metadata (если SDK их вернул)."""
+        usage = getattr(response, "usage_metadata", None)
+        if usage is None:
+            return
+        self.prompt_tokens += getattr(usage, "prompt_token_count", 0) or 0
+        self.response_tokens += getattr(usage, "candidates_token_count", 0) or 0
+        self.cached_tokens += getattr(usage, "cached_content_token_count", 0) or 0
+
+    def share(self, parts: int) -> "GeminiCall":
+        """Доля вызова на одну из parts картинок (один запрос на несколько вещей)."""
+        parts = max(parts, 1)
+        return replace(
+            self,
+            prompt_tokens=self.prompt_tokens // parts,
+            response_tokens=self.response_tokens // parts,
+            cached_tokens=self.cached_tokens // parts,
+        )
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "operation": self.operation,
+            "model": self.model,
+            "endpoint": self.endpoint,
+            "attempts": self.attempts,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "prompt_tokens": self.prompt_tokens,
+            "response_tokens": self.response_tokens,
+            "cached_tokens": self.cached_tokens,
+            "queue_wait_ms": round(self.queue_wait_ms, 1),
+            "model_ms": round(self.model_ms, 1),
+            "latency_ms": round(self.latency_ms, 1),
+            "outcome": self.outcome,
+            "cost_usd": round(self.cost_usd, 6),
+        }
+
+
+class _Aggregate:
+    """Сумма по группе вызовов (эндпоинт, пользователь, модель)."""
+
+    def __init__(self, window: int = 500) -> None:
+        self.calls = 0
+        self.retries = 0
+        self.hedges = 0
+        self.prompt_tokens = 0
+        self.response_tokens = 0
+        self.cached_tokens = 0
+        self.cost_usd = 0.0
+        self.total_latency_ms = 0.0
+        self.outcomes: Counter = Counter()
+        self._recent: Deque[float] = deque(maxlen=window)
+
+    def add(self, call: GeminiCall) -> None:
+        self.calls += 1
+        self.retries += call.retries
+        self.hedges += call.hedges
+        self.prompt_tokens += call.prompt_tokens
+        self.response_tokens += call.response_tokens
+        self.cached_tokens += call.cached_tokens
+        self.cost_usd += call.cost_usd
+        self.total_latency_ms += call.latency_ms
+        self.outcomes[call.outcome or "unknown"] += 1
+        self._recent.append(call.latency_ms)
+
+    def percentile(self, q: float) -> float:
+        if not self._recent:
+            return 0.0
+        ordered = sorted(self._recent)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "prompt_tokens": self.prompt_tokens,
+            "response_tokens": self.response_tokens,
+            "cached_tokens": self.cached_tokens,
+            "cost_usd": round(self.cost_usd, 6),
+            "avg_latency_ms": round(self.total_latency_ms / self.calls, 1) if self.calls else 0.0,
+            "p50_latency_ms": round(self.percentile(0.50), 1),
+            "p95_latency_ms": round(self.percentile(0.95), 1),
+            "outcomes": dict(self.outcomes),
+        }
+
+
+class GeminiMetrics:
+    """
+    Агрегаты по вызовам Gemini: всего, по операциям, моделям, эндпоинтам
+    и пользователям (последние max_users активных, LRU).
+    """
+
+    def __init__(self, max_users: int) -> None:
+        self.max_users = max_users
+        self.total = _Aggregate()
+        self.by_operation: Dict[str, _Aggregate] = {}
+        self.by_model: Dict[str, _Aggregate] = {}
+        self.by_endpoint: Dict[str, _Aggregate] = {}
+        self.by_user: "OrderedDict[int, _Aggregate]" = OrderedDict()
+
+    def start(
+        self,
+        operation: str,
+        model: str,
+        user_id: Optional[int] = None,
+        call: Optional[GeminiCall] = None,
+    ) -> GeminiCall:
+        """
+        Новый учёт вызова. Если вызывающий передал свой GeminiCall
+        (чтобы потом сохранить его в AIAnalysis) — заполняется он.
+        """
+        if call is None:
+            call = GeminiCall(operation=operation, model=model)
+        call.operation = operation
+        call.model = model
+        call.user_id = user_id
+        call.endpoint = current_endpoint()
+        call.started_at = time.monotonic()
+        return call
+
+    def finish(self, call: GeminiCall, outcome: str) -> None:
+        """Фиксирует итог вызова и добавляет его в агрегаты."""
+        call.outcome = call.outcome or outcome
+        call.latency_ms = (time.monotonic() - call.started_at) * 1000
+
+        self.total.add(call)
+        self.by_operation.setdefault(call.operation, _Aggregate()).add(call)
+        self.by_model.setdefault(call.model, _Aggregate()).add(call)
+        self.by_endpoint.setdefault(call.endpoint or "background", _Aggregate()).add(call)
+
+        if call.user_id is not None:
+            aggregate = self.by_user.get(call.user_id)
+            if aggregate is None:
+                aggregate = self.by_user[call.user_id] = _Aggregate()
+            self.by_user.move_to_end(call.user_id)
+            aggregate.add(call)
+            while len(self.by_user) > self.max_users:
+                self.by_user.popitem(last=False)
+
+        logger.info(
+            f"[GEMINI METRICS] {call.operation} {call.model} outcome={call.outcome} "
+            f"attempts={call.attempts} tokens={call.prompt_tokens}+{call.response_tokens} "
+            f"(cached={call.cached_tokens}) "
+            f"latency={call.latency_ms:.0f}ms"
+        )
+
+    def user_stats(self, user_id: int) -> Dict[str, Any]:
+        aggregate = self.by_user.get(user_id)
+        return aggregate.as_dict() if aggregate else _Aggregate().as_dict()
+
+    def stats(self, include_users: bool = False) -> Dict[str, Any]:
+        result = {
+            "total": self.total.as_dict(),
+            "by_operation": {k: v.as_dict() for k, v in self.by_operation.items()},
+            "by_model": {k: v.as_dict() for k, v in self.by_model.items()},
+            "by_endpoint": {k: v.as_dict() for k, v in self.by_endpoint.items()},
+        }
+        if include_users:
+            result["by_user"] = {str(k): v.as_dict() for k, v in self.by_user.items()}
+        return result
+
+
+gemini_metrics = GeminiMetrics(max_users=settings.GEMINI_METRICS_MAX_USERS)
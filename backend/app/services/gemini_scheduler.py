@@ -0,0 +1,239 @@
+# app/services/gemini_scheduler.py
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Optional, Dict, Any, Deque, AsyncIterator
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    """Классы приоритета: меньше значение — раньше обслуживается."""
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+
+class GeminiOverloadedError(Exception):
+    """Очередь к Gemini слишком длинная — запрос отклонён (load shedding)."""
+
+    def __init__(self, message: str, retry_after: float = 5.0) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+@dataclass
+class _Waiter:
+    user_key: Any
+    priority: Priority
+    future: asyncio.Future
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+class _WaitStats:
+    """Статистика ожидания в очереди для одного класса приоритета."""
+
+    def __init__(self, window: int = 500) -> None:
+        self.granted = 0
+        self.shed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._recent: Deque[float] = deque(maxlen=window)
+
+    def record(self, wait: float) -> None:
+        self.granted += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self._recent.append(wait)
+
+    def percentile(self, q: float) -> float:
+        if not self._recent:
+            return 0.0
+        ordered = sorted(self._recent)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "granted": self.granted,
+            "shed": self.shed,
+            "avg_wait_ms": round(self.total_wait / self.granted * 1000, 1) if self.granted else 0.0,
+            "p50_wait_ms": round(self.percentile(0.50) * 1000, 1),
+            "p95_wait_ms": round(self.percentile(0.95) * 1000, 1),
+            "max_wait_ms": round(self.max_wait * 1000, 1),
+        }
+
+
+class GeminiScheduler:
+    """
+    Единая точка входа для всех вызовов Gemini.
+
+    - глобальный лимит одновременных запросов;
+    - строгие приоритеты (интерактивные запросы раньше фоновых);
+    - внутри приоритета — round-robin по пользователям, чтобы один
+      пользователь с пятью образами не занимал всю квоту;
+    - load shedding: если ожидаемое или фактическое ожидание в очереди
+      превышает порог, запрос отклоняется с GeminiOverloadedError.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        max_queue_wait: Dict[Priority, float],
+    ) -> None:
+        self.max_concurrency = max_concurrency
+        self.max_queue_wait = max_queue_wait
+
+        self._active = 0
+        # priority -> user_key -> очередь ожидающих (порядок ключей = очередь round-robin)
+        self._queues: Dict[Priority, "OrderedDict[Any, Deque[_Waiter]]"] = {
+            p: OrderedDict() for p in Priority
+        }
+        self._queued = {p: 0 for p in Priority}
+
+        # EWMA длительности одного вызова — для оценки ожидания
+        self._avg_service_time = 2.0
+        self._stats = {p: _WaitStats() for p in Priority}
+
+    def _queued_ahead(self, priority: Priority) -> int:
+        return sum(self._queued[p] for p in Priority if p <= priority)
+
+    def _estimated_wait(self, priority: Priority) -> float:
+        ahead = self._queued_ahead(priority) + 1
+        return ahead * self._avg_service_time / max(self.max_concurrency, 1)
+
+    def _dispatch(self) -> None:
+        """Раздаёт освободившиеся слоты ожидающим."""
+        while self._active < self.max_concurrency:
+            waiter = self._next_waiter()
+            if waiter is None:
+                return
+            if waiter.future.done():
+                # Отменён или вышел по таймауту, пока стоял в очереди
+                continue
+            self._active += 1
+            waiter.future.set_result(None)
+
+    def _next_waiter(self) -> Optional[_Waiter]:
+        for priority in Priority:
+            users = self._queues[priority]
+            if not users:
+                continue
+            user_key, waiters = next(iter(users.items()))
+            waiter = waiters.popleft()
+            self._queued[priority] -= 1
+            if waiters:
+                users.move_to_end(user_key)
+            else:
+                del users[user_key]
+            return waiter
+        return None
+
+    def _remove(self, waiter: _Waiter) -> None:
+        users = self._queues[waiter.priority]
+        waiters = users.get(waiter.user_key)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            self._queued[waiter.priority] -= 1
+            if not waiters:
+                del users[waiter.user_key]
+
+    async def _acquire(self, user_key: Any, priority: Priority) -> float:
+        stats = self._stats[priority]
+
+        if self._active < self.max_concurrency and self._queued_ahead(priority) == 0:
+            self._active += 1
+            stats.record(0.0)
+            return 0.0
+
+        max_wait = self.max_queue_wait[priority]
+        estimated = self._estimated_wait(priority)
+        if estimated > max_wait:
+            stats.shed += 1
+            logger.warning(
+                f"[SCHEDULER] Shedding {priority.name} request from {user_key}: "
+                f"estimated wait {estimated:.1f}s > {max_wait:.1f}s"
+            )
+            raise GeminiOverloadedError("Gemini queue is full, try again later", retry_after=estimated)
+
+        waiter = _Waiter(
+            user_key=user_key,
+            priority=priority,
+            future=asyncio.get_running_loop().create_future(),
+        )
+        self._queues[priority].setdefault(user_key, deque()).append(waiter)
+        self._queued[priority] += 1
+
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout=max_wait)
+        except asyncio.TimeoutError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Слот выдали в момент таймаута — пользуемся им
+                pass
+            else:
+                waiter.future.cancel()
+                self._remove(waiter)
+                stats.shed += 1
+                logger.warning(f"[SCHEDULER] {priority.name} request from {user_key} waited > {max_wait:.1f}s")
+                raise GeminiOverloadedError("Gemini queue wait exceeded", retry_after=max_wait)
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                self._release(0.0)
+            else:
+                waiter.future.cancel()
+                self._remove(waiter)
+            raise
+
+        wait = time.monotonic() - waiter.enqueued_at
+        stats.record(wait)
+        return wait
+
+    def _release(self, service_time: float) -> None:
+        self._active -= 1
+        if service_time > 0:
+            self._avg_service_time = 0.9 * self._avg_service_time + 0.1 * service_time
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        user_id: Optional[int] = None,
+        priority: Priority = Priority.INTERACTIVE,
+    ) -> AsyncIterator[float]:
+        """
+        Занимает слот на один вызов Gemini. Отдаёт время ожидания в очереди (сек).
+
+        Raises:
+            GeminiOverloadedError: очередь перегружена
+        """
+        user_key = user_id if user_id is not None else "anonymous"
+        wait = await self._acquire(user_key, priority)
+        started = time.monotonic()
+        try:
+            yield wait
+        finally:
+            self._release(time.monotonic() - started)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "active": self._active,
+            "queued": {p.name.lower(): self._queued[p] for p in Priority},
+            "avg_call_seconds": round(self._avg_service_time, 2),
+            "priorities": {p.name.lower(): self._stats[p].as_dict() for p in Priority},
+        }
+
+
+# GEMINI_MAX_CONCURRENCY — на один ключ; с пулом ключей пропускная способность растёт
+gemini_scheduler = GeminiScheduler(
+    max_concurrency=settings.GEMINI_MAX_CONCURRENCY * max(len(settings.gemini_api_keys), 1),
+    max_queue_wait={
+        Priority.INTERACTIVE: settings.GEMINI_MAX_QUEUE_WAIT_SECONDS,
+        Priority.BACKGROUND: settings.GEMINI_BACKGROUND_MAX_QUEUE_WAIT_SECONDS,
+    },
+)
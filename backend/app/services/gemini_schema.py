@@ -0,0 +1,188 @@
+# app/services/gemini_schema.py
+
+import json
+import logging
+from typing import Optional, Dict, Any, List, Type
+
+from pydantic import BaseModel, TypeAdapter, ValidationError
+
+from app.schemas.ai import (
+    ClothingAnalysis,
+    ClothingAnalysisBatch,
+    DetectedClothingItem,
+    IndexedClothingAnalysis,
+    OutfitPlan,
+    OutfitPlanOutfit,
+    OutfitPlanSlot,
+)
+from app.services.json_stream import repair_truncated_json
+
+logger = logging.getLogger(__name__)
+
+_JSON_TYPES = {
+    "string": "STRING",
+    "number": "NUMBER",
+    "integer": "INTEGER",
+    "boolean": "BOOLEAN",
+    "array": "ARRAY",
+    "object": "OBJECT",
+}
+
+
+def _convert(node: Dict[str, Any], defs: Dict[str, Any]) -> Dict[str, Any]:
+    if "$ref" in node:
+        resolved = dict(defs[node["$ref"].split("/")[-1]])
+        if "description" in node:
+            resolved["description"] = node["description"]
+        return _convert(resolved, defs)
+
+    nullable = False
+    if "anyOf" in node:
+        variants = [v for v in node["anyOf"] if v.get("type") != "null"]
+        nullable = len(variants) < len(node["anyOf"])
+        if len(variants) != 1:
+            raise ValueError(f"Unsupported union in response schema: {node['anyOf']}")
+        merged = dict(variants[0])
+        if "description" in node:
+            merged["description"] = node["description"]
+        node = merged
+        if "$ref" in node:
+            converted = _convert(node, defs)
+            if nullable:
+                converted["nullable"] = True
+            return converted
+
+    result: Dict[str, Any] = {"type_": _JSON_TYPES[node["type"]]}
+    if nullable:
+        result["nullable"] = True
+    if node.get("description"):
+        result["description"] = node["description"]
+    if "enum" in node:
+        result["enum"] = [str(v) for v in node["enum"]]
+    if node["type"] == "array":
+        result["items"] = _convert(node["items"], defs)
+    if node["type"] == "object":
+        result["properties"] = {
+            name: _convert(prop, defs) for name, prop in node.get("properties", {}).items()
+        }
+        if node.get("required"):
+            result["required"] = list(node["required"])
+    return result
+
+
+def gemini_response_schema(model: Type[BaseModel]) -> Dict[str, Any]:
+    """
+    JSON Schema pydantic-модели -> подмножество OpenAPI, которое понимает
+    response_schema Gemini (без default/title/$ref, Optional -> nullable).
+
+    Обязательными считаются поля без значения по умолчанию.
+    """
+    schema = model.model_json_schema()
+    defs = schema.get("$defs", {})
+    # Докстринги классов (по-русски, для разработчиков) модели не нужны
+    schema.pop("description", None)
+    for definition in defs.values():
+        definition.pop("description", None)
+    return _convert(schema, defs)
+
+
+# Валидаторы собираются один раз при импорте, а не на каждый ответ
+CLOTHING_ANALYSIS_ADAPTER = TypeAdapter(ClothingAnalysis)
+CLOTHING_ANALYSIS_BATCH_ADAPTER = TypeAdapter(ClothingAnalysisBatch)
+INDEXED_ANALYSIS_ADAPTER = TypeAdapter(IndexedClothingAnalysis)
+DETECTED_ITEM_ADAPTER = TypeAdapter(DetectedClothingItem)
+OUTFIT_PLAN_ADAPTER = TypeAdapter(OutfitPlan)
+OUTFIT_ADAPTER = TypeAdapter(OutfitPlanOutfit)
+OUTFIT_SLOT_ADAPTER = TypeAdapter(OutfitPlanSlot)
+
+
+def parse_model_json(text: str, adapter: TypeAdapter) -> Optional[Any]:
+    """
+    Разбор ответа модели: сначала как есть (pydantic-core, без json.loads),
+    при ошибке — после достройки обрезанного JSON. None, если не удалось.
+    """
+    text = (text or "").strip()
+    if not text:
+        return None
+
+    try:
+        return adapter.validate_json(text)
+    except ValidationError as e:
+        first_error = e
+
+    repaired = repair_truncated_json(text)
+    if repaired is None:
+        logger.warning(f"[GEMINI SCHEMA] No JSON in response: {first_error.errors()[0]['msg']}")
+        return None
+    try:
+        value = adapter.validate_json(repaired)
+    except ValidationError as e:
+        logger.warning(f"[GEMINI SCHEMA] Invalid response after repair: {e.errors()[0]['msg']}")
+        return None
+
+    if repaired != text:
+        logger.info(f"[GEMINI SCHEMA] Recovered JSON from {len(text)}-char response")
+    return value
+
+
+def parse_model_json_loose(text: str) -> Optional[Any]:
+    """Как parse_model_json, но без схемы: просто dict/list после достройки."""
+    repaired = repair_truncated_json(text or "")
+    if repaired is None:
+        return None
+    try:
+        return json.loads(repaired)
+    except ValueError:
+        return None
+
+
+def parse_outfit_plan(text: str) -> Optional[OutfitPlan]:
+    """
+    Разбор плана образов. Обрезанный посреди слота ответ целиком схему не
+    проходит (у последнего слота или образа нет обязательных полей), поэтому
+    после достройки образы и слоты проверяются по одному: неполные
+    отбрасываются, целые остаются. None — ни одного целого образа.
+    """
+    text = (text or "").strip()
+    if not text:
+        return None
+
+    try:
+        return OUTFIT_PLAN_ADAPTER.validate_json(text)
+    except ValidationError:
+        pass
+
+    payload = parse_model_json_loose(text)
+    raw_outfits = payload.get("outfits") if isinstance(payload, dict) else None
+    if not isinstance(raw_outfits, list):
+        logger.warning("[GEMINI SCHEMA] No outfits in outfit plan response")
+        return None
+
+    outfits: List[OutfitPlanOutfit] = []
+    dropped_outfits = dropped_slots = 0
+    for raw in raw_outfits:
+        if not isinstance(raw, dict):
+            dropped_outfits += 1
+            continue
+        slots: List[Dict[str, Any]] = []
+        for raw_slot in raw.get("slots") or []:
+            try:
+                slots.append(OUTFIT_SLOT_ADAPTER.validate_python(raw_slot).model_dump())
+            except ValidationError:
+                dropped_slots += 1
+        if not slots:
+            dropped_outfits += 1
+            continue
+        try:
+            outfits.append(OUTFIT_ADAPTER.validate_python({**raw, "slots": slots}))
+        except ValidationError:
+            dropped_outfits += 1
+
+    if dropped_outfits or dropped_slots:
+        logger.info(
+            f"[GEMINI SCHEMA] Outfit plan recovered: {len(outfits)} outfits kept, "
+            f"dropped {dropped_outfits} outfits and {dropped_slots} slots"
+        )
+    if not outfits:
+        return None
+    return OutfitPlan(outfits=outfits)
@@ -1,67 +1,55 @@
 # app/services/gemini_service.py
 
+import asyncio
+import hashlib
+import io
 import json
-import time
 import logging
 import os
-from typing import Optional, Dict, Any
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing, nullcontext
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Dict, Any, AsyncIterator, List, Set, Tuple
 import google.generativeai as genai
+from pydantic import ValidationError
 from app.core.config import settings
+from app.schemas.ai import (
+    ClothingAnalysis,
+    ClothingAnalysisBatch,
+    ItemAnalysisWithOutfitPlan,
+    OutfitDetection,
+    OutfitPlan,
+)
+from app.services.gemini_context_cache import gemini_context_cache
+from app.services.gemini_hedging import gemini_hedger
+from app.services.gemini_key_pool import GeminiKey, gemini_key_pool
+from app.services.gemini_metrics import GeminiCall, gemini_metrics
+from app.services.gemini_scheduler import GeminiOverloadedError, Priority, gemini_scheduler
+from app.services.gemini_schema import (
+    CLOTHING_ANALYSIS_ADAPTER,
+    DETECTED_ITEM_ADAPTER,
+    INDEXED_ANALYSIS_ADAPTER,
+    OUTFIT_SLOT_ADAPTER,
+    gemini_response_schema,
+    parse_model_json,
+    parse_model_json_loose,
+    parse_outfit_plan,
+)
+from app.services.json_stream import ANY_INDEX, IncrementalJSONParser
+from app.services.model_router import is_quota_error, model_router
+from app.services.image_service import PreparedImage, bytes_sha256, file_sha256, image_service
 
 logger = logging.getLogger(__name__)
 
 
-class GeminiService:
-    """Gemini AI service с улучшенным промптом для поиска."""
-
-    def __init__(self) -> None:
-        # Если GEMINI_MODEL есть в .env — используем его,
-        # иначе по умолчанию берём gemini-2.5-flash-lite
-        self.model_name = getattr(settings, "GEMINI_MODEL", None) or "gemini-2.5-flash-lite"
-        
-        if not settings.GEMINI_API_KEY:
-            logger.warning("GEMINI_API_KEY not configured")
-            self.model = None
-            return
-
-        try:
-            genai.configure(api_key=settings.GEMINI_API_KEY)
-            self.model = genai.GenerativeModel(self.model_name)
-            logger.info(f"✓ Gemini AI initialized: {self.model_name}")
-        except Exception as e:
-            logger.error(f"Gemini init failed: {e}")
-            self.model = None
-
-    def _extract_json_from_text(self, text: str) -> Optional[str]:
-        """Извлекает JSON из текста."""
-        try:
-            start = text.find("{")
-            end = text.rfind("}")
-            if start == -1 or end == -1:
-                return None
-            return text[start: end + 1]
-        except Exception:
-            return None
-
-    async def analyze_clothing_image(
-        self,
-        image_path: str,
-        retries: int = 3,
-    ) -> Optional[Dict[str, Any]]:
-        """
-        Анализирует одежду на изображении с детальными тегами для поиска.
-        """
-        if not self.model:
-            logger.error("Gemini model not available")
-            return None
-
-        if not os.path.exists(image_path):
-            logger.error(f"Image not found: {image_path}")
-            return None
-
-        # НОВЫЙ ПРОМПТ С ТЕГАМИ
-        prompt = """You are a professional fashion stylist and product search expert.
-Analyze this clothing item in GREAT DETAIL and return valid JSON.
+# Статическая системная инструкция анализа одежды с тегами для поиска.
+# Отправляется как system_instruction и кэшируется на сервере (CachedContent);
+# в каждом запросе — только короткий CLOTHING_ANALYSIS_REQUEST и картинка.
+# Любое изменение текста меняет analysis_version и инвалидирует кэш анализов.
+CLOTHING_ANALYSIS_INSTRUCTION = """You are a professional fashion stylist and product search expert.
+Analyze the clothing item in the image you receive in GREAT DETAIL and return valid JSON.
 
 CRITICAL: If this is a specific type like varsity jacket, bomber, letterman jacket,
 denim jacket, etc. - you MUST specify that in category AND tags.
@@ -103,38 +91,782 @@ RULES:
 - Be VERY specific in category and tags
 """
 
+# Динамическая часть запроса анализа одной вещи
+CLOTHING_ANALYSIS_REQUEST = "Analyze this clothing item."
+
+# response_schema для Gemini: модель обязана вернуть JSON этой формы
+CLOTHING_ANALYSIS_SCHEMA = genai.protos.Schema(gemini_response_schema(ClothingAnalysis))
+CLOTHING_ANALYSIS_BATCH_SCHEMA = genai.protos.Schema(gemini_response_schema(ClothingAnalysisBatch))
+OUTFIT_DETECTION_SCHEMA = genai.protos.Schema(gemini_response_schema(OutfitDetection))
+OUTFIT_PLAN_SCHEMA = genai.protos.Schema(gemini_response_schema(OutfitPlan))
+ANALYSIS_WITH_PLAN_SCHEMA = genai.protos.Schema(gemini_response_schema(ItemAnalysisWithOutfitPlan))
+
+# Хэш схемы анализа: смена полей ClothingAnalysis тоже устаревает анализы
+ANALYSIS_SCHEMA_HASH = hashlib.sha256(
+    json.dumps(ClothingAnalysis.model_json_schema(), sort_keys=True).encode("utf-8")
+).hexdigest()[:8]
+
+# Ответ, если модель вернула что-то, но разобрать не удалось ни с одной попытки
+FALLBACK_ANALYSIS: Dict[str, Any] = {
+    "category": "unknown",
+    "subcategory": None,
+    "colors": ["unknown"],
+    "pattern": None,
+    "material": "unknown",
+    "fit": None,
+    "length": None,
+    "collar_type": None,
+    "sleeve_length": None,
+    "details": None,
+    "brand": None,
+    "target_audience": None,
+    "style": "casual",
+    "season": "all-season",
+    "description": "Could not analyze image",
+    "explanation": "",
+    "search_query": "casual clothing",
+    "search_keywords": ["casual", "clothing"],
+    "tags": ["clothing"],
+}
+
+# Статическая системная инструкция планов образов (кэшируется как и анализ)
+# и короткие шаблоны динамической части (str.format).
+# Изменение текста меняет outfit_prompt_version и инвалидирует кэш планов.
+OUTFIT_PLANNER_INSTRUCTION = """You are a professional fashion stylist AI. You create complete outfit plans.
+
+For each outfit, define 4 slots based on season:
+- If winter/autumn: top, bottom, shoes, outerwear
+- If spring/summer: top, bottom, shoes, accessory
+
+Return ONLY valid JSON (no markdown) in this structure:
+{
+  "outfits": [
+    {
+      "outfit_name": "Outfit name (2-4 words)",
+      "description": "Brief concept (1-2 sentences)",
+      "slots": [
+        {
+          "slot_type": "top/bottom/shoes/outerwear/accessory",
+          "description": "What this slot should be",
+          "search_query": "exact marketplace search query with gender",
+          "must_have": ["keyword1", "keyword2"],
+          "must_not_have": ["hoodie", "graphic"],
+          "color_palette": ["color1", "color2"]
+        }
+      ]
+    }
+  ]
+}
+
+Important:
+- Make search queries specific (include gender if needed)
+- Use must_not_have to exclude wrong items
+- Keep must_have to 2-3 keywords
+- Color palette: 2-4 colors
+- Make outfits cohesive with the requested style"""
+
+OUTFIT_FROM_ITEM_PROMPT = """Create {outfits_count} complete outfit plans around a specific clothing item.
+
+BASE ITEM:
+- Category: {base_category}
+- Colors: {base_colors}
+- Description: {base_desc}
+- Style: {base_style}
+
+REQUIREMENTS:
+- Overall style: {style}
+- Gender: {gender}
+- Season: {season_str}
+- Budget: {budget_str}
+- Create {outfits_count} different outfits that include or complement the base item"""
+
+OUTFIT_FROM_STYLE_PROMPT = """Create {outfits_count} complete outfit plans for {style} style.
+
+REQUIREMENTS:
+- Style: {style}
+- Gender: {gender}
+- Season: {season_str}
+- Budget: {budget_str}"""
+
+# Параллельный режим планов: каждый образ — отдельный вызов со своей
+# концепцией, чтобы независимые вызовы не выдали одинаковые образы
+OUTFIT_CONCEPT_HINTS = [
+    "a polished, elevated take",
+    "a relaxed everyday take",
+    "a bold statement take with strong contrast",
+    "a layered take mixing textures",
+    "a minimal, tonal take",
+]
+
+OUTFIT_CONCEPT_PROMPT = """
+
+This is outfit {index} of {total} in a set, each generated separately.
+Concept for THIS outfit: {hint}.
+The other outfits use these concepts, do not repeat them: {others}."""
+
+# Совмещённый запрос для ещё не проанализированной вещи: анализ и план
+# образов одним мультимодальным вызовом. Обе инструкции — дословно, чтобы
+# анализ совпадал с обычным; сверху — общий формат ответа.
+ANALYSIS_OUTFIT_PLAN_INSTRUCTION = (
+    CLOTHING_ANALYSIS_INSTRUCTION
+    + "\n\n"
+    + OUTFIT_PLANNER_INSTRUCTION
+    + """
+
+You may be asked to do BOTH in one answer: analyze the base item in the image and
+create outfit plans around it. Then return ONE JSON object:
+{"analysis": {...the clothing analysis fields...}, "outfits": [...the outfit plans...]}
+Write "analysis" first and build the outfits around the analyzed item."""
+)
+
+OUTFIT_FROM_IMAGE_PROMPT = """The image shows the BASE ITEM. Analyze it, then create {outfits_count} complete
+outfit plans that include or complement it.
+
+REQUIREMENTS:
+- Overall style: {style}
+- Gender: {gender}
+- Season: {season_str}
+- Budget: {budget_str}"""
+
+# Имя инструкции -> текст; имя входит в ключ серверного кэша
+SYSTEM_INSTRUCTIONS: Dict[str, str] = {
+    "analysis": CLOTHING_ANALYSIS_INSTRUCTION,
+    "outfit_plan": OUTFIT_PLANNER_INSTRUCTION,
+    "analysis_outfit_plan": ANALYSIS_OUTFIT_PLAN_INSTRUCTION,
+}
+
+# Динамическая часть запроса для нескольких картинок в одном запросе
+MULTI_IMAGE_INSTRUCTION = """You will receive {count} images, each preceded by a label "Image N".
+Each image shows ONE separate clothing item. Analyze every image independently.
+
+Return ONE JSON object:
+{{"items": [{{"image_index": 1, ...all fields from your instructions...}}, {{"image_index": 2, ...}}]}}
+with exactly {count} entries, one per image, in the same order.
+"""
+
+# Динамическая часть запроса разбора фото образа на отдельные вещи
+# (системная инструкция — та же, что у анализа одной вещи)
+OUTFIT_DETECTION_REQUEST = """This photo shows a whole outfit, possibly worn by a person.
+Find every distinct clothing item, shoes and accessory that is clearly visible (at most {max_items}).
+Ignore the person, the background and items that are mostly hidden.
+
+Return ONE JSON object:
+{{"items": [{{"box_2d": [ymin, xmin, ymax, xmax], ...all fields from your instructions...}}]}}
+box_2d is the tight bounding box of the item, normalized to 0-1000.
+Analyze each item on its own, as if it were photographed separately.
+"""
+
+
+class GeminiService:
+    """Gemini AI service с улучшенным промптом для поиска."""
+
+    def __init__(self) -> None:
+        # Если GEMINI_MODEL есть в .env — используем его,
+        # иначе по умолчанию берём gemini-2.5-flash-lite
+        self.model_name = getattr(settings, "GEMINI_MODEL", None) or "gemini-2.5-flash-lite"
+
+        # Files API синхронный — выносим upload/delete в отдельный пул потоков,
+        # чтобы не блокировать event loop.
+        self._upload_executor = ThreadPoolExecutor(
+            max_workers=settings.GEMINI_UPLOAD_WORKERS,
+            thread_name_prefix="gemini-upload",
+        )
+        # sha256 содержимого -> (загруженный файл, когда истекает на сервере)
+        self._uploaded_files: "OrderedDict[str, Tuple[Any, datetime]]" = OrderedDict()
+        # sha256 -> лок загрузки и число запросов, которые его держат или ждут
+        self._upload_locks: Dict[str, asyncio.Lock] = {}
+        self._upload_waiters: Dict[str, int] = {}
+        self._background_tasks: Set[asyncio.Task] = set()
+        # (модель, инструкция, номер ключа) -> модель с system_instruction,
+        # если серверный кэш инструкции недоступен; создаются по первому обращению
+        self._models: Dict[Tuple[str, str, int], Any] = {}
+
+        if not gemini_key_pool.keys:
+            logger.warning("GEMINI_API_KEY not configured")
+            self.model = None
+            return
+
+        try:
+            # Глобальный клиент SDK (Files API, кэш контекста) — на основном ключе пула
+            genai.configure(api_key=gemini_key_pool.keys[0].api_key)
+            self.model = genai.GenerativeModel(self.model_name)
+            logger.info(f"✓ Gemini AI initialized: {self.model_name}, {len(gemini_key_pool)} API key(s)")
+        except Exception as e:
+            logger.error(f"Gemini init failed: {e}")
+            self.model = None
+
+    async def _get_model(self, model_name: str, instruction: str, key: GeminiKey) -> Any:
+        """
+        GenerativeModel для модели маршрута со статической инструкцией
+        SYSTEM_INSTRUCTIONS[instruction] на ключе key из пула: поверх
+        серверного кэша контекста, а если он недоступен — с обычной
+        system_instruction. Кэш контекста живёт в проекте основного ключа,
+        поэтому на остальных ключах используется только system_instruction.
+        """
+        if settings.GEMINI_CONTEXT_CACHE_ENABLED and key.is_default:
+            model = await gemini_context_cache.get_model(
+                model_name, instruction, SYSTEM_INSTRUCTIONS[instruction]
+            )
+            if model is not None:
+                return model
+
+        cache_key = (model_name, instruction, key.index)
+        model = self._models.get(cache_key)
+        if model is None:
+            if key.is_default:
+                model = genai.GenerativeModel(model_name, system_instruction=SYSTEM_INSTRUCTIONS[instruction])
+            else:
+                # GenerativeModel SDK работает только с глобальным клиентом
+                # (основной ключ); остальные ключи ходят своим клиентом
+                model = key.generative_model(model_name, SYSTEM_INSTRUCTIONS[instruction])
+            self._models[cache_key] = model
+        return model
+
+    @staticmethod
+    def _references_uploaded_files(contents: Any) -> bool:
+        """В запросе есть файл Files API (он виден только проекту основного ключа)."""
+        parts = contents if isinstance(contents, list) else [contents]
+        return any(not isinstance(part, (str, dict)) for part in parts)
+
+    def _pick_model(
+        self,
+        task: str,
+        call: GeminiCall,
+        tried: List[str],
+        default_key_only: bool = False,
+    ) -> Tuple[str, GeminiKey]:
+        """
+        Модель и ключ для очередной попытки: модель — по маршруту задачи,
+        ключ — наименее загруженный из пула, у которого есть квота на эту
+        модель. Модель, у которой квота кончилась на всех ключах, уходит
+        в cool-down маршрутизатора.
+
+        Raises:
+            GeminiOverloadedError: все модели маршрута упёрлись в квоту
+        """
+        while True:
+            model_name = model_router.pick(task, exclude=tried)
+            if model_name is None:
+                call.outcome = "quota"
+                raise GeminiOverloadedError(
+                    f"All Gemini models for '{task}' are over quota",
+                    retry_after=model_router.retry_after(task),
+                )
+            key = gemini_key_pool.pick(model_name, default_only=default_key_only)
+            if key is not None:
+                call.model = model_name
+                return model_name, key
+
+            tried.append(model_name)
+            if gemini_key_pool.exhausted(model_name):
+                model_router.report_quota(
+                    model_name, Exception(f"429: quota exhausted on all {len(gemini_key_pool)} keys")
+                )
+
+    async def _generate(
+        self,
+        task: str,
+        instruction: str,
+        contents: Any,
+        generation_config: Dict[str, Any],
+        call: GeminiCall,
+        user_id: Optional[int],
+        priority: Priority,
+    ) -> Any:
+        """
+        Один запрос к Gemini через планировщик с переключением ключей и
+        моделей: при 429/квоте ключ остывает для этой модели, и запрос
+        повторяется на другом ключе пула, а когда квота кончилась на всех
+        ключах — на следующей модели маршрута задачи.
+        Медленный запрос хеджируется дубликатом (см. _hedged_request).
+        instruction — ключ SYSTEM_INSTRUCTIONS (статическая часть промпта).
+        """
+        tried: List[str] = []
+        default_key_only = self._references_uploaded_files(contents)
+        while True:
+            model_name, key = self._pick_model(task, call, tried, default_key_only)
+            try:
+                response, (model_name, key) = await self._hedged_request(
+                    task, model_name, key, instruction, contents, generation_config,
+                    call, user_id, priority, tried, default_key_only,
+                )
+            except Exception as e:
+                if not is_quota_error(e):
+                    raise
+                # Следующая попытка — на другом ключе или, если квота
+                # кончилась на всех ключах, на следующей модели маршрута
+                logger.warning(f"[GEMINI] {model_name} over quota on {key.label}, failing over")
+                continue
+
+            tokens_before = call.total_tokens
+            call.add_usage(response)
+            gemini_key_pool.add_tokens(key, call.total_tokens - tokens_before)
+            call.model = model_name
+            return response
+
+    async def _request(
+        self,
+        task: str,
+        model_name: str,
+        key: GeminiKey,
+        instruction: str,
+        contents: Any,
+        generation_config: Dict[str, Any],
+        call: GeminiCall,
+        user_id: Optional[int],
+        priority: Priority,
+        started: Optional[asyncio.Event] = None,
+        hedge: bool = False,
+    ) -> Any:
+        """
+        Один запрос к модели в слоте планировщика с учётом в пуле ключей и
+        маршрутизаторе. started выставляется, когда запрос получил слот.
+        Хедж не считается попыткой call (его учёт — call.hedges).
+        """
+        model = await self._get_model(model_name, instruction, key)
+        async with gemini_scheduler.slot(user_id, priority) as queue_wait:
+            if started is not None:
+                started.set()
+            request_started = time.monotonic()
+            gemini_key_pool.start(key)
+            try:
+                with nullcontext() if hedge else call.attempt(queue_wait):
+                    response = await model.generate_content_async(
+                        contents,
+                        generation_config=generation_config,
+                    )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if is_quota_error(e):
+                    gemini_key_pool.report_quota(key, model_name)
+                else:
+                    gemini_key_pool.report_error(key)
+                    model_router.report_error(model_name, e)
+                raise
+            finally:
+                gemini_key_pool.finish(key)
+
+        latency = time.monotonic() - request_started
+        model_router.report_success(model_name, latency)
+        gemini_hedger.observe(task, model_name, latency)
+        return response
+
+    def _hedge_target(
+        self,
+        task: str,
+        model_name: str,
+        key: GeminiKey,
+        tried: List[str],
+        default_key_only: bool,
+    ) -> Tuple[str, GeminiKey]:
+        """
+        Куда слать дубликат: та же модель на другом ключе, иначе (если
+        разрешено) следующая модель маршрута, иначе тот же ключ.
+        """
+        other_key = gemini_key_pool.pick(model_name, default_key_only, exclude=key)
+        if other_key is not None:
+            return model_name, other_key
+        if settings.GEMINI_HEDGE_ALTERNATE_MODEL:
+            other_model = model_router.pick(task, exclude=[*tried, model_name])
+            if other_model is not None:
+                other_key = gemini_key_pool.pick(other_model, default_key_only)
+                if other_key is not None:
+                    return other_model, other_key
+        return model_name, key
+
+    @staticmethod
+    def _is_valid_response(response: Any) -> bool:
+        """Ответ содержит разбираемый JSON (все вызовы _generate просят JSON)."""
+        try:
+            text = response.text or ""
+        except ValueError:
+            return False
+        return parse_model_json_loose(text) is not None
+
+    async def _hedged_request(
+        self,
+        task: str,
+        model_name: str,
+        key: GeminiKey,
+        instruction: str,
+        contents: Any,
+        generation_config: Dict[str, Any],
+        call: GeminiCall,
+        user_id: Optional[int],
+        priority: Priority,
+        tried: List[str],
+        default_key_only: bool,
+    ) -> Tuple[Any, Tuple[str, GeminiKey]]:
+        """
+        Запрос с хеджированием: если за gemini_hedger.delay после получения
+        слота ответа нет и бюджет позволяет, уходит дубликат. Побеждает
+        первый ответ с валидным JSON, второй запрос отменяется.
+        Returns (response, (модель, ключ) победителя); при неудаче обоих
+        пробрасывается ошибка основного запроса.
+        """
+        gemini_hedger.record_request()
+        started = asyncio.Event()
+        primary = asyncio.create_task(
+            self._request(
+                task, model_name, key, instruction, contents, generation_config,
+                call, user_id, priority, started,
+            )
+        )
+        targets: Dict[asyncio.Task, Tuple[str, GeminiKey]] = {primary: (model_name, key)}
+        try:
+            delay = gemini_hedger.delay(task, model_name)
+            if delay is not None:
+                slot_waiter = asyncio.create_task(started.wait())
+                await asyncio.wait({primary, slot_waiter}, return_when=asyncio.FIRST_COMPLETED)
+                slot_waiter.cancel()
+                if not primary.done():
+                    await asyncio.wait({primary}, timeout=delay)
+                if not primary.done() and gemini_hedger.try_acquire():
+                    hedge_model, hedge_key = self._hedge_target(
+                        task, model_name, key, tried, default_key_only
+                    )
+                    logger.info(
+                        f"[GEMINI] No response from {model_name} in {delay:.1f}s, "
+                        f"hedging to {hedge_model} on {hedge_key.label}"
+                    )
+                    call.hedges += 1
+                    hedge = asyncio.create_task(
+                        self._request(
+                            task, hedge_model, hedge_key, instruction, contents,
+                            generation_config, call, user_id, priority, hedge=True,
+                        )
+                    )
+                    targets[hedge] = (hedge_model, hedge_key)
+
+            pending = set(targets)
+            fallback: Optional[Tuple[Any, Tuple[str, GeminiKey]]] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task_done in done:
+                    if task_done.cancelled() or task_done.exception() is not None:
+                        continue
+                    response = task_done.result()
+                    if len(targets) == 1 or self._is_valid_response(response):
+                        if task_done is not primary:
+                            gemini_hedger.record_win()
+                            logger.info(f"[GEMINI] Hedged request to {targets[task_done][0]} won")
+                        return response, targets[task_done]
+                    # Невалидный ответ отдаём, только если второй тоже не справится
+                    fallback = fallback or (response, targets[task_done])
+
+            if fallback is not None:
+                return fallback
+            if not primary.cancelled() and primary.exception() is not None:
+                raise primary.exception()
+            for task_done in targets:
+                if not task_done.cancelled() and task_done.exception() is not None:
+                    raise task_done.exception()
+            raise RuntimeError("Gemini request was cancelled")
+        finally:
+            for task_pending in targets:
+                if not task_pending.done():
+                    task_pending.cancel()
+
+    @property
+    def analysis_version(self) -> str:
+        """
+        Версия анализа: хэш промпта + хэш схемы ответа (+ GEMINI_ANALYSIS_VERSION_TAG).
+        Ключ кэша анализов; пишется в AIAnalysis.analysis_version.
+
+        Модель в версию не входит: переанализ и failover идут через другие
+        модели, и ответ всё равно совместим по промпту и схеме. Чтобы
+        переанализировать вещи после смены модели, меняют тег.
+        """
+        prompt = CLOTHING_ANALYSIS_INSTRUCTION + CLOTHING_ANALYSIS_REQUEST
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:12]
+        version = f"{prompt_hash}:{ANALYSIS_SCHEMA_HASH}"
+        if settings.GEMINI_ANALYSIS_VERSION_TAG:
+            version = f"{version}:{settings.GEMINI_ANALYSIS_VERSION_TAG}"
+        return version
+
+    @property
+    def outfit_prompt_version(self) -> str:
+        """Версия генерации планов образов: модель + хэш шаблонов промптов."""
+        templates = (
+            OUTFIT_PLANNER_INSTRUCTION + OUTFIT_FROM_ITEM_PROMPT + OUTFIT_FROM_STYLE_PROMPT
+            + ANALYSIS_OUTFIT_PLAN_INSTRUCTION + OUTFIT_FROM_IMAGE_PROMPT
+            + OUTFIT_CONCEPT_PROMPT + "".join(OUTFIT_CONCEPT_HINTS)
+        )
+        prompt_hash = hashlib.sha256(templates.encode("utf-8")).hexdigest()[:12]
+        return f"{self.model_name}:{prompt_hash}"
+
+    # ============ FILES API: ЗАГРУЗКА И КЭШ ХЭНДЛОВ ============
+
+    def _file_expires_at(self, uploaded_file: Any) -> datetime:
+        """Срок жизни файла на сервере (не дольше GEMINI_FILE_TTL_SECONDS)."""
+        now = datetime.now(timezone.utc)
+        expires_at = now + timedelta(seconds=settings.GEMINI_FILE_TTL_SECONDS)
+        server_expiry = getattr(uploaded_file, "expiration_time", None)
+        if isinstance(server_expiry, datetime):
+            if server_expiry.tzinfo is None:
+                server_expiry = server_expiry.replace(tzinfo=timezone.utc)
+            if now < server_expiry < expires_at:
+                expires_at = server_expiry
+        return expires_at
+
+    def _get_cached_upload(self, content_hash: str) -> Optional[Any]:
+        """Возвращает ещё живой хэндл из кэша или None."""
+        entry = self._uploaded_files.get(content_hash)
+        if not entry:
+            return None
+
+        uploaded_file, expires_at = entry
+        margin = timedelta(seconds=settings.GEMINI_FILE_EXPIRY_MARGIN_SECONDS)
+        if datetime.now(timezone.utc) + margin >= expires_at:
+            self._uploaded_files.pop(content_hash, None)
+            self._schedule_remote_delete(uploaded_file)
+            return None
+
+        self._uploaded_files.move_to_end(content_hash)
+        return uploaded_file
+
+    async def _get_uploaded_file(
+        self,
+        image_path: str,
+        prepared: Optional[PreparedImage] = None,
+    ) -> Any:
+        """
+        Загружает файл в Gemini Files API или переиспользует уже загруженный.
+
+        Если передан prepared, грузится подготовленная копия, а не оригинал.
+        Ключ кэша — SHA-256 загружаемых байтов, поэтому ретраи и /ai/re-analyze
+        той же картинки не грузят её повторно.
+        """
+        loop = asyncio.get_running_loop()
+        if prepared is not None:
+            content_hash = await loop.run_in_executor(self._upload_executor, bytes_sha256, prepared.data)
+        else:
+            content_hash = await loop.run_in_executor(self._upload_executor, file_sha256, image_path)
+
+        cached = self._get_cached_upload(content_hash)
+        if cached is not None:
+            logger.info(f"[GEMINI] Reusing uploaded file {cached.name}")
+            return cached
+
+        lock = self._upload_locks.setdefault(content_hash, asyncio.Lock())
+        self._upload_waiters[content_hash] = self._upload_waiters.get(content_hash, 0) + 1
+        try:
+            async with lock:
+                # Пока ждали лок, файл мог загрузить параллельный запрос
+                cached = self._get_cached_upload(content_hash)
+                if cached is not None:
+                    return cached
+
+                if prepared is not None:
+                    upload = loop.run_in_executor(
+                        self._upload_executor,
+                        lambda: genai.upload_file(
+                            io.BytesIO(prepared.data),
+                            mime_type=prepared.mime_type,
+                            display_name=os.path.basename(image_path),
+                        ),
+                    )
+                else:
+                    upload = loop.run_in_executor(self._upload_executor, genai.upload_file, image_path)
+
+                uploaded_file = None
+                try:
+                    # Отмена запроса не останавливает загрузку в потоке:
+                    # shield сохраняет её результат, чтобы файл не потерялся
+                    uploaded_file = await asyncio.shield(upload)
+                finally:
+                    if uploaded_file is None:
+                        upload.add_done_callback(
+                            lambda done: self._keep_orphan_upload(content_hash, done)
+                        )
+                self._remember_upload(content_hash, uploaded_file)
+                logger.info(f"[GEMINI] Uploaded {image_path} as {uploaded_file.name}")
+                return uploaded_file
+        finally:
+            # Сразу после release лок свободен, но ждущие его ещё не проснулись —
+            # удалять лок, пока они есть, нельзя: новый запрос создал бы второй
+            self._upload_waiters[content_hash] -= 1
+            if not self._upload_waiters[content_hash]:
+                del self._upload_waiters[content_hash]
+                self._upload_locks.pop(content_hash, None)
+
+    def _remember_upload(self, content_hash: str, uploaded_file: Any) -> None:
+        """Кладёт хэндл в кэш; вытесненные файлы удаляются на сервере."""
+        self._uploaded_files[content_hash] = (uploaded_file, self._file_expires_at(uploaded_file))
+        self._uploaded_files.move_to_end(content_hash)
+        while len(self._uploaded_files) > settings.GEMINI_UPLOAD_CACHE_SIZE:
+            _, (evicted, _) = self._uploaded_files.popitem(last=False)
+            self._schedule_remote_delete(evicted)
+
+    def _keep_orphan_upload(self, content_hash: str, upload: "asyncio.Future[Any]") -> None:
+        """
+        Загрузка, которую перестали ждать (отмена запроса): готовый файл
+        попадает в кэш, а если там уже есть живой хэндл — удаляется.
+        """
+        if upload.cancelled() or upload.exception() is not None:
+            return
+        uploaded_file = upload.result()
+        if self._get_cached_upload(content_hash) is not None:
+            self._schedule_remote_delete(uploaded_file)
+            return
+        logger.info(f"[GEMINI] Keeping upload {uploaded_file.name} finished after cancellation")
+        self._remember_upload(content_hash, uploaded_file)
+
+    async def _image_part(
+        self,
+        image_path: str,
+        prepared: Optional[PreparedImage],
+    ) -> Any:
+        """Небольшие картинки отправляем inline, остальные — через Files API."""
+        if prepared is not None and len(prepared.data) <= settings.GEMINI_INLINE_MAX_BYTES:
+            return {"mime_type": prepared.mime_type, "data": prepared.data}
+        return await self._get_uploaded_file(image_path, prepared)
+
+    def _schedule_remote_delete(self, uploaded_file: Any) -> None:
+        """Удаляет файл на стороне Gemini в фоне, не задерживая запрос."""
+        name = getattr(uploaded_file, "name", None)
+        if not name:
+            return
+        try:
+            task = asyncio.get_running_loop().create_task(self._delete_remote_file(name))
+        except RuntimeError:
+            # Нет запущенного loop — сервер сам удалит файл по истечении срока
+            return
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def _delete_remote_file(self, name: str) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self._upload_executor, genai.delete_file, name)
+            logger.info(f"[GEMINI] Deleted remote file {name}")
+        except Exception as e:
+            logger.warning(f"[GEMINI] Failed to delete remote file {name}: {e}")
+
+    async def shutdown(self) -> None:
+        """Чистит загруженные файлы и кэши контекста, останавливает пул потоков."""
+        await gemini_context_cache.shutdown()
+        while self._uploaded_files:
+            _, (uploaded_file, _) = self._uploaded_files.popitem()
+            self._schedule_remote_delete(uploaded_file)
+
+        if self._background_tasks:
+            await asyncio.gather(*self._background_tasks, return_exceptions=True)
+
+        self._upload_executor.shutdown(wait=False)
+
+    @staticmethod
+    def _normalize_analysis(data: Dict[str, Any]) -> Dict[str, Any]:
+        """Валидация обязательных полей анализа."""
+        required = ["category", "colors", "tags"]
+        for field in required:
+            if data.get(field) is None:
+                data[field] = [] if field in ["colors", "tags"] else "unknown"
+        return data
+
+    async def _tracked(self, call: GeminiCall, coro: Any) -> Any:
+        """Выполняет вызов и записывает его итог в gemini_metrics."""
+        try:
+            result = await coro
+        except GeminiOverloadedError:
+            gemini_metrics.finish(call, "overloaded")
+            raise
+        except asyncio.CancelledError:
+            gemini_metrics.finish(call, "cancelled")
+            raise
+        except Exception:
+            gemini_metrics.finish(call, "error")
+            raise
+
+        if isinstance(result, list):
+            succeeded = any(r is not None for r in result)
+        else:
+            succeeded = bool(result)
+        gemini_metrics.finish(call, "ok" if succeeded else "failed")
+        return result
+
+    async def analyze_clothing_image(
+        self,
+        image_path: str,
+        retries: int = 3,
+        user_id: Optional[int] = None,
+        priority: Priority = Priority.INTERACTIVE,
+        call_info: Optional[GeminiCall] = None,
+        task: str = "analysis",
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Анализирует одежду на изображении с детальными тегами для поиска.
+
+        Вызовы идут через gemini_scheduler (user_id/priority — для честной
+        очереди). При перегрузке или исчерпании квоты всех моделей маршрута
+        task пробрасывается GeminiOverloadedError.
+        call_info, если передан, заполняется фактической моделью, токенами,
+        латентностью, числом попыток и итогом вызова.
+        """
+        call = gemini_metrics.start("analyze_image", self.model_name, user_id, call_info)
+        return await self._tracked(
+            call, self._analyze_clothing_image(image_path, retries, user_id, priority, call, task)
+        )
+
+    async def _analyze_clothing_image(
+        self,
+        image_path: str,
+        retries: int,
+        user_id: Optional[int],
+        priority: Priority,
+        call: GeminiCall,
+        task: str,
+    ) -> Optional[Dict[str, Any]]:
+        if not self.model:
+            logger.error("Gemini model not available")
+            return None
+
+        if not os.path.exists(image_path):
+            logger.error(f"Image not found: {image_path}")
+            return None
+
+        prompt = CLOTHING_ANALYSIS_REQUEST
+
+        # EXIF-поворот, даунскейл и пережатие — один раз на все попытки
+        prepared = await image_service.prepare_for_gemini(image_path)
+
         for attempt in range(retries):
             try:
-                logger.info(f"[GEMINI] Attempt {attempt + 1}/{retries} (model={self.model_name})")
-                
-                uploaded_file = genai.upload_file(image_path)
-                
-                response = await self.model.generate_content_async(
-                    [prompt, uploaded_file],
-                    generation_config={
+                logger.info(f"[GEMINI] Attempt {attempt + 1}/{retries} (task={task})")
+
+                image_part = await self._image_part(image_path, prepared)
+
+                response = await self._generate(
+                    task,
+                    "analysis",
+                    [prompt, image_part],
+                    {
                         "response_mime_type": "application/json",
+                        "response_schema": CLOTHING_ANALYSIS_SCHEMA,
                         "max_output_tokens": 1024,
                         "temperature": 0.6,
                     },
+                    call,
+                    user_id,
+                    priority,
                 )
 
                 raw_text = (response.text or "").strip()
-                json_str = self._extract_json_from_text(raw_text)
-                
-                if not json_str:
-                    logger.warning("[GEMINI] No JSON in response")
+                parsed = parse_model_json(raw_text, CLOTHING_ANALYSIS_ADAPTER)
+
+                if parsed is None:
+                    logger.warning("[GEMINI] Unparseable analysis response")
                     if attempt < retries - 1:
-                        time.sleep(1)
+                        await asyncio.sleep(1)
                         continue
-                    break
+                    if "{" not in raw_text:
+                        break
+                    # Fallback на дефолтный ответ
+                    call.outcome = "fallback"
+                    return dict(FALLBACK_ANALYSIS)
 
-                data = json.loads(json_str)
-
-                # Валидация обязательных полей
-                required = ["category", "colors", "tags"]
-                for field in required:
-                    if field not in data:
-                        data[field] = [] if field in ["colors", "tags"] else "unknown"
+                data = self._normalize_analysis(parsed.model_dump())
 
                 logger.info(
                     f"[GEMINI] ✓ Category: {data.get('category')}, "
@@ -143,233 +875,770 @@ RULES:
 
                 return data
 
-            except json.JSONDecodeError as e:
-                logger.error(f"[GEMINI] JSON parse error: {e}")
-                if attempt < retries - 1:
-                    time.sleep(1)
-                    continue
-
-                # Fallback на дефолтный ответ
-                return {
-                    "category": "unknown",
-                    "subcategory": None,
-                    "colors": ["unknown"],
-                    "pattern": None,
-                    "material": "unknown",
-                    "fit": None,
-                    "length": None,
-                    "collar_type": None,
-                    "sleeve_length": None,
-                    "details": None,
-                    "brand": None,
-                    "target_audience": None,
-                    "style": "casual",
-                    "season": "all-season",
-                    "description": "Could not analyze image",
-                    "explanation": "",
-                    "search_query": "casual clothing",
-                    "search_keywords": ["casual", "clothing"],
-                    "tags": ["clothing"],
-                }
+            except GeminiOverloadedError:
+                raise
 
             except Exception as e:
                 logger.error(f"[GEMINI] Error: {e}")
-                # При 429/квоте нет смысла ретраить дальше
-                if "429" in str(e) or "quota" in str(e).lower():
-                    break
 
                 if attempt < retries - 1:
-                    time.sleep(1)
+                    await asyncio.sleep(1)
                     continue
 
                 return None
 
         return None
 
+    async def analyze_clothing_images(
+        self,
+        image_paths: List[str],
+        retries: int = 2,
+        user_id: Optional[int] = None,
+        priority: Priority = Priority.INTERACTIVE,
+        call_info: Optional[GeminiCall] = None,
+        task: str = "analysis",
+    ) -> List[Optional[Dict[str, Any]]]:
+        """
+        Анализирует несколько вещей одним запросом (по одной вещи на картинку).
+
+        Возвращает список той же длины, что и image_paths. Картинки, для
+        которых модель не вернула результат, дозапрашиваются по одной через
+        analyze_clothing_image. call_info описывает общий запрос.
+        """
+        if not self.model:
+            logger.error("Gemini model not available")
+            return [None] * len(image_paths)
+
+        if len(image_paths) == 1:
+            return [
+                await self.analyze_clothing_image(
+                    image_paths[0], user_id=user_id, priority=priority, call_info=call_info, task=task
+                )
+            ]
+
+        call = gemini_metrics.start("analyze_images", self.model_name, user_id, call_info)
+        results = await self._tracked(
+            call, self._analyze_clothing_images(image_paths, retries, user_id, priority, call, task)
+        )
+
+        missing = [i for i, r in enumerate(results) if r is None]
+        if missing:
+            logger.warning(f"[GEMINI] Multi-image response missed {len(missing)} images, analyzing one by one")
+            singles = await asyncio.gather(
+                *(
+                    self.analyze_clothing_image(image_paths[i], user_id=user_id, priority=priority, task=task)
+                    for i in missing
+                )
+            )
+            for i, data in zip(missing, singles):
+                results[i] = data
+
+        return results
+
+    async def _analyze_clothing_images(
+        self,
+        image_paths: List[str],
+        retries: int,
+        user_id: Optional[int],
+        priority: Priority,
+        call: GeminiCall,
+        task: str,
+    ) -> List[Optional[Dict[str, Any]]]:
+        prepared_list = await asyncio.gather(
+            *(image_service.prepare_for_gemini(path) for path in image_paths)
+        )
+        prompt = MULTI_IMAGE_INSTRUCTION.format(count=len(image_paths))
+        results: List[Optional[Dict[str, Any]]] = [None] * len(image_paths)
+
+        for attempt in range(retries):
+            try:
+                logger.info(
+                    f"[GEMINI] Multi-image attempt {attempt + 1}/{retries}: "
+                    f"{len(image_paths)} images (task={task})"
+                )
+
+                parts: List[Any] = [prompt]
+                for idx, (path, prepared) in enumerate(zip(image_paths, prepared_list), start=1):
+                    parts.append(f"Image {idx}")
+                    parts.append(await self._image_part(path, prepared))
+
+                response = await self._generate(
+                    task,
+                    "analysis",
+                    parts,
+                    {
+                        "response_mime_type": "application/json",
+                        "response_schema": CLOTHING_ANALYSIS_BATCH_SCHEMA,
+                        "max_output_tokens": 1024 * len(image_paths),
+                        "temperature": 0.6,
+                    },
+                    call,
+                    user_id,
+                    priority,
+                )
+
+                # Без строгой схемы на весь ответ: обрезанный или частично
+                # битый ответ всё равно отдаёт целые элементы
+                payload = parse_model_json_loose(response.text or "")
+                if not isinstance(payload, dict):
+                    logger.warning("[GEMINI] No JSON in multi-image response")
+                    if attempt < retries - 1:
+                        await asyncio.sleep(1)
+                        continue
+                    break
+
+                for position, entry in enumerate(payload.get("items") or []):
+                    if not isinstance(entry, dict):
+                        continue
+                    entry.setdefault("image_index", position + 1)
+                    try:
+                        item = INDEXED_ANALYSIS_ADAPTER.validate_python(entry)
+                    except ValidationError:
+                        continue
+                    if 1 <= item.image_index <= len(image_paths):
+                        results[item.image_index - 1] = self._normalize_analysis(
+                            item.model_dump(exclude={"image_index"})
+                        )
+                break
+
+            except GeminiOverloadedError:
+                raise
+
+            except Exception as e:
+                logger.error(f"[GEMINI] Multi-image error: {e}")
+                if attempt < retries - 1:
+                    await asyncio.sleep(1)
+                    continue
+
+        return results
+
+    async def detect_clothing_items(
+        self,
+        image_path: str,
+        max_items: int,
+        retries: int = 2,
+        user_id: Optional[int] = None,
+        priority: Priority = Priority.INTERACTIVE,
+        call_info: Optional[GeminiCall] = None,
+        task: str = "analysis",
+    ) -> List[Dict[str, Any]]:
+        """
+        Находит все вещи на фото образа одним запросом.
+
+        Возвращает анализы вещей (не больше max_items), у каждой — рамка
+        box_2d [ymin, xmin, ymax, xmax] в координатах 0-1000. Пустой список —
+        модель ничего не нашла или ответ не разобрать.
+        """
+        if not self.model:
+            logger.error("Gemini model not available")
+            return []
+
+        if not os.path.exists(image_path):
+            logger.error(f"Image not found: {image_path}")
+            return []
+
+        call = gemini_metrics.start("detect_items", self.model_name, user_id, call_info)
+        return await self._tracked(
+            call,
+            self._detect_clothing_items(image_path, max_items, retries, user_id, priority, call, task),
+        )
+
+    async def _detect_clothing_items(
+        self,
+        image_path: str,
+        max_items: int,
+        retries: int,
+        user_id: Optional[int],
+        priority: Priority,
+        call: GeminiCall,
+        task: str,
+    ) -> List[Dict[str, Any]]:
+        prepared = await image_service.prepare_for_gemini(image_path)
+        prompt = OUTFIT_DETECTION_REQUEST.format(max_items=max_items)
+
+        for attempt in range(retries):
+            try:
+                logger.info(f"[GEMINI] Detection attempt {attempt + 1}/{retries} (task={task})")
+
+                image_part = await self._image_part(image_path, prepared)
+
+                response = await self._generate(
+                    task,
+                    "analysis",
+                    [prompt, image_part],
+                    {
+                        "response_mime_type": "application/json",
+                        "response_schema": OUTFIT_DETECTION_SCHEMA,
+                        "max_output_tokens": 1024 * max_items,
+                        "temperature": 0.4,
+                    },
+                    call,
+                    user_id,
+                    priority,
+                )
+
+                # Как и в multi-image: битый элемент не роняет остальные
+                payload = parse_model_json_loose(response.text or "")
+                if not isinstance(payload, dict):
+                    logger.warning("[GEMINI] No JSON in detection response")
+                    if attempt < retries - 1:
+                        await asyncio.sleep(1)
+                        continue
+                    break
+
+                items: List[Dict[str, Any]] = []
+                for entry in payload.get("items") or []:
+                    if not isinstance(entry, dict):
+                        continue
+                    try:
+                        item = DETECTED_ITEM_ADAPTER.validate_python(entry)
+                    except ValidationError:
+                        continue
+                    items.append(self._normalize_analysis(item.model_dump()))
+                    if len(items) >= max_items:
+                        break
+
+                logger.info(f"[GEMINI] ✓ Detected {len(items)} items")
+                return items
+
+            except GeminiOverloadedError:
+                raise
+
+            except Exception as e:
+                logger.error(f"[GEMINI] Detection error: {e}")
+                if attempt < retries - 1:
+                    await asyncio.sleep(1)
+                    continue
+
+        return []
+
     # ============ НОВАЯ ФУНКЦИЯ ДЛЯ ГЕНЕРАЦИИ ОБРАЗОВ ============
     
-    async def generate_outfit_plan(
+    def _build_outfit_prompt(
         self,
         style: str,
-        gender: str = "men",
+        gender: str,
+        season: Optional[str],
+        outfits_count: int,
+        base_item_analysis: Optional[Dict[str, Any]],
+        budget: Optional[str],
+        concept_hint: Optional[str] = None,
+    ) -> str:
+        """
+        Собирает промпт плана образов (вокруг вещи или с нуля).
+        concept_hint — хвост промпта одного образа параллельного режима.
+        """
+        season_str = season or "any season"
+        budget_str = budget or "mid-range"
+
+        if base_item_analysis:
+            # Режим "образ вокруг вещи"
+            base_colors = base_item_analysis.get("colors", [])
+            prompt = OUTFIT_FROM_ITEM_PROMPT.format(
+                outfits_count=outfits_count,
+                base_category=base_item_analysis.get("category", "clothing"),
+                base_colors=", ".join(base_colors) if base_colors else "not specified",
+                base_desc=base_item_analysis.get("description", ""),
+                base_style=base_item_analysis.get("style", style),
+                style=style,
+                gender=gender,
+                season_str=season_str,
+                budget_str=budget_str,
+            )
+        else:
+            # Режим "образ с нуля"
+            prompt = OUTFIT_FROM_STYLE_PROMPT.format(
+                outfits_count=outfits_count,
+                style=style,
+                gender=gender,
+                season_str=season_str,
+                budget_str=budget_str,
+            )
+        return prompt + (concept_hint or "")
+
+    @staticmethod
+    def _plan_max_tokens(outfits_count: int) -> int:
+        """Лимит ответа плана: одному образу хватает половины обычного."""
+        return 1024 if outfits_count == 1 else 2048
+
+    @staticmethod
+    def _concept_hints(total: int) -> List[str]:
+        """Хвосты промптов образов параллельного режима, по одному на образ."""
+        hints = [OUTFIT_CONCEPT_HINTS[i % len(OUTFIT_CONCEPT_HINTS)] for i in range(total)]
+        return [
+            OUTFIT_CONCEPT_PROMPT.format(
+                index=i + 1,
+                total=total,
+                hint=hint,
+                others="; ".join(h for j, h in enumerate(hints) if j != i),
+            )
+            for i, hint in enumerate(hints)
+        ]
+
+    def _parse_fused_analysis(self, value: Any) -> Optional[Dict[str, Any]]:
+        """Анализ вещи из совмещённого ответа или None, если он невалиден."""
+        if not isinstance(value, dict):
+            return None
+        try:
+            parsed = CLOTHING_ANALYSIS_ADAPTER.validate_python(value)
+        except ValidationError:
+            return None
+        return self._normalize_analysis(parsed.model_dump())
+
+    @staticmethod
+    def _chunk_text(chunk: Any) -> str:
+        """Текст куска стрима (у служебных кусков без parts .text бросает ValueError)."""
+        try:
+            return chunk.text or ""
+        except ValueError:
+            return ""
+
+    async def stream_outfit_plan(
+        self,
+        style: Optional[str],
+        gender: Optional[str] = "men",
         season: Optional[str] = None,
         outfits_count: int = 3,
         base_item_analysis: Optional[Dict[str, Any]] = None,
         budget: Optional[str] = None,
         retries: int = 2,
-    ) -> Optional[Dict[str, Any]]:
+        user_id: Optional[int] = None,
+        priority: Priority = Priority.INTERACTIVE,
+        base_image_path: Optional[str] = None,
+        call_info: Optional[GeminiCall] = None,
+        parallel: Optional[bool] = None,
+        concept_hint: Optional[str] = None,
+    ) -> AsyncIterator[Tuple[Any, ...]]:
         """
-        Генерирует структурированный план образов в формате JSON.
-        
-        Args:
-            style: Стиль образа (old money, streetwear, etc.)
-            gender: Пол (men/women/unisex)
-            season: Сезон (spring/summer/autumn/winter) - опционально
-            outfits_count: Количество образов (1-5)
-            base_item_analysis: Анализ базовой вещи (если from-item) - опционально
-            budget: Бюджет (low/mid/high) - опционально
-            retries: Количество попыток
-        
-        Returns:
-            Dict с планом образов
+        Потоковая генерация плана образов.
+
+        Отдаёт события:
+            ("analysis", analysis) — только в совмещённом режиме, см. ниже;
+            ("slot", outfit_index, slot_index, slot) — как только слот закрылся в JSON;
+            ("plan", plan_or_None) — последним событием, полный план.
+
+        base_image_path без base_item_analysis — совмещённый режим: один
+        мультимодальный запрос и анализирует вещь на фото, и строит образы
+        вокруг неё (gender/season/style, если не заданы, модель берёт из
+        анализа). Анализ приходит раньше слотов.
+
+        parallel (по умолчанию OUTFIT_PLAN_PARALLEL) — по потоку на каждый
+        образ, события сливаются; в совмещённом режиме не применяется.
+
+        Повторная попытка возможна, только пока ни одно событие не отдано наружу.
         """
-        if not self.model:
-            logger.error("Gemini model not available")
-            return None
+        fused = base_image_path is not None and not base_item_analysis
+        if parallel is None:
+            parallel = settings.OUTFIT_PLAN_PARALLEL
+        if parallel and outfits_count > 1 and not fused:
+            async for event in self._stream_outfit_plan_parallel(
+                style, gender, season, outfits_count, base_item_analysis,
+                budget, retries, user_id, priority,
+            ):
+                yield event
+            return
 
+        call = gemini_metrics.start(
+            "analysis_outfit_plan_stream" if fused
+            else "outfit_plan_stream_part" if concept_hint
+            else "outfit_plan_stream",
+            self.model_name, user_id, call_info,
+        )
+        outcome = "cancelled"
         try:
-            season_str = season or "any season"
-            budget_str = budget or "mid-range"
-            
-            if base_item_analysis:
-                # Режим "образ вокруг вещи"
-                base_category = base_item_analysis.get("category", "clothing")
-                base_colors = base_item_analysis.get("colors", [])
-                base_desc = base_item_analysis.get("description", "")
-                base_style = base_item_analysis.get("style", style)
-                
-                prompt = f"""You are a professional fashion stylist AI. Create {outfits_count} complete outfit plans around a specific clothing item.
+            outfit_plan = None
+            async for event in self._stream_outfit_plan(
+                style, gender, season, outfits_count, base_item_analysis,
+                budget, retries, user_id, priority, call,
+                base_image_path if fused else None, concept_hint,
+            ):
+                if event[0] == "plan":
+                    outfit_plan = event[1]
+                yield event
+            outcome = "ok" if outfit_plan else "failed"
+        except GeminiOverloadedError:
+            outcome = "overloaded"
+            raise
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            gemini_metrics.finish(call, outcome)
 
-BASE ITEM:
-- Category: {base_category}
-- Colors: {', '.join(base_colors) if base_colors else 'not specified'}
-- Description: {base_desc}
-- Style: {base_style}
+    async def _stream_outfit_plan_parallel(
+        self,
+        style: str,
+        gender: str,
+        season: Optional[str],
+        outfits_count: int,
+        base_item_analysis: Optional[Dict[str, Any]],
+        budget: Optional[str],
+        retries: int,
+        user_id: Optional[int],
+        priority: Priority,
+    ) -> AsyncIterator[Tuple[Any, ...]]:
+        """
+        Поток на каждый образ, события сливаются по мере прихода.
 
-REQUIREMENTS:
-- Overall style: {style}
-- Gender: {gender}
-- Season: {season_str}
-- Budget: {budget_str}
-- Create {outfits_count} different outfits that include or complement the base item
+        Номер образа в общем плане выдаётся при первом слоте его потока,
+        поэтому образ, упавший до первого слота, просто выпадает, а уже
+        отданные наружу индексы остаются верными. Образ, упавший после
+        слотов, собирается из того, что успело прийти.
+        """
+        queue: asyncio.Queue = asyncio.Queue()
 
-For each outfit, define 4 slots based on season:
-- If winter/autumn: top, bottom, shoes, outerwear
-- If spring/summer: top, bottom, shoes, accessory
+        async def run_part(part: int, hint: str) -> None:
+            try:
+                async for event in self.stream_outfit_plan(
+                    style, gender, season, 1, base_item_analysis, budget, retries,
+                    user_id, priority, parallel=False, concept_hint=hint,
+                ):
+                    await queue.put((part, event))
+            except Exception as e:
+                logger.warning(f"[GEMINI] Outfit part {part + 1}/{outfits_count} failed: {e}")
+                await queue.put((part, ("error", e)))
 
-Return ONLY valid JSON (no markdown) in this structure:
-{{
-  "outfits": [
-    {{
-      "outfit_name": "Outfit name (2-4 words)",
-      "description": "Brief concept (1-2 sentences)",
-      "slots": [
-        {{
-          "slot_type": "top/bottom/shoes/outerwear/accessory",
-          "description": "What this slot should be",
-          "search_query": "exact marketplace search query with gender",
-          "must_have": ["keyword1", "keyword2"],
-          "must_not_have": ["hoodie", "graphic"],
-          "color_palette": ["color1", "color2"]
-        }}
-      ]
-    }}
-  ]
-}}
+        parts = [
+            asyncio.create_task(run_part(part, hint))
+            for part, hint in enumerate(self._concept_hints(outfits_count))
+        ]
+        positions: Dict[int, int] = {}
+        slots: Dict[int, Dict[int, Dict[str, Any]]] = {}
+        outfits: Dict[int, Dict[str, Any]] = {}
+        errors: List[BaseException] = []
+        finished = 0
+        try:
+            while finished < outfits_count:
+                part, event = await queue.get()
+                if event[0] == "slot":
+                    _, _, slot_idx, slot = event
+                    position = positions.setdefault(part, len(positions))
+                    slots.setdefault(part, {})[slot_idx] = slot
+                    yield ("slot", position, slot_idx, slot)
+                    continue
+                finished += 1
+                if event[0] == "plan" and event[1] and event[1].get("outfits"):
+                    outfits[part] = event[1]["outfits"][0]
+                elif event[0] == "error":
+                    errors.append(event[1])
+        finally:
+            for task in parts:
+                task.cancel()
 
-Important:
-- Make search queries specific (include gender if needed)
-- Use must_not_have to exclude wrong items
-- Keep must_have to 2-3 keywords
-- Color palette: 2-4 colors"""
+        # Сначала образы с отданными слотами (в порядке их номеров), потом остальные
+        for part in sorted(outfits):
+            positions.setdefault(part, len(positions))
+        plan_outfits: List[Dict[str, Any]] = []
+        for part, _ in sorted(positions.items(), key=lambda entry: entry[1]):
+            outfit = outfits.get(part)
+            if outfit is None:
+                received = slots.get(part, {})
+                prefix = []
+                while len(prefix) in received:
+                    prefix.append(received[len(prefix)])
+                outfit = {
+                    "outfit_name": f"Look {len(plan_outfits) + 1}",
+                    "description": "",
+                    "slots": prefix,
+                }
+            plan_outfits.append(outfit)
 
-            else:
-                # Режим "образ с нуля"
-                prompt = f"""You are a professional fashion stylist AI. Create {outfits_count} complete outfit plans for {style} style.
+        logger.info(
+            f"✅ [GEMINI] Parallel outfit stream: {len(outfits)}/{outfits_count} complete outfits"
+        )
+        if plan_outfits:
+            yield ("plan", {"outfits": plan_outfits})
+            return
+        for error in errors:
+            if isinstance(error, GeminiOverloadedError):
+                raise error
+        yield ("plan", None)
 
-REQUIREMENTS:
-- Style: {style}
-- Gender: {gender}
-- Season: {season_str}
-- Budget: {budget_str}
+    async def _pump_stream(
+        self,
+        task: str,
+        source: int,
+        model_name: str,
+        key: GeminiKey,
+        instruction: str,
+        contents: Any,
+        generation_config: Dict[str, Any],
+        call: GeminiCall,
+        user_id: Optional[int],
+        priority: Priority,
+        chunks: asyncio.Queue,
+        hedge: bool = False,
+    ) -> None:
+        """
+        Стрим модели в очередь: (source, "started", None) при получении
+        слота, (source, "chunk", текст) по мере прихода, затем
+        (source, "done", None) или (source, "error", исключение). Слот
+        планировщика и in_flight ключа держит только эта задача и только
+        пока идёт стрим: потребитель очереди их не задерживает и в
+        латентность не попадает. Как и в _request, хедж не считается
+        попыткой call, а ошибки модели учитываются в пуле и маршрутизаторе.
+        """
+        try:
+            model = await self._get_model(model_name, instruction, key)
+            async with gemini_scheduler.slot(user_id, priority) as queue_wait:
+                chunks.put_nowait((source, "started", None))
+                started = time.monotonic()
+                first_chunk = True
+                gemini_key_pool.start(key)
+                try:
+                    with nullcontext() if hedge else call.attempt(queue_wait):
+                        response = await model.generate_content_async(
+                            contents, generation_config=generation_config, stream=True,
+                        )
+                        async for chunk in response:
+                            if first_chunk:
+                                first_chunk = False
+                                gemini_hedger.observe(task, model_name, time.monotonic() - started)
+                            chunks.put_nowait((source, "chunk", self._chunk_text(chunk)))
+                except Exception as e:
+                    if is_quota_error(e):
+                        gemini_key_pool.report_quota(key, model_name)
+                    else:
+                        gemini_key_pool.report_error(key)
+                        model_router.report_error(model_name, e)
+                    raise
+                finally:
+                    gemini_key_pool.finish(key)
+            model_router.report_success(model_name, time.monotonic() - started)
+            tokens_before = call.total_tokens
+            call.add_usage(response)
+            gemini_key_pool.add_tokens(key, call.total_tokens - tokens_before)
+            chunks.put_nowait((source, "done", None))
+        except Exception as e:
+            chunks.put_nowait((source, "error", e))
 
-For each outfit, define 4 slots based on season:
-- If winter/autumn: top, bottom, shoes, outerwear
-- If spring/summer: top, bottom, shoes, accessory
+    async def _hedged_stream(
+        self,
+        task: str,
+        model_name: str,
+        key: GeminiKey,
+        instruction: str,
+        contents: Any,
+        generation_config: Dict[str, Any],
+        call: GeminiCall,
+        user_id: Optional[int],
+        priority: Priority,
+        tried: List[str],
+        default_key_only: bool,
+    ) -> AsyncIterator[str]:
+        """
+        Текст стрима модели с хеджированием по первому куску: если за
+        gemini_hedger.delay после получения слота не пришло ни куска и
+        бюджет позволяет, тот же запрос уходит вторым стримом (куда — см.
+        _hedge_target). Читается стрим, первым отдавший кусок, второй
+        отменяется. Если оба упали до первого куска, пробрасывается ошибка
+        основного.
+        """
+        gemini_hedger.record_request()
+        chunks: asyncio.Queue = asyncio.Queue()
+        targets: Dict[int, Tuple[str, GeminiKey]] = {0: (model_name, key)}
+        pumps: Dict[int, asyncio.Task] = {
+            0: asyncio.create_task(self._pump_stream(
+                task, 0, model_name, key, instruction, contents, generation_config,
+                call, user_id, priority, chunks,
+            ))
+        }
+        errors: Dict[int, Exception] = {}
+        delay = gemini_hedger.delay(task, model_name)
+        hedge_at: Optional[float] = None
+        winner: Optional[int] = None
+        try:
+            while True:
+                timeout = None if hedge_at is None else max(hedge_at - time.monotonic(), 0.0)
+                try:
+                    source, kind, value = await asyncio.wait_for(chunks.get(), timeout)
+                except asyncio.TimeoutError:
+                    hedge_at = None
+                    if gemini_hedger.try_acquire():
+                        hedge_model, hedge_key = self._hedge_target(
+                            task, model_name, key, tried, default_key_only
+                        )
+                        logger.info(
+                            f"[GEMINI] No stream chunk from {model_name} in {delay:.1f}s, "
+                            f"hedging to {hedge_model} on {hedge_key.label}"
+                        )
+                        call.hedges += 1
+                        targets[1] = (hedge_model, hedge_key)
+                        pumps[1] = asyncio.create_task(self._pump_stream(
+                            task, 1, hedge_model, hedge_key, instruction, contents,
+                            generation_config, call, user_id, priority, chunks, hedge=True,
+                        ))
+                    continue
 
-Return ONLY valid JSON (no markdown) in this structure:
-{{
-  "outfits": [
-    {{
-      "outfit_name": "Outfit name (2-4 words)",
-      "description": "Brief concept (1-2 sentences)",
-      "slots": [
-        {{
-          "slot_type": "top/bottom/shoes/outerwear/accessory",
-          "description": "What this slot should be",
-          "search_query": "exact marketplace search query with gender",
-          "must_have": ["keyword1", "keyword2"],
-          "must_not_have": ["hoodie", "graphic"],
-          "color_palette": ["color1", "color2"]
-        }}
-      ]
-    }}
-  ]
-}}
+                if winner is not None and source != winner:
+                    continue
+                if kind == "started":
+                    if source == 0 and delay is not None:
+                        hedge_at = time.monotonic() + delay
+                    continue
+                if kind == "error":
+                    if winner is not None:
+                        raise value
+                    errors[source] = value
+                    if len(errors) < len(pumps):
+                        # Второй стрим ещё может ответить
+                        continue
+                    raise errors.get(0, value)
 
-Important:
-- Make search queries specific (include gender if needed)
-- Use must_not_have to exclude wrong items
-- Keep must_have to 2-3 keywords
-- Make outfits cohesive with {style}"""
+                if winner is None:
+                    winner = source
+                    hedge_at = None
+                    for other, pump in pumps.items():
+                        if other != source:
+                            pump.cancel()
+                    if source != 0:
+                        gemini_hedger.record_win()
+                        call.model = targets[source][0]
+                        logger.info(f"[GEMINI] Hedged stream to {targets[source][0]} won")
+                if kind == "done":
+                    return
+                yield value
+        finally:
+            for pump in pumps.values():
+                pump.cancel()
 
-            for attempt in range(retries):
-                try:
-                    logger.info(f"🎨 [GEMINI] Generating outfit plan (attempt {attempt+1}/{retries})")
-                    logger.info(f"   Style: {style}, Gender: {gender}, Season: {season_str}")
-                    
-                    response = await self.model.generate_content_async(
-                        prompt,
-                        generation_config={
-                            "response_mime_type": "application/json",
-                            "max_output_tokens": 2048,
-                            "temperature": 0.8,
-                        },
+    async def _stream_outfit_plan(
+        self,
+        style: str,
+        gender: str,
+        season: Optional[str],
+        outfits_count: int,
+        base_item_analysis: Optional[Dict[str, Any]],
+        budget: Optional[str],
+        retries: int,
+        user_id: Optional[int],
+        priority: Priority,
+        call: GeminiCall,
+        base_image_path: Optional[str] = None,
+        concept_hint: Optional[str] = None,
+    ) -> AsyncIterator[Tuple[Any, ...]]:
+        if not self.model:
+            logger.error("Gemini model not available")
+            yield ("plan", None)
+            return
+
+        patterns: List[List[Any]] = [["outfits", ANY_INDEX, "slots", ANY_INDEX]]
+        if base_image_path:
+            prompt = OUTFIT_FROM_IMAGE_PROMPT.format(
+                outfits_count=outfits_count,
+                style=style or "match the base item",
+                gender=gender or "match the base item's target audience",
+                season_str=season or "match the base item's season",
+                budget_str=budget or "mid-range",
+            )
+            instruction, schema, max_tokens = "analysis_outfit_plan", ANALYSIS_WITH_PLAN_SCHEMA, 3072
+            prepared = await image_service.prepare_for_gemini(base_image_path)
+            patterns.append(["analysis"])
+        else:
+            prompt = self._build_outfit_prompt(
+                style=style,
+                gender=gender,
+                season=season,
+                outfits_count=outfits_count,
+                base_item_analysis=base_item_analysis,
+                budget=budget,
+                concept_hint=concept_hint,
+            )
+            instruction, schema = "outfit_plan", OUTFIT_PLAN_SCHEMA
+            max_tokens = self._plan_max_tokens(outfits_count)
+
+        attempt = 0
+        tried: List[str] = []
+        while attempt < retries:
+            contents: Any = prompt
+            if base_image_path:
+                contents = [prompt, await self._image_part(base_image_path, prepared)]
+            default_key_only = self._references_uploaded_files(contents)
+            model_name, key = self._pick_model("outfit_plan", call, tried, default_key_only)
+            parser = IncrementalJSONParser(patterns)
+            emitted = 0
+            analysis_emitted = False
+            try:
+                logger.info(
+                    f"🎨 [GEMINI] Streaming outfit plan (attempt {attempt + 1}/{retries}, model={model_name})"
+                )
+
+                stream = self._hedged_stream(
+                    "outfit_plan", model_name, key, instruction, contents,
+                    {
+                        "response_mime_type": "application/json",
+                        "response_schema": schema,
+                        "max_output_tokens": max_tokens,
+                        "temperature": 0.8,
+                    },
+                    call, user_id, priority, tried, default_key_only,
+                )
+                async with aclosing(stream):
+                    async for text in stream:
+                        for path, slot in parser.feed(text):
+                            if path[0] == "analysis":
+                                analysis = self._parse_fused_analysis(slot)
+                                if analysis and not analysis_emitted:
+                                    analysis_emitted = True
+                                    emitted += 1
+                                    yield ("analysis", analysis)
+                                continue
+                            try:
+                                slot = OUTFIT_SLOT_ADAPTER.validate_python(slot).model_dump()
+                            except ValidationError:
+                                continue
+                            emitted += 1
+                            yield ("slot", path[1], path[3], slot)
+
+                if base_image_path and not analysis_emitted:
+                    # Модель написала анализ после образов — берём из полного текста
+                    payload = parse_model_json_loose(parser.text)
+                    analysis = self._parse_fused_analysis(
+                        payload.get("analysis") if isinstance(payload, dict) else None
                     )
-                    
-                    raw_text = (response.text or "").strip()
-                    json_str = self._extract_json_from_text(raw_text)
-                    
-                    if not json_str:
-                        logger.warning("[GEMINI] No JSON in outfit response")
-                        if attempt < retries - 1:
-                            time.sleep(1)
-                            continue
-                        return None
-                    
-                    outfit_plan = json.loads(json_str)
-                    
-                    if "outfits" not in outfit_plan:
-                        logger.error("[GEMINI] Missing 'outfits' field in response")
-                        if attempt < retries - 1:
-                            time.sleep(1)
-                            continue
-                        return None
-                    
-                    logger.info(f"✅ [GEMINI] Generated {len(outfit_plan['outfits'])} outfits")
-                    return outfit_plan
-                    
-                except json.JSONDecodeError as e:
-                    logger.error(f"[GEMINI] Outfit JSON parse error: {e}")
-                    if attempt < retries - 1:
-                        time.sleep(1)
-                        continue
-                    return None
-                    
-                except Exception as e:
-                    logger.error(f"[GEMINI] Outfit generation error: {e}")
-                    if "429" in str(e) or "quota" in str(e).lower():
-                        return None
-                    if attempt < retries - 1:
-                        time.sleep(1)
+                    if analysis:
+                        analysis_emitted = True
+                        emitted += 1
+                        yield ("analysis", analysis)
+
+                # Обрезанный ответ достраивается: целые слоты не теряются,
+                # недописанные отбрасываются. Ключ "analysis" совмещённого
+                # ответа схема плана игнорирует
+                parsed = parse_outfit_plan(parser.text)
+                outfit_plan = parsed.model_dump() if parsed is not None and parsed.outfits else None
+
+                if not outfit_plan:
+                    logger.warning("[GEMINI] Streamed outfit plan is invalid")
+                    attempt += 1
+                    if emitted == 0 and attempt < retries:
+                        await asyncio.sleep(1)
                         continue
-                    return None
-            
-            return None
-            
-        except Exception as e:
-            logger.error(f"[GEMINI] Fatal outfit generation error: {e}", exc_info=True)
-            return None
+                    yield ("plan", None)
+                    return
+
+                logger.info(
+                    f"✅ [GEMINI] Streamed {len(outfit_plan['outfits'])} outfits "
+                    f"({emitted} slots emitted early)"
+                )
+                yield ("plan", outfit_plan)
+                return
+
+            except GeminiOverloadedError:
+                raise
+
+            except Exception as e:
+                logger.error(f"[GEMINI] Outfit stream error ({model_name}, {key.label}): {e}")
+                if is_quota_error(e) and emitted == 0:
+                    # Попытку не тратим — другой ключ или следующая модель маршрута
+                    continue
+                attempt += 1
+                if emitted == 0 and attempt < retries:
+                    await asyncio.sleep(1)
+                    continue
+                yield ("plan", None)
+                return
+
+        yield ("plan", None)
 
 
 # Singleton
@@ -0,0 +1,268 @@
+# app/services/image_service.py
+
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional, List, Sequence, Tuple
+
+from PIL import Image, ImageOps
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# dHash 8x8 -> 64 бита
+PHASH_SIZE = 8
+# Цветовая подпись: средний цвет ячеек сетки 3x3
+COLOR_GRID = 3
+
+
+def bytes_sha256(data: bytes) -> str:
+    """SHA-256 от байтов изображения (hex)."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_sha256(path: str) -> str:
+    """SHA-256 содержимого файла. Синхронная — вызывать из пула потоков."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def compute_dhash(path: str, hash_size: int = PHASH_SIZE) -> int:
+    """
+    Difference hash: устойчив к пересжатию, ресайзу и небольшим сдвигам.
+    Синхронная — вызывать из пула потоков.
+    """
+    with Image.open(path) as img:
+        # Для JPEG декодируем сразу в уменьшенном виде — на 12 Мп фото это в разы быстрее
+        img.draft("L", (hash_size * 8, hash_size * 8))
+        img = ImageOps.exif_transpose(img)
+        small = img.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+        pixels = list(small.getdata())
+
+    bits = 0
+    width = hash_size + 1
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * width + col]
+            right = pixels[row * width + col + 1]
+            bits = (bits << 1) | (1 if left > right else 0)
+    return bits
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def compute_color_signature(path: str, grid: int = COLOR_GRID) -> str:
+    """
+    Средний RGB ячеек сетки grid x grid в hex (rrggbb на ячейку). dHash
+    строится по яркости и не отличает тот же фасон в другом цвете.
+    Синхронная — вызывать из пула потоков.
+    """
+    with Image.open(path) as img:
+        img.draft("RGB", (grid * 8, grid * 8))
+        img = ImageOps.exif_transpose(img)
+        small = img.convert("RGB").resize((grid, grid), Image.Resampling.BOX)
+        return small.tobytes().hex()
+
+
+def color_difference(a: str, b: str) -> int:
+    """Наибольшая разница одного канала (0–255) между одноимёнными ячейками подписей."""
+    first, second = bytes.fromhex(a), bytes.fromhex(b)
+    if len(first) != len(second):
+        return 255
+    return max((abs(x - y) for x, y in zip(first, second)), default=0)
+
+
+@dataclass
+class PreparedImage:
+    """Изображение, подготовленное для отправки в Gemini."""
+    data: bytes
+    mime_type: str
+    width: int
+    height: int
+    original_bytes: int
+
+
+def prepare_image(path: str, max_edge: int, image_format: str, quality: int) -> PreparedImage:
+    """
+    EXIF-ориентация -> даунскейл до max_edge -> компактный JPEG/WebP.
+    Синхронная — вызывать из пула потоков.
+    """
+    image_format = image_format.upper()
+    with open(path, "rb") as f:
+        original = f.read()
+
+    with Image.open(io.BytesIO(original)) as img:
+        # JPEG декодер умеет сразу отдавать уменьшенную картинку (1/2, 1/4, 1/8)
+        img.draft("RGB", (max_edge, max_edge))
+        img = ImageOps.exif_transpose(img)
+
+        if img.mode in ("RGBA", "LA", "P"):
+            rgba = img.convert("RGBA")
+            if image_format == "WEBP":
+                img = rgba
+            else:
+                background = Image.new("RGB", rgba.size, "white")
+                background.paste(rgba, mask=rgba.split()[-1])
+                img = background
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+
+        img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+
+        buffer = io.BytesIO()
+        if image_format == "WEBP":
+            img.save(buffer, "WEBP", quality=quality, method=4)
+            mime_type = "image/webp"
+        else:
+            img.save(buffer, "JPEG", quality=quality, optimize=True)
+            mime_type = "image/jpeg"
+
+        return PreparedImage(
+            data=buffer.getvalue(),
+            mime_type=mime_type,
+            width=img.width,
+            height=img.height,
+            original_bytes=len(original),
+        )
+
+
+def crop_boxes(
+    path: str,
+    boxes: Sequence[Optional[Sequence[int]]],
+    output_dir: str,
+    padding: float,
+    quality: int,
+) -> List[Optional[str]]:
+    """
+    Вырезает области [ymin, xmin, ymax, xmax] (0-1000, как их отдаёт Gemini)
+    в отдельные JPEG. Координаты — после EXIF-поворота: модель видит фото
+    уже повёрнутым. Для негодной рамки в результате None.
+    Синхронная — вызывать из пула потоков.
+    """
+    paths: List[Optional[str]] = []
+    with Image.open(path) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        width, height = img.size
+
+        for box in boxes:
+            if not box or len(box) != 4:
+                paths.append(None)
+                continue
+            ymin, xmin, ymax, xmax = (min(max(int(v), 0), 1000) for v in box)
+            if ymax <= ymin or xmax <= xmin:
+                paths.append(None)
+                continue
+
+            pad_y = (ymax - ymin) * padding
+            pad_x = (xmax - xmin) * padding
+            left = int(max(xmin - pad_x, 0) * width / 1000)
+            top = int(max(ymin - pad_y, 0) * height / 1000)
+            right = int(min(xmax + pad_x, 1000) * width / 1000)
+            bottom = int(min(ymax + pad_y, 1000) * height / 1000)
+            if right - left < 2 or bottom - top < 2:
+                paths.append(None)
+                continue
+
+            crop_path = os.path.join(output_dir, f"{uuid.uuid4()}.jpg")
+            img.crop((left, top, right, bottom)).save(crop_path, "JPEG", quality=quality, optimize=True)
+            paths.append(crop_path)
+    return paths
+
+
+class ImageService:
+    """CPU-задачи над изображениями (Pillow) в отдельном пуле потоков."""
+
+    def __init__(self) -> None:
+        self._executor = ThreadPoolExecutor(
+            max_workers=settings.IMAGE_WORKERS,
+            thread_name_prefix="image-worker",
+        )
+
+    async def perceptual_hash(self, path: str) -> Optional[str]:
+        """dHash изображения в виде 16-символьного hex или None, если файл не картинка."""
+        loop = asyncio.get_running_loop()
+        try:
+            value = await loop.run_in_executor(self._executor, compute_dhash, path)
+        except Exception as e:
+            logger.warning(f"[IMAGE] Failed to compute perceptual hash for {path}: {e}")
+            return None
+        return f"{value:016x}"
+
+    async def color_signature(self, path: str) -> Optional[str]:
+        """Цветовая подпись изображения (см. compute_color_signature) или None."""
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._executor, compute_color_signature, path)
+        except Exception as e:
+            logger.warning(f"[IMAGE] Failed to compute color signature for {path}: {e}")
+            return None
+
+    async def fingerprint(self, path: str) -> Tuple[Optional[str], Optional[str]]:
+        """(перцептивный хэш, цветовая подпись) — по ним ищутся почти такие же фото."""
+        image_phash, image_colors = await asyncio.gather(
+            self.perceptual_hash(path), self.color_signature(path)
+        )
+        return image_phash, image_colors
+
+    async def prepare_for_gemini(self, path: str) -> Optional[PreparedImage]:
+        """Уменьшенная и пережатая копия изображения или None, если Pillow не смог его открыть."""
+        loop = asyncio.get_running_loop()
+        try:
+            prepared = await loop.run_in_executor(
+                self._executor,
+                prepare_image,
+                path,
+                settings.GEMINI_IMAGE_MAX_EDGE,
+                settings.GEMINI_IMAGE_FORMAT,
+                settings.GEMINI_IMAGE_QUALITY,
+            )
+        except Exception as e:
+            logger.warning(f"[IMAGE] Preprocessing failed for {path}: {e}")
+            return None
+
+        logger.info(
+            f"[IMAGE] Prepared {path}: {prepared.original_bytes // 1024} KB -> "
+            f"{len(prepared.data) // 1024} KB ({prepared.width}x{prepared.height})"
+        )
+        return prepared
+
+    async def crop_regions(
+        self,
+        path: str,
+        boxes: Sequence[Optional[Sequence[int]]],
+        output_dir: str,
+    ) -> List[Optional[str]]:
+        """Вырезанные по рамкам Gemini файлы (None — рамка негодная или фото не открылось)."""
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(
+                self._executor,
+                crop_boxes,
+                path,
+                boxes,
+                output_dir,
+                settings.OUTFIT_DETECTION_CROP_PADDING,
+                settings.GEMINI_IMAGE_QUALITY,
+            )
+        except Exception as e:
+            logger.warning(f"[IMAGE] Cropping failed for {path}: {e}")
+            return [None] * len(boxes)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False)
+
+
+image_service = ImageService()
@@ -0,0 +1,571 @@
+# app/services/item_analysis_service.py
+
+import asyncio
+import logging
+import os
+from dataclasses import dataclass
+from typing import Optional, Dict, Any, List, Set, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.db.session import async_session
+from app.models.ai_analysis import AIAnalysis
+from app.models.clothing import ClothingItem
+from app.services.analysis_cache_service import analysis_cache_service
+from app.services.gemini_metrics import GeminiCall
+from app.services.gemini_scheduler import GeminiOverloadedError, Priority
+from app.services.gemini_service import gemini_service
+from app.services.image_service import color_difference, file_sha256, image_service
+from app.services.phash_index import phash_index
+
+logger = logging.getLogger(__name__)
+
+# Значения ClothingItem.analysis_status
+ANALYSIS_PENDING = "pending"
+ANALYSIS_PROCESSING = "processing"
+ANALYSIS_DONE = "done"
+ANALYSIS_FAILED = "failed"
+
+
+class ItemAnalysisError(Exception):
+    """Анализ вещи невозможен; status_code — подходящий HTTP-код для API."""
+
+    def __init__(self, message: str, status_code: int = 500) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def is_usable_analysis(analysis_data: Any) -> bool:
+    """
+    Анализ годится для поиска и образов, даже если он старой версии:
+    есть внятная категория и теги или поисковый запрос.
+    """
+    if not isinstance(analysis_data, dict):
+        return False
+    category = (analysis_data.get("category") or "").strip().lower()
+    if category in ("", "unknown", "none"):
+        return False
+    return bool(analysis_data.get("tags") or analysis_data.get("search_query"))
+
+
+def gemini_call_fields(
+    call: Optional[GeminiCall] = None,
+    source: str = "cached",
+    model_used: Optional[str] = None,
+    analysis_version: Optional[str] = None,
+) -> dict:
+    """
+    Поля учёта Gemini и версия анализа для AIAnalysis.
+
+    Если анализ получен без собственного вызова (кэш, похожее фото,
+    ожидание такого же запроса) — пишем только модель и источник.
+    """
+    if analysis_version is None and gemini_service:
+        analysis_version = gemini_service.analysis_version
+    if call is not None and call.attempts:
+        return {
+            "analysis_version": analysis_version,
+            "model_used": call.model,
+            "prompt_tokens": call.prompt_tokens,
+            "response_tokens": call.response_tokens,
+            "latency_ms": int(call.latency_ms),
+            "gemini_retries": call.retries,
+            "gemini_outcome": call.outcome,
+        }
+    return {
+        "analysis_version": analysis_version,
+        "model_used": model_used or (gemini_service.model_name if gemini_service else None),
+        "gemini_outcome": source,
+    }
+
+
+def reused_call_fields(analysis: AIAnalysis) -> dict:
+    """Поля для анализа, скопированного с почти такого же фото (с его версией)."""
+    return gemini_call_fields(
+        source="reused",
+        model_used=analysis.model_used,
+        analysis_version=analysis.analysis_version,
+    )
+
+
+async def find_near_duplicate_analysis(
+    db: AsyncSession,
+    user_id: int,
+    image_phash: str,
+    image_colors: Optional[str],
+    analysis_version: Optional[str] = None,
+) -> Optional[Tuple[AIAnalysis, int]]:
+    """
+    Ищет годный анализ почти такого же фото у пользователя: (analysis, distance).
+    Близкий хэш не отличает тот же фасон в другом цвете, поэтому цветовые
+    подписи тоже должны совпасть (анализы без подписи не переиспользуются).
+    С analysis_version подходят только анализы этой версии.
+    """
+    if not image_colors:
+        return None
+    candidates = await phash_index.find_nearest(db, user_id, image_phash)
+    for distance, analysis_id in candidates:
+        result = await db.execute(
+            select(AIAnalysis).where(
+                AIAnalysis.id == analysis_id,
+                AIAnalysis.user_id == user_id,
+            )
+        )
+        analysis = result.scalar_one_or_none()
+        if analysis is None or not is_usable_analysis(analysis.analysis_data):
+            continue
+        if (
+            not analysis.image_colors
+            or color_difference(image_colors, analysis.image_colors) > settings.PHASH_MAX_COLOR_DIFFERENCE
+        ):
+            continue
+        if analysis_version is None or analysis.analysis_version == analysis_version:
+            logger.info(f"Near-duplicate of analysis {analysis_id} (distance={distance})")
+            return analysis, distance
+    return None
+
+
+def outdated_item_filter(analysis_version: str, include_unanalyzed: bool = False) -> List[Any]:
+    """
+    Условия WHERE для ClothingItem без анализа версии analysis_version.
+    Без include_unanalyzed — только вещи, у которых вообще есть анализы.
+    """
+    has_analysis = select(AIAnalysis.id).where(AIAnalysis.clothing_item_id == ClothingItem.id)
+    has_current = has_analysis.where(AIAnalysis.analysis_version == analysis_version)
+    if include_unanalyzed:
+        return [~has_current.exists()]
+    return [has_analysis.exists(), ~has_current.exists()]
+
+
+async def latest_item_analysis(db: AsyncSession, item_id: int) -> Optional[AIAnalysis]:
+    """Последний анализ вещи."""
+    result = await db.execute(
+        select(AIAnalysis)
+        .where(AIAnalysis.clothing_item_id == item_id)
+        .order_by(AIAnalysis.created_at.desc(), AIAnalysis.id.desc())
+        .limit(1)
+    )
+    return result.scalar_one_or_none()
+
+
+async def analyze_item(
+    db: AsyncSession,
+    item: ClothingItem,
+    user_id: int,
+    priority: Priority = Priority.INTERACTIVE,
+    task: str = "analysis",
+    current_only: bool = False,
+) -> Dict[str, Any]:
+    """
+    Анализирует вещь (похожее фото -> кэш -> Gemini), сохраняет AIAnalysis,
+    обновляет поля вещи и коммитит.
+
+    current_only — переиспользовать анализ похожего фото, только если он
+    текущей версии (фоновый переанализ устаревших).
+
+    Raises:
+        ItemAnalysisError: нет картинки / Gemini недоступен / анализ не удался
+        GeminiOverloadedError: очередь Gemini перегружена
+    """
+    if not item.image_url or not os.path.exists(item.image_url):
+        raise ItemAnalysisError("Item image not found", status_code=400)
+
+    logger.info(f"Auto-analyzing item {item.id} ({priority.name.lower()}, task={task})")
+    image_phash, image_colors = await image_service.fingerprint(item.image_url)
+    near_duplicate = None
+    if image_phash:
+        near_duplicate = await find_near_duplicate_analysis(
+            db, user_id, image_phash, image_colors,
+            analysis_version=gemini_service.analysis_version if current_only and gemini_service else None,
+        )
+
+    if near_duplicate:
+        analysis_data = near_duplicate[0].analysis_data
+        call_fields = reused_call_fields(near_duplicate[0])
+    else:
+        if not gemini_service or not gemini_service.model:
+            raise ItemAnalysisError("Gemini AI service not available", status_code=503)
+
+        call = GeminiCall()
+        analysis_data, cache_hit = await analysis_cache_service.get_or_analyze(
+            item.image_url, user_id=user_id, priority=priority, call_info=call, task=task
+        )
+        call_fields = gemini_call_fields(call, source="cached" if cache_hit else "shared")
+        if not analysis_data:
+            raise ItemAnalysisError("Failed to analyze image")
+
+    await save_item_analysis(db, item, user_id, analysis_data, call_fields, image_phash, image_colors)
+    return analysis_data
+
+
+async def find_ready_item_analysis(
+    db: AsyncSession,
+    item: ClothingItem,
+    user_id: int,
+) -> Tuple[Optional[Dict[str, Any]], Optional[dict], Optional[str], Optional[str], str]:
+    """
+    Анализ вещи без вызова Gemini: почти такое же фото пользователя или
+    кэш по хэшу содержимого. Returns (analysis_data, call_fields, phash,
+    colors, content_hash); analysis_data None — придётся звать Gemini.
+    """
+    image_phash, image_colors = await image_service.fingerprint(item.image_url)
+    content_hash = await asyncio.to_thread(file_sha256, item.image_url)
+
+    if image_phash:
+        near_duplicate = await find_near_duplicate_analysis(db, user_id, image_phash, image_colors)
+        if near_duplicate:
+            return (
+                near_duplicate[0].analysis_data,
+                reused_call_fields(near_duplicate[0]),
+                image_phash,
+                image_colors,
+                content_hash,
+            )
+
+    if gemini_service:
+        cached = await analysis_cache_service.get(content_hash, gemini_service.analysis_version)
+        if cached:
+            return cached, gemini_call_fields(source="cached"), image_phash, image_colors, content_hash
+
+    return None, None, image_phash, image_colors, content_hash
+
+
+async def save_item_analysis(
+    db: AsyncSession,
+    item: ClothingItem,
+    user_id: int,
+    analysis_data: Dict[str, Any],
+    call_fields: dict,
+    image_phash: Optional[str],
+    image_colors: Optional[str],
+) -> AIAnalysis:
+    """Сохраняет AIAnalysis вещи, обновляет её поля по анализу и коммитит."""
+    ai_analysis = AIAnalysis(
+        user_id=user_id,
+        clothing_item_id=item.id,
+        prompt=f"Auto-analyze: {item.image_url}",
+        response=str(analysis_data),
+        analysis_data=analysis_data,
+        image_phash=image_phash,
+        image_colors=image_colors,
+        **call_fields,
+    )
+    db.add(ai_analysis)
+
+    item.category = analysis_data.get("category") or item.category
+    item.color = ", ".join(analysis_data.get("colors", [])) or item.color
+    item.brand = analysis_data.get("brand") or item.brand
+    item.description = analysis_data.get("description") or item.description
+    item.analysis_status = ANALYSIS_DONE
+
+    await db.commit()
+    await db.refresh(item)
+    if image_phash:
+        phash_index.add(user_id, image_phash, ai_analysis.id)
+    return ai_analysis
+
+
+@dataclass
+class _Job:
+    item_id: int
+    user_id: int
+    future: asyncio.Future
+    # Переанализ устаревшего анализа (а не первый анализ после загрузки)
+    reanalysis: bool = False
+    # Воркер начал анализ или задачу забрал интерактивный запрос
+    started: bool = False
+    # Сколько раз задача уже откладывалась из-за перегрузки Gemini
+    overload_retries: int = 0
+
+
+class ItemAnalysisService:
+    """
+    Фоновый анализ вещей сразу после загрузки в гардероб.
+
+    /wardrobe/upload ставит задачу в очередь; воркеры анализируют вещи с
+    фоновым приоритетом Gemini. AI-эндпоинты, которым нужен анализ:
+    - ждут уже идущую задачу вместо повторного анализа;
+    - ещё не начатую задачу забирают себе и выполняют с интерактивным
+      приоритетом (воркер её пропустит).
+    Сюда же ставятся вещи, чей анализ устарел (другая analysis_version):
+    их переанализ идёт только в фоне, запросы пользуются старым анализом.
+
+    Очередь живёт в памяти, поэтому при старте в неё заново ставятся вещи,
+    оставшиеся в pending/processing. Если Gemini перегружен, задача не
+    падает, а возвращается в очередь через overload_retry_seconds (с
+    ростом паузы, не больше overload_max_retries раз).
+    """
+
+    def __init__(self, workers: int, overload_retry_seconds: float = 30.0, overload_max_retries: int = 5) -> None:
+        self.workers = max(workers, 1)
+        self.overload_retry_seconds = overload_retry_seconds
+        self.overload_max_retries = overload_max_retries
+        self._queue: Optional[asyncio.Queue] = None
+        self._jobs: Dict[int, _Job] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._retries: Set[asyncio.TimerHandle] = set()
+        self.completed = 0
+        self.failed = 0
+        self.claimed = 0
+        self.requeued = 0
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue()
+        self._tasks = [
+            asyncio.create_task(self._worker(i), name=f"item-analysis-{i}")
+            for i in range(self.workers)
+        ]
+        self._tasks.append(asyncio.create_task(self._requeue_unfinished(), name="item-analysis-requeue"))
+        logger.info(f"[ITEM ANALYSIS] Started {self.workers} workers")
+
+    async def _requeue_unfinished(self) -> None:
+        """Ставит в очередь вещи, чей анализ не закончился до перезапуска."""
+        has_analysis = select(AIAnalysis.id).where(AIAnalysis.clothing_item_id == ClothingItem.id).exists()
+        try:
+            async with async_session() as db:
+                result = await db.execute(
+                    select(ClothingItem.id, ClothingItem.user_id, has_analysis)
+                    .where(ClothingItem.analysis_status.in_([ANALYSIS_PENDING, ANALYSIS_PROCESSING]))
+                    .order_by(ClothingItem.id)
+                )
+                rows = result.all()
+        except Exception as e:
+            logger.error(f"[ITEM ANALYSIS] Failed to load unfinished items: {e}")
+            return
+        queued = sum(
+            1 for item_id, user_id, analyzed in rows
+            if self.enqueue(item_id, user_id, reanalysis=bool(analyzed))
+        )
+        if queued:
+            logger.info(f"[ITEM ANALYSIS] Re-queued {queued} unfinished items")
+
+    async def shutdown(self) -> None:
+        for handle in self._retries:
+            handle.cancel()
+        self._retries.clear()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+        for job in self._jobs.values():
+            if not job.future.done():
+                job.future.set_result(None)
+        self._jobs.clear()
+
+    def enqueue(self, item_id: int, user_id: int, reanalysis: bool = False, overload_retries: int = 0) -> bool:
+        """Ставит анализ вещи в очередь (повторная постановка игнорируется)."""
+        if item_id in self._jobs:
+            return False
+        self.start()
+        job = _Job(
+            item_id, user_id, asyncio.get_running_loop().create_future(), reanalysis,
+            overload_retries=overload_retries,
+        )
+        self._jobs[item_id] = job
+        self._queue.put_nowait(job)
+        return True
+
+    def _retry_later(self, job: _Job, retry_after: float) -> None:
+        """Возвращает задачу в очередь после паузы (Gemini перегружен)."""
+        retries = job.overload_retries + 1
+        delay = max(retry_after, self.overload_retry_seconds * retries)
+        handle: Optional[asyncio.TimerHandle] = None
+
+        def requeue() -> None:
+            self._retries.discard(handle)
+            if self._queue is not None:
+                self.enqueue(job.item_id, job.user_id, job.reanalysis, overload_retries=retries)
+
+        handle = asyncio.get_running_loop().call_later(delay, requeue)
+        self._retries.add(handle)
+        self.requeued += 1
+        logger.info(f"[ITEM ANALYSIS] Gemini overloaded, item {job.item_id} re-queued in {delay:.0f}s")
+
+    async def enqueue_outdated(
+        self,
+        db: AsyncSession,
+        user_id: Optional[int] = None,
+        limit: Optional[int] = None,
+    ) -> int:
+        """
+        Ставит на фоновый переанализ вещи, у которых есть анализы, но ни
+        одного текущей версии. Возвращает число поставленных в очередь.
+        """
+        if not gemini_service or not gemini_service.model:
+            return 0
+
+        version = gemini_service.analysis_version
+        query = (
+            select(ClothingItem)
+            .where(*outdated_item_filter(version))
+            .order_by(ClothingItem.id)
+        )
+        if user_id is not None:
+            query = query.where(ClothingItem.user_id == user_id)
+        if limit:
+            query = query.limit(limit)
+
+        items = (await db.execute(query)).scalars().all()
+        queued = [item for item in items if self.enqueue(item.id, item.user_id, reanalysis=True)]
+        for item in queued:
+            item.analysis_status = ANALYSIS_PENDING
+        await db.commit()
+        logger.info(f"[ITEM ANALYSIS] Queued {len(queued)} outdated items for re-analysis ({version})")
+        return len(queued)
+
+    def is_running(self, item_id: int) -> bool:
+        """Анализ вещи уже выполняется (воркером или другим запросом)."""
+        job = self._jobs.get(item_id)
+        return job is not None and job.started
+
+    def claim(self, item_id: int) -> Optional[_Job]:
+        """
+        Забирает ещё не начатую задачу вещи: запрос проанализирует вещь сам
+        (например, совмещённым вызовом с планом образов) и отдаст результат
+        через release. None — задачи в очереди нет.
+        """
+        job = self._jobs.get(item_id)
+        if job is None or job.started:
+            return None
+        job.started = True
+        self.claimed += 1
+        return job
+
+    def release(self, job: Optional[_Job], analysis_data: Optional[Dict[str, Any]]) -> None:
+        """Завершает забранную через claim задачу (ждущие получат analysis_data)."""
+        if job is not None:
+            self._finish(job, analysis_data)
+
+    def _finish(self, job: _Job, analysis_data: Optional[Dict[str, Any]]) -> None:
+        if self._jobs.get(job.item_id) is job:
+            del self._jobs[job.item_id]
+        if not job.future.done():
+            job.future.set_result(analysis_data)
+
+    async def _worker(self, index: int) -> None:
+        while True:
+            job = await self._queue.get()
+            try:
+                if job.started:
+                    # Забрана интерактивным запросом
+                    continue
+                job.started = True
+                self._finish(job, await self._run(job))
+            except asyncio.CancelledError:
+                self._finish(job, None)
+                raise
+            except Exception as e:
+                logger.error(f"[ITEM ANALYSIS] Worker {index} failed on item {job.item_id}: {e}")
+                self._finish(job, None)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: _Job) -> Optional[Dict[str, Any]]:
+        async with async_session() as db:
+            result = await db.execute(select(ClothingItem).where(ClothingItem.id == job.item_id))
+            item = result.scalar_one_or_none()
+            if item is None:
+                return None
+
+            existing = await latest_item_analysis(db, item.id)
+            # Без Gemini переанализировать нечем — оставляем имеющийся анализ
+            current_version = gemini_service.analysis_version if gemini_service else None
+            if existing and is_usable_analysis(existing.analysis_data) and (
+                not job.reanalysis or current_version is None
+                or existing.analysis_version == current_version
+            ):
+                item.analysis_status = ANALYSIS_DONE
+                await db.commit()
+                return existing.analysis_data
+
+            item.analysis_status = ANALYSIS_PROCESSING
+            await db.commit()
+            try:
+                analysis_data = await analyze_item(
+                    db, item, job.user_id, Priority.BACKGROUND,
+                    task="reanalysis" if job.reanalysis else "analysis",
+                    current_only=job.reanalysis,
+                )
+            except GeminiOverloadedError as e:
+                await db.rollback()
+                if job.overload_retries < self.overload_max_retries:
+                    # Ждущие запросы получат None и проанализируют вещь сами;
+                    # фоновая задача вернётся в очередь после паузы
+                    item.analysis_status = ANALYSIS_PENDING
+                    await db.commit()
+                    self._retry_later(job, e.retry_after)
+                    return None
+                item.analysis_status = ANALYSIS_FAILED
+                await db.commit()
+                self.failed += 1
+                logger.warning(f"[ITEM ANALYSIS] Item {job.item_id} analysis failed: Gemini overloaded")
+                return None
+            except Exception as e:
+                await db.rollback()
+                item.analysis_status = ANALYSIS_FAILED
+                await db.commit()
+                self.failed += 1
+                logger.warning(f"[ITEM ANALYSIS] Item {job.item_id} analysis failed: {e}")
+                return None
+
+            self.completed += 1
+            logger.info(f"[ITEM ANALYSIS] Item {job.item_id} analyzed in background")
+            return analysis_data
+
+    async def analyze_now(
+        self,
+        db: AsyncSession,
+        item: ClothingItem,
+        user_id: int,
+    ) -> Dict[str, Any]:
+        """
+        Анализ для интерактивного запроса без дублирования фоновой задачи.
+
+        Raises:
+            ItemAnalysisError / GeminiOverloadedError — как analyze_item
+        """
+        job = self._jobs.get(item.id)
+        if job is not None and job.started:
+            logger.info(f"[ITEM ANALYSIS] Awaiting background analysis of item {item.id}")
+            analysis_data = await asyncio.shield(job.future)
+            if analysis_data:
+                await db.refresh(item)
+                return analysis_data
+            # Фоновый анализ не удался — пробуем сами, с интерактивным приоритетом
+            job = None
+        elif job is not None:
+            job = self.claim(item.id)
+
+        try:
+            analysis_data = await analyze_item(db, item, user_id, Priority.INTERACTIVE)
+        except BaseException:
+            if job is not None:
+                self._finish(job, None)
+            raise
+        if job is not None:
+            self._finish(job, analysis_data)
+        return analysis_data
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers if self._tasks else 0,
+            "queued": self._queue.qsize() if self._queue else 0,
+            "in_progress": sum(1 for j in self._jobs.values() if j.started),
+            "completed": self.completed,
+            "failed": self.failed,
+            "claimed_by_requests": self.claimed,
+            "requeued_on_overload": self.requeued,
+            "waiting_retry": len(self._retries),
+        }
+
+
+item_analysis_service = ItemAnalysisService(
+    workers=settings.ITEM_ANALYSIS_WORKERS,
+    overload_retry_seconds=settings.ITEM_ANALYSIS_OVERLOAD_RETRY_SECONDS,
+    overload_max_retries=settings.ITEM_ANALYSIS_OVERLOAD_MAX_RETRIES,
+)
@@ -0,0 +1,195 @@
+# app/services/json_stream.py
+
+import json
+import logging
+from typing import Any, List, Optional, Sequence, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+PathItem = Union[str, int]
+# Шаблон пути: строка — ключ объекта, ANY_INDEX — любой индекс массива
+ANY_INDEX = -1
+
+
+class _Container:
+    __slots__ = ("is_object", "start", "path", "key", "index", "expect_key")
+
+    def __init__(self, is_object: bool, start: int, path: List[PathItem]) -> None:
+        self.is_object = is_object
+        self.start = start
+        self.path = path
+        self.key: Optional[str] = None
+        self.index = 0
+        self.expect_key = is_object
+
+    def child_path(self) -> List[PathItem]:
+        return self.path + [self.key if self.is_object else self.index]
+
+
+class IncrementalJSONParser:
+    """
+    Потоковый разбор JSON: как только закрывается объект по одному из
+    шаблонов путей (например, outfits[*].slots[*]), он отдаётся наружу,
+    не дожидаясь конца ответа модели.
+
+    Текст до первой '{' / '[' (например, ```json) игнорируется.
+    """
+
+    def __init__(self, patterns: Sequence[Sequence[PathItem]]) -> None:
+        self.patterns = [list(p) for p in patterns]
+        self._text = ""
+        self._pos = 0
+        self._stack: List[_Container] = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._done = False
+
+    @property
+    def text(self) -> str:
+        return self._text
+
+    @property
+    def done(self) -> bool:
+        """Корневой контейнер закрыт."""
+        return self._done
+
+    def _matches(self, path: List[PathItem]) -> bool:
+        for pattern in self.patterns:
+            if len(pattern) != len(path):
+                continue
+            if all((p == ANY_INDEX and isinstance(v, int)) or p == v for p, v in zip(pattern, path)):
+                return True
+        return False
+
+    def feed(self, chunk: str) -> List[Tuple[List[PathItem], Any]]:
+        """Добавляет кусок текста; возвращает [(path, value)] закрывшихся объектов."""
+        self._text += chunk
+        if self._done:
+            return []
+
+        text = self._text
+        events: List[Tuple[List[PathItem], Any]] = []
+
+        while self._pos < len(text):
+            pos = self._pos
+            ch = text[pos]
+            self._pos += 1
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    top = self._stack[-1] if self._stack else None
+                    if top is not None and top.is_object and top.expect_key:
+                        try:
+                            top.key = json.loads(text[self._string_start:pos + 1])
+                        except ValueError:
+                            top.key = text[self._string_start + 1:pos]
+                continue
+
+            if not self._stack:
+                if ch in "{[":
+                    self._stack.append(_Container(ch == "{", pos, []))
+                continue
+
+            top = self._stack[-1]
+            if ch == '"':
+                self._in_string = True
+                self._string_start = pos
+            elif ch == ":" and top.is_object:
+                top.expect_key = False
+            elif ch == ",":
+                if top.is_object:
+                    top.expect_key = True
+                    top.key = None
+                else:
+                    top.index += 1
+            elif ch in "{[":
+                self._stack.append(_Container(ch == "{", pos, top.child_path()))
+            elif ch in "}]":
+                closed = self._stack.pop()
+                if self._matches(closed.path):
+                    try:
+                        events.append((closed.path, json.loads(text[closed.start:pos + 1])))
+                    except ValueError as e:
+                        logger.debug(f"[JSON STREAM] Skipping malformed object at {closed.path}: {e}")
+                if not self._stack:
+                    self._done = True
+                    break
+
+        return events
+
+
+def repair_truncated_json(text: str) -> Optional[str]:
+    """
+    Достраивает обрезанный JSON (ответ модели упёрся в max_output_tokens).
+
+    Недописанные строка, число, литерал или ключ отбрасываются до
+    последнего целого значения (обрезанное "bl" вместо "blue" хуже, чем
+    пустое поле), затем закрываются все открытые объекты и массивы. Текст до первой '{' / '[' игнорируется.
+    Возвращает None, если JSON так и не начался.
+    """
+    start = -1
+    for idx, ch in enumerate(text):
+        if ch in "{[":
+            start = idx
+            break
+    if start == -1:
+        return None
+
+    # стек: [is_object, expect_key]
+    stack: List[List[bool]] = []
+    in_string = False
+    escape = False
+    string_is_value = False
+    # Последняя позиция, до которой текст — целые значения, и закрывающие скобки для неё
+    safe_end = start
+    safe_closers = ""
+
+    def closers() -> str:
+        return "".join("}" if is_object else "]" for is_object, _ in reversed(stack))
+
+    pos = start
+    while pos < len(text):
+        ch = text[pos]
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+                if string_is_value:
+                    safe_end, safe_closers = pos + 1, closers()
+            pos += 1
+            continue
+
+        if ch == '"':
+            in_string = True
+            top = stack[-1] if stack else None
+            string_is_value = not (top is not None and top[0] and top[1])
+        elif ch in "{[":
+            stack.append([ch == "{", ch == "{"])
+            safe_end, safe_closers = pos + 1, closers()
+        elif ch in "}]":
+            if not stack:
+                break
+            stack.pop()
+            safe_end, safe_closers = pos + 1, closers()
+            if not stack:
+                # Документ целый
+                return text[start:pos + 1]
+        elif ch == ":" and stack and stack[-1][0]:
+            stack[-1][1] = False
+        elif ch == ",":
+            # Всё до запятой — законченные значения
+            safe_end, safe_closers = pos, closers()
+            if stack and stack[-1][0]:
+                stack[-1][1] = True
+        pos += 1
+
+    return text[start:safe_end] + safe_closers
@@ -0,0 +1,167 @@
+# app/services/model_router.py
+
+import logging
+import time
+from typing import Optional, Dict, Any, List
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def is_quota_error(error: BaseException) -> bool:
+    """429 / ResourceExhausted / превышение квоты модели."""
+    text = str(error).lower()
+    return (
+        "429" in text
+        or "quota" in text
+        or "resource exhausted" in text
+        or error.__class__.__name__ == "ResourceExhausted"
+    )
+
+
+class _ModelState:
+    """Состояние одной модели: квота, ошибки, латентность."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.cooldown_until = 0.0
+        self.consecutive_errors = 0
+        self.requests = 0
+        self.successes = 0
+        self.errors = 0
+        self.quota_errors = 0
+        self.avg_latency = 0.0
+        self.last_error: Optional[str] = None
+
+    def available(self, now: float) -> bool:
+        return now >= self.cooldown_until
+
+    def as_dict(self, now: float) -> Dict[str, Any]:
+        return {
+            "available": self.available(now),
+            "cooldown_seconds": round(max(self.cooldown_until - now, 0.0), 1),
+            "requests": self.requests,
+            "successes": self.successes,
+            "errors": self.errors,
+            "quota_errors": self.quota_errors,
+            "avg_latency_ms": round(self.avg_latency * 1000, 1),
+            "last_error": self.last_error,
+        }
+
+
+class ModelRouter:
+    """
+    Упорядоченный список моделей на каждую задачу (analysis, reanalysis,
+    outfit_plan) с учётом квоты и ошибок.
+
+    Модель, вернувшая 429, уходит в cool-down на quota_cooldown секунд;
+    после error_threshold ошибок подряд — на error_cooldown. Пока модель
+    остывает, запросы идут к следующей в списке задачи.
+    """
+
+    def __init__(
+        self,
+        routes: Dict[str, List[str]],
+        quota_cooldown: float,
+        error_cooldown: float,
+        error_threshold: int,
+    ) -> None:
+        self.routes = routes
+        self.quota_cooldown = quota_cooldown
+        self.error_cooldown = error_cooldown
+        self.error_threshold = max(error_threshold, 1)
+        self._states: Dict[str, _ModelState] = {}
+
+    def _state(self, model: str) -> _ModelState:
+        state = self._states.get(model)
+        if state is None:
+            state = self._states[model] = _ModelState(model)
+        return state
+
+    def route(self, task: str) -> List[str]:
+        return self.routes.get(task) or self.routes["analysis"]
+
+    def candidates(self, task: str) -> List[str]:
+        """Доступные сейчас модели задачи, в порядке предпочтения."""
+        now = time.monotonic()
+        return [m for m in self.route(task) if self._state(m).available(now)]
+
+    def pick(self, task: str, exclude: Optional[List[str]] = None) -> Optional[str]:
+        """Первая доступная модель задачи (кроме exclude) или None."""
+        for model in self.candidates(task):
+            if not exclude or model not in exclude:
+                return model
+        return None
+
+    def retry_after(self, task: str) -> float:
+        """Через сколько секунд освободится первая модель задачи."""
+        now = time.monotonic()
+        waits = [self._state(m).cooldown_until - now for m in self.route(task)]
+        return max(min(waits, default=0.0), 1.0)
+
+    def report_success(self, model: str, latency: float) -> None:
+        state = self._state(model)
+        state.requests += 1
+        state.successes += 1
+        state.consecutive_errors = 0
+        state.avg_latency = latency if state.successes == 1 else 0.9 * state.avg_latency + 0.1 * latency
+
+    def report_quota(self, model: str, error: BaseException) -> None:
+        state = self._state(model)
+        state.requests += 1
+        state.quota_errors += 1
+        state.last_error = str(error)[:200]
+        state.cooldown_until = time.monotonic() + self.quota_cooldown
+        logger.warning(f"[MODEL ROUTER] {model} hit quota, cooling down {self.quota_cooldown:.0f}s")
+
+    def report_error(self, model: str, error: BaseException) -> None:
+        state = self._state(model)
+        state.requests += 1
+        state.errors += 1
+        state.consecutive_errors += 1
+        state.last_error = str(error)[:200]
+        if state.consecutive_errors >= self.error_threshold:
+            state.cooldown_until = time.monotonic() + self.error_cooldown
+            state.consecutive_errors = 0
+            logger.warning(
+                f"[MODEL ROUTER] {model} failed {self.error_threshold} times in a row, "
+                f"cooling down {self.error_cooldown:.0f}s"
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        models = {m for route in self.routes.values() for m in route} | set(self._states)
+        return {
+            "routes": self.routes,
+            "models": {m: self._state(m).as_dict(now) for m in sorted(models)},
+        }
+
+
+def build_routes(primary_model: str) -> Dict[str, List[str]]:
+    """
+    Маршруты по умолчанию: основная модель + GEMINI_FALLBACK_MODELS;
+    для переанализа сначала более дешёвая GEMINI_REANALYSIS_MODEL.
+    GEMINI_MODEL_ROUTES переопределяет любой из маршрутов.
+    """
+    def unique(models: List[str]) -> List[str]:
+        return list(dict.fromkeys(m for m in models if m))
+
+    default = unique([primary_model, *settings.GEMINI_FALLBACK_MODELS])
+    routes = {
+        "analysis": default,
+        "reanalysis": unique([settings.GEMINI_REANALYSIS_MODEL, *default]),
+        "outfit_plan": default,
+    }
+    for task, models in settings.GEMINI_MODEL_ROUTES.items():
+        if models:
+            routes[task] = unique(models)
+    return routes
+
+
+model_router = ModelRouter(
+    routes=build_routes(getattr(settings, "GEMINI_MODEL", None) or "gemini-2.5-flash-lite"),
+    quota_cooldown=settings.GEMINI_MODEL_QUOTA_COOLDOWN_SECONDS,
+    error_cooldown=settings.GEMINI_MODEL_ERROR_COOLDOWN_SECONDS,
+    error_threshold=settings.GEMINI_MODEL_ERROR_THRESHOLD,
+)
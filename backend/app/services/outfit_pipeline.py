@@ -0,0 +1,186 @@
+# app/services/outfit_pipeline.py
+
+import asyncio
+import logging
+import time
+from collections import Counter, deque
+from typing import Optional, Dict, Any, Deque, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Этапы пайплайна образов в порядке выполнения (этапы слотов перекрываются:
+# поиск слота стартует, пока план ещё генерируется)
+OUTFIT_PIPELINE_STAGES = (
+    "analysis", "plan", "query_build", "search", "filter", "rank", "dedupe", "assemble",
+)
+
+# Сколько последних прогонов держать на пайплайн для перцентилей
+_RUN_WINDOW = 200
+
+
+def _stage_order(stage: str) -> int:
+    if stage in OUTFIT_PIPELINE_STAGES:
+        return OUTFIT_PIPELINE_STAGES.index(stage)
+    return len(OUTFIT_PIPELINE_STAGES)
+
+
+class _StageSpan:
+    """
+    Один вызов этапа. Работает и как `with` (синхронные этапы), и как
+    `async with` — тогда учитывает лимит параллельности этапа; ожидание
+    лимита во время этапа не входит.
+    """
+
+    def __init__(self, run: "PipelineRun", stage: str, items_in: int) -> None:
+        self.run = run
+        self.stage = stage
+        self.items_in = items_in
+        self.items_out = 0
+        self.counters: Counter = Counter()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._started = 0.0
+
+    def __enter__(self) -> "_StageSpan":
+        self._started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is asyncio.CancelledError:
+            self.counters["cancelled"] += 1
+        elif exc_type is not None:
+            self.counters["errors"] += 1
+        self.run._record(self, self._started, time.monotonic())
+
+    async def __aenter__(self) -> "_StageSpan":
+        self._semaphore = self.run._semaphores.get(self.stage)
+        if self._semaphore is not None:
+            await self._semaphore.acquire()
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        try:
+            self.__exit__(exc_type, exc, tb)
+        finally:
+            if self._semaphore is not None:
+                self._semaphore.release()
+
+
+class PipelineRun:
+    """
+    Один прогон пайплайна (один HTTP-запрос): время и счётчики по этапам.
+
+    busy_ms — сумма длительностей вызовов этапа, wall_ms — от начала первого
+    до конца последнего вызова (для параллельных этапов busy > wall).
+    limits — максимум одновременных вызовов этапа (для `async with`).
+    """
+
+    def __init__(self, name: str, limits: Optional[Dict[str, int]] = None) -> None:
+        self.name = name
+        self.started = time.monotonic()
+        self._semaphores = {
+            stage: asyncio.Semaphore(limit)
+            for stage, limit in (limits or {}).items()
+            if limit and limit > 0
+        }
+        self._stages: Dict[str, Dict[str, Any]] = {}
+        self.total_ms: Optional[float] = None
+
+    def __enter__(self) -> "PipelineRun":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.finish("ok" if exc_type is None else "error")
+
+    def stage(self, name: str, items_in: int = 0) -> _StageSpan:
+        return _StageSpan(self, name, items_in)
+
+    def _record(self, span: _StageSpan, started: float, finished: float) -> None:
+        entry = self._stages.get(span.stage)
+        if entry is None:
+            entry = self._stages[span.stage] = {
+                "calls": 0, "items_in": 0, "items_out": 0, "busy": 0.0,
+                "first": started, "last": finished, "counters": Counter(),
+            }
+        entry["calls"] += 1
+        entry["items_in"] += span.items_in
+        entry["items_out"] += span.items_out
+        entry["busy"] += finished - started
+        entry["first"] = min(entry["first"], started)
+        entry["last"] = max(entry["last"], finished)
+        entry["counters"].update(span.counters)
+
+    def timings(self) -> Dict[str, Dict[str, Any]]:
+        ordered = sorted(self._stages.items(), key=lambda kv: (_stage_order(kv[0]), kv[1]["first"]))
+        return {
+            stage: {
+                "calls": entry["calls"],
+                "items_in": entry["items_in"],
+                "items_out": entry["items_out"],
+                "busy_ms": round(entry["busy"] * 1000, 1),
+                "wall_ms": round((entry["last"] - entry["first"]) * 1000, 1),
+                **dict(entry["counters"]),
+            }
+            for stage, entry in ordered
+        }
+
+    def finish(self, outcome: str = "ok") -> None:
+        """Закрывает прогон: лог с разбивкой по этапам и запись в общую статистику."""
+        if self.total_ms is not None:
+            return
+        self.total_ms = (time.monotonic() - self.started) * 1000
+        timings = self.timings()
+        breakdown = " ".join(f"{stage}={t['wall_ms']:.0f}ms" for stage, t in timings.items())
+        logger.info(f"[PIPELINE] {self.name} {outcome} total={self.total_ms:.0f}ms {breakdown}")
+        pipeline_metrics.record(self.name, outcome, self.total_ms, timings)
+
+
+class PipelineMetrics:
+    """Статистика прогонов по пайплайнам: перцентили общего времени и этапов."""
+
+    def __init__(self) -> None:
+        self._runs: Dict[str, Deque[Tuple[float, Dict[str, Dict[str, Any]]]]] = {}
+        self._outcomes: Dict[str, Counter] = {}
+        self._counters: Dict[str, Dict[str, Counter]] = {}
+
+    def record(self, name: str, outcome: str, total_ms: float, timings: Dict[str, Dict[str, Any]]) -> None:
+        window = self._runs.get(name)
+        if window is None:
+            window = self._runs[name] = deque(maxlen=_RUN_WINDOW)
+        window.append((total_ms, timings))
+        self._outcomes.setdefault(name, Counter())[outcome] += 1
+        stage_counters = self._counters.setdefault(name, {})
+        for stage, values in timings.items():
+            stage_counters.setdefault(stage, Counter()).update(
+                {k: v for k, v in values.items() if k not in ("busy_ms", "wall_ms")}
+            )
+
+    @staticmethod
+    def _percentiles(values: List[float]) -> Dict[str, float]:
+        ordered = sorted(values)
+
+        def pick(q: float) -> float:
+            return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 1)
+
+        return {"p50": pick(0.5), "p95": pick(0.95), "avg": round(sum(ordered) / len(ordered), 1)}
+
+    def stats(self) -> Dict[str, Any]:
+        result: Dict[str, Any] = {}
+        for name, window in self._runs.items():
+            stages: Dict[str, Any] = {}
+            for stage in {s for _, timings in window for s in timings}:
+                walls = [t[stage]["wall_ms"] for _, t in window if stage in t]
+                busys = [t[stage]["busy_ms"] for _, t in window if stage in t]
+                stages[stage] = {
+                    "wall_ms": self._percentiles(walls),
+                    "busy_ms_avg": round(sum(busys) / len(busys), 1),
+                    "totals": dict(self._counters[name].get(stage, {})),
+                }
+            result[name] = {
+                "runs": dict(self._outcomes[name]),
+                "total_ms": self._percentiles([total for total, _ in window]),
+                "stages": {stage: stages[stage] for stage in sorted(stages, key=_stage_order)},
+            }
+        return result
+
+
+pipeline_metrics = PipelineMetrics()
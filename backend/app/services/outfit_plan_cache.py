@@ -0,0 +1,133 @@
+# app/services/outfit_plan_cache.py
+
+import copy
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional, Dict, Any, List, Tuple
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+# Поля анализа базовой вещи, которые реально попадают в промпт
+_FINGERPRINT_FIELDS = ("category", "colors", "description", "style")
+
+
+def _normalize(value: Optional[str], default: str) -> str:
+    if not value:
+        return default
+    return " ".join(str(value).lower().split())
+
+
+def analysis_fingerprint(analysis_data: Optional[Dict[str, Any]]) -> str:
+    """Короткий отпечаток анализа базовой вещи (только поля из промпта)."""
+    if not analysis_data:
+        return "-"
+    relevant = {k: analysis_data.get(k) for k in _FINGERPRINT_FIELDS}
+    payload = json.dumps(relevant, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+@dataclass
+class _PlanPool:
+    plans: List[Tuple[Dict[str, Any], float]] = field(default_factory=list)
+    next_index: int = 0
+
+
+class OutfitPlanCache:
+    """
+    In-memory кэш планов образов по нормализованным входным параметрам.
+
+    Для каждого ключа хранится пул до `variety` планов: пока пул не заполнен,
+    get() возвращает None и вызывающий генерирует новый план (ради
+    разнообразия); после заполнения планы отдаются по кругу без LLM.
+    Версия промпта входит в ключ, так что смена промпта инвалидирует кэш.
+    """
+
+    def __init__(self, ttl_seconds: int, variety: int, max_keys: int) -> None:
+        self.ttl_seconds = ttl_seconds
+        self.variety = max(variety, 1)
+        self.max_keys = max_keys
+        self._pools: "OrderedDict[str, _PlanPool]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(
+        prompt_version: str,
+        style: str,
+        gender: str,
+        season: Optional[str],
+        outfits_count: int,
+        budget: Optional[str],
+        base_item_analysis: Optional[Dict[str, Any]] = None,
+    ) -> str:
+        return "|".join([
+            prompt_version,
+            _normalize(style, "casual"),
+            _normalize(gender, "men"),
+            _normalize(season, "any"),
+            str(outfits_count),
+            _normalize(budget, "mid"),
+            analysis_fingerprint(base_item_analysis),
+        ])
+
+    def _live_pool(self, key: str) -> Optional[_PlanPool]:
+        pool = self._pools.get(key)
+        if pool is None:
+            return None
+        now = time.monotonic()
+        pool.plans = [(plan, ts) for plan, ts in pool.plans if now - ts < self.ttl_seconds]
+        if not pool.plans:
+            del self._pools[key]
+            return None
+        self._pools.move_to_end(key)
+        return pool
+
+    def get(self, key: str, allow_partial: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        План из пула (по кругу) или None.
+
+        allow_partial=True отдаёт план даже из незаполненного пула —
+        например, когда генерация нового плана не удалась.
+        """
+        pool = self._live_pool(key)
+        if pool is None or (len(pool.plans) < self.variety and not allow_partial):
+            self.misses += 1
+            return None
+
+        plan, _ = pool.plans[pool.next_index % len(pool.plans)]
+        pool.next_index += 1
+        self.hits += 1
+        return copy.deepcopy(plan)
+
+    def put(self, key: str, plan: Dict[str, Any]) -> None:
+        pool = self._live_pool(key) or _PlanPool()
+        pool.plans.append((copy.deepcopy(plan), time.monotonic()))
+        if len(pool.plans) > self.variety:
+            pool.plans = pool.plans[-self.variety:]
+        self._pools[key] = pool
+        self._pools.move_to_end(key)
+
+        while len(self._pools) > self.max_keys:
+            self._pools.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "keys": len(self._pools),
+            "variety": self.variety,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+outfit_plan_cache = OutfitPlanCache(
+    ttl_seconds=settings.OUTFIT_PLAN_CACHE_TTL_SECONDS,
+    variety=settings.OUTFIT_PLAN_CACHE_VARIETY,
+    max_keys=settings.OUTFIT_PLAN_CACHE_MAX_KEYS,
+)
@@ -0,0 +1,145 @@
+# app/services/phash_index.py
+
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Optional, Dict, List, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.models.ai_analysis import AIAnalysis
+from app.services.image_service import hamming_distance
+
+logger = logging.getLogger(__name__)
+
+
+class BKTree:
+    """
+    BK-дерево по расстоянию Хэмминга для 64-битных перцептивных хэшей.
+
+    Поиск с радиусом r обходит только поддеревья с рёбрами в
+    [d - r, d + r], поэтому на гардеробах в тысячи вещей это доли миллисекунды.
+    """
+
+    __slots__ = ("_root", "_size")
+
+    def __init__(self) -> None:
+        # Узел: [hash, [values], {distance: child}]
+        self._root: Optional[list] = None
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, value_hash: int, value: int) -> None:
+        self._size += 1
+        if self._root is None:
+            self._root = [value_hash, [value], {}]
+            return
+
+        node = self._root
+        while True:
+            distance = hamming_distance(value_hash, node[0])
+            if distance == 0:
+                node[1].append(value)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value_hash, [value], {}]
+                return
+            node = child
+
+    def search(self, value_hash: int, max_distance: int) -> List[Tuple[int, int]]:
+        """Все (distance, value) в радиусе max_distance, ближайшие первыми."""
+        if self._root is None:
+            return []
+
+        found: List[Tuple[int, int]] = []
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(value_hash, node[0])
+            if distance <= max_distance:
+                found.extend((distance, v) for v in node[1])
+            low, high = distance - max_distance, distance + max_distance
+            for edge, child in node[2].items():
+                if low <= edge <= high:
+                    stack.append(child)
+
+        found.sort()
+        return found
+
+
+class PerceptualHashIndex:
+    """
+    Индекс перцептивных хэшей проанализированных изображений по пользователям.
+
+    Дерево пользователя лениво строится из ai_analyses.image_phash при первом
+    обращении и дальше пополняется в памяти. Хранится ограниченное число
+    пользователей (LRU).
+    """
+
+    def __init__(self) -> None:
+        self._trees: "OrderedDict[int, BKTree]" = OrderedDict()
+        self._load_locks: Dict[int, asyncio.Lock] = {}
+
+    async def _get_tree(self, db: AsyncSession, user_id: int) -> BKTree:
+        tree = self._trees.get(user_id)
+        if tree is not None:
+            self._trees.move_to_end(user_id)
+            return tree
+
+        lock = self._load_locks.setdefault(user_id, asyncio.Lock())
+        async with lock:
+            tree = self._trees.get(user_id)
+            if tree is not None:
+                return tree
+
+            result = await db.execute(
+                select(AIAnalysis.id, AIAnalysis.image_phash).where(
+                    AIAnalysis.user_id == user_id,
+                    AIAnalysis.image_phash.is_not(None),
+                )
+            )
+            tree = BKTree()
+            for analysis_id, phash in result.all():
+                try:
+                    tree.add(int(phash, 16), analysis_id)
+                except ValueError:
+                    continue
+
+            self._trees[user_id] = tree
+            while len(self._trees) > settings.PHASH_INDEX_MAX_USERS:
+                self._trees.popitem(last=False)
+
+        self._load_locks.pop(user_id, None)
+        logger.info(f"[PHASH] Loaded index for user {user_id}: {len(tree)} hashes")
+        return tree
+
+    async def find_nearest(
+        self,
+        db: AsyncSession,
+        user_id: int,
+        phash: str,
+        max_distance: Optional[int] = None,
+    ) -> List[Tuple[int, int]]:
+        """Кандидаты (distance, analysis_id) в радиусе max_distance, ближайшие первыми."""
+        if max_distance is None:
+            max_distance = settings.PHASH_MAX_DISTANCE
+        tree = await self._get_tree(db, user_id)
+        return tree.search(int(phash, 16), max_distance)
+
+    def add(self, user_id: int, phash: str, analysis_id: int) -> None:
+        """Добавляет анализ в индекс (если дерево пользователя уже загружено)."""
+        tree = self._trees.get(user_id)
+        if tree is not None:
+            tree.add(int(phash, 16), analysis_id)
+
+    def invalidate_user(self, user_id: int) -> None:
+        """Сбрасывает дерево пользователя — при следующем запросе перечитаем из БД."""
+        self._trees.pop(user_id, None)
+
+
+phash_index = PerceptualHashIndex()
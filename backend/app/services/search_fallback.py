@@ -0,0 +1,104 @@
+# app/services/search_fallback.py
+
+import logging
+from collections import deque
+from typing import Optional, Dict, Any, Deque, Tuple
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних исходов держать на ключ (вид поиска, категория, форма запроса)
+_OUTCOME_WINDOW = 100
+# Сколько ключей держать (категории приходят от Gemini и плана образов)
+_MAX_KEYS = 2000
+
+
+def query_shape(query: str) -> str:
+    """Форма запроса: число слов (корзинами) и наличие минус-слов."""
+    tokens = query.split()
+    words = [t for t in tokens if not t.startswith("-")]
+    n = len(words)
+    bucket = "1-2" if n <= 2 else "3-4" if n <= 4 else "5-6" if n <= 6 else "7+"
+    return f"w{bucket}" + ("-minus" if len(words) < len(tokens) else "")
+
+
+class SearchFallbackPredictor:
+    """
+    Предсказывает, что основной поиск на маркетплейсах ничего не даст, по
+    истории пустых результатов для (вид поиска, категория, форма запроса).
+    Если вероятность выше порога, fallback-запрос запускается сразу, вместе
+    с основным, и выбрасывается, если основной что-то нашёл.
+
+    Пока по категории мало данных, используется статистика формы запроса
+    по всем категориям этого вида поиска.
+    """
+
+    def __init__(self, enabled: bool, threshold: float, min_samples: int) -> None:
+        self.enabled = enabled
+        self.threshold = threshold
+        self.min_samples = max(min_samples, 1)
+        self._outcomes: Dict[Tuple[str, str, str], Deque[bool]] = {}
+        self.speculated = 0
+        self.used = 0
+        self.wasted = 0
+
+    @staticmethod
+    def _keys(kind: str, category: str, query: str) -> Tuple[Tuple[str, str, str], Tuple[str, str, str]]:
+        shape = query_shape(query)
+        return (kind, (category or "").strip().lower(), shape), (kind, "*", shape)
+
+    def record(self, kind: str, category: str, query: str, empty: bool) -> None:
+        """Исход основного поиска: empty — понадобился fallback."""
+        for key in self._keys(kind, category, query):
+            window = self._outcomes.get(key)
+            if window is None:
+                if len(self._outcomes) >= _MAX_KEYS:
+                    self._outcomes.pop(next(iter(self._outcomes)))
+                window = self._outcomes[key] = deque(maxlen=_OUTCOME_WINDOW)
+            window.append(empty)
+
+    def probability(self, kind: str, category: str, query: str) -> Optional[float]:
+        """Доля пустых результатов; None — статистики пока мало."""
+        for key in self._keys(kind, category, query):
+            window = self._outcomes.get(key)
+            if window and len(window) >= self.min_samples:
+                return sum(window) / len(window)
+        return None
+
+    def should_speculate(self, kind: str, category: str, query: str) -> bool:
+        if not self.enabled:
+            return False
+        p = self.probability(kind, category, query)
+        if p is None or p < self.threshold:
+            return False
+        logger.info(f"[SEARCH] Speculative fallback for {kind}/{category}/{query_shape(query)} (p_empty={p:.2f})")
+        self.speculated += 1
+        return True
+
+    def record_speculation(self, used: bool) -> None:
+        if used:
+            self.used += 1
+        else:
+            self.wasted += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "threshold": self.threshold,
+            "speculated": self.speculated,
+            "used": self.used,
+            "wasted": self.wasted,
+            "empty_rates": {
+                f"{kind}:{category}:{shape}": round(sum(window) / len(window), 3)
+                for (kind, category, shape), window in self._outcomes.items()
+                if len(window) >= self.min_samples
+            },
+        }
+
+
+search_fallback_predictor = SearchFallbackPredictor(
+    enabled=settings.SEARCH_SPECULATIVE_FALLBACK_ENABLED,
+    threshold=settings.SEARCH_SPECULATIVE_FALLBACK_THRESHOLD,
+    min_samples=settings.SEARCH_SPECULATIVE_FALLBACK_MIN_SAMPLES,
+)
@@ -0,0 +1,146 @@
+"""
+Юнит-тесты пакетного (пере)анализа: продолжение по checkpoint, параметры
+прохода, бюджет вызовов и ожидание при перегрузке Gemini (временная sqlite,
+анализ — заглушка).
+"""
+import asyncio
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+
+from app.db.session import Base
+from app.models.ai_analysis import AIAnalysis
+from app.models.clothing import ClothingItem
+from app.services import analysis_backfill as module
+from app.services.analysis_backfill import (
+    AnalysisBackfill,
+    BackfillOptions,
+    BackfillScopeMismatch,
+    parse_args,
+)
+from app.services.gemini_scheduler import GeminiOverloadedError
+
+
+@pytest.fixture
+def db(monkeypatch, tmp_path):
+    """Временная sqlite вместо async_session задания."""
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'backfill.db'}", poolclass=NullPool)
+    factory = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    monkeypatch.setattr(module, "async_session", factory)
+
+    async def create_all():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+
+    asyncio.run(create_all())
+    return factory
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    """Заглушка кэша анализов: пустой кэш, get_or_analyze по списку исходов."""
+    state = {"analyzed": [], "outcomes": []}
+
+    async def get_many(content_hashes, analysis_version):
+        return {}
+
+    async def get_or_analyze(image_path, content_hash=None, force=False, **kwargs):
+        state["analyzed"].append(image_path)
+        outcome = state["outcomes"].pop(0) if state["outcomes"] else None
+        if isinstance(outcome, Exception):
+            raise outcome
+        return {"category": "jacket", "colors": ["black"]}, False
+
+    async def fingerprint(path):
+        return None, None
+
+    monkeypatch.setattr(module.analysis_cache_service, "get_many", get_many)
+    monkeypatch.setattr(module.analysis_cache_service, "get_or_analyze", get_or_analyze)
+    monkeypatch.setattr(module.image_service, "fingerprint", fingerprint)
+    return state
+
+
+def add_items(factory, tmp_path, users):
+    """По вещи с уникальной картинкой на каждого пользователя из users."""
+    async def run():
+        async with factory() as session:
+            items = []
+            for i, user_id in enumerate(users):
+                path = tmp_path / f"item{i}.jpg"
+                path.write_bytes(f"image {i}".encode())
+                items.append(ClothingItem(user_id=user_id, image_url=str(path)))
+            session.add_all(items)
+            await session.commit()
+            return [item.id for item in items]
+
+    return asyncio.run(run())
+
+
+def analyzed_items(factory):
+    async def run():
+        async with factory() as session:
+            result = await session.execute(select(AIAnalysis.clothing_item_id).order_by(AIAnalysis.id))
+            return list(result.scalars())
+
+    return asyncio.run(run())
+
+
+def backfill(**kwargs):
+    return asyncio.run(AnalysisBackfill(BackfillOptions(requests_per_minute=0, **kwargs)).run())
+
+
+def test_call_budget_stops_run_and_next_run_resumes(db, gemini, tmp_path):
+    ids = add_items(db, tmp_path, [1] * 5)
+
+    first = backfill(batch_size=2, max_calls=3)
+    # Бюджет режет вторую пачку до одной вещи
+    assert first["gemini_calls"] == 3
+    assert first["last_item_id"] == ids[2]
+    assert not first["finished"]
+
+    second = backfill(batch_size=2)
+    assert second["finished"]
+    assert second["processed"] == 5
+    # Уже обработанные вещи повторно не анализируются
+    assert len(gemini["analyzed"]) == 5
+    assert analyzed_items(db) == ids
+
+
+def test_resume_with_other_scope_is_refused(db, gemini, tmp_path):
+    add_items(db, tmp_path, [1, 1, 2, 2])
+    backfill(batch_size=1, max_calls=1, user_id=1)
+
+    with pytest.raises(BackfillScopeMismatch):
+        backfill(batch_size=1)
+    with pytest.raises(BackfillScopeMismatch):
+        backfill(batch_size=1, user_id=1, task="reanalysis")
+    assert len(gemini["analyzed"]) == 1
+
+    # Своё имя — независимый проход; --restart начинает заново с новыми параметрами
+    other = backfill(name="all-users")
+    assert other["processed"] == 3
+    restarted = backfill(restart=True, all_items=True)
+    assert restarted["finished"]
+    assert restarted["processed"] == 4
+
+
+def test_overloaded_gemini_is_waited_out(db, gemini, tmp_path, monkeypatch):
+    ids = add_items(db, tmp_path, [1, 1])
+    gemini["outcomes"] = [GeminiOverloadedError("busy", retry_after=0.01)]
+
+    summary = backfill(concurrency=1)
+
+    assert summary["failed"] == 0
+    assert summary["analyzed"] == 2
+    # Вещь после перегрузки повторена, а не помечена failed
+    assert len(gemini["analyzed"]) == 3
+    assert sorted(analyzed_items(db)) == ids
+
+
+def test_cli_name_and_scope_options():
+    options = parse_args(["--name", "user-42", "--user-id", "42", "--task", "reanalysis", "--all"])
+    assert options.name == "user-42"
+    assert options.scope() == {"task": "reanalysis", "all_items": True, "user_id": 42}
@@ -0,0 +1,134 @@
+"""
+Юнит-тесты пакетного анализа с кэшем: попадания одним запросом, лимит
+параллельных запросов к Gemini, пачки картинок (временная sqlite, Gemini — заглушка).
+"""
+import asyncio
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+
+from app.db.session import Base
+from app.services import analysis_cache_service as module
+from app.services.analysis_cache_service import AnalysisCacheService
+from app.services.gemini_metrics import GeminiCall
+from app.services.gemini_service import GeminiService
+
+
+@pytest.fixture
+def cache(monkeypatch, tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'cache.db'}", poolclass=NullPool)
+    monkeypatch.setattr(module, "async_session", sessionmaker(engine, class_=AsyncSession, expire_on_commit=False))
+
+    async def create_all():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+
+    asyncio.run(create_all())
+    return AnalysisCacheService()
+
+
+class FakeGemini:
+    """Заглушка gemini_service: считает одновременные запросы и пачки."""
+
+    analysis_version = "v1"
+    model_name = "test-model"
+
+    def __init__(self):
+        self.single = []
+        self.packs = []
+        self.active = 0
+        self.max_active = 0
+        self.fail = set()
+
+    async def _call(self):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        await asyncio.sleep(0.01)
+        self.active -= 1
+
+    async def analyze_clothing_image(self, image_path, call_info=None, **kwargs):
+        self.single.append(image_path)
+        await self._call()
+        if image_path in self.fail:
+            raise RuntimeError("gemini down")
+        return {"category": f"cat {image_path}"}
+
+    async def analyze_clothing_images(self, image_paths, call_info=None, **kwargs):
+        self.packs.append(list(image_paths))
+        await self._call()
+        call_info.prompt_tokens = 300
+        call_info.model = "pack-model"
+        return [{"category": f"cat {p}"} for p in image_paths]
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    fake = FakeGemini()
+    monkeypatch.setattr(module, "gemini_service", fake)
+    return fake
+
+
+def test_cached_images_skip_gemini_and_misses_are_bounded(cache, gemini):
+    async def run():
+        await cache.put("h0", "v1", {"category": "cached"})
+        await cache.put("h1", "v0", {"category": "old version"})
+        images = [(f"img{i}", f"h{i}") for i in range(6)]
+        return await cache.analyze_batch(images, pack_size=1, concurrency=2)
+
+    results = asyncio.run(run())
+
+    assert results[0] == ({"category": "cached"}, True, None)
+    # Анализ другой версии — промах
+    assert results[1][0] == {"category": "cat img1"}
+    assert sorted(gemini.single) == [f"img{i}" for i in range(1, 6)]
+    assert gemini.max_active == 2
+    assert all(isinstance(r[2], GeminiCall) for r in results[1:])
+    # Свежие анализы попали в кэш
+    assert asyncio.run(cache.get("h3", "v1")) == {"category": "cat img3"}
+
+
+def test_failed_image_reported_without_failing_the_batch(cache, gemini):
+    gemini.fail = {"img1"}
+
+    results = asyncio.run(cache.analyze_batch([("img0", "h0"), ("img1", "h1")], concurrency=4))
+
+    assert results[0][0] == {"category": "cat img0"}
+    assert isinstance(results[1], RuntimeError)
+
+
+def test_packs_share_one_request_and_its_tokens(cache, gemini):
+    images = [(f"img{i}", f"h{i}") for i in range(5)]
+
+    results = asyncio.run(cache.analyze_batch(images, pack_size=2, concurrency=4))
+
+    assert gemini.packs == [["img0", "img1"], ["img2", "img3"], ["img4"]]
+    assert [r[0]["category"] for r in results] == [f"cat img{i}" for i in range(5)]
+    assert [r[2].prompt_tokens for r in results] == [150, 150, 150, 150, 300]
+    assert asyncio.run(cache.get("h4", "v1")) == {"category": "cat img4"}
+
+
+def test_images_missing_from_pack_response_analyzed_one_by_one(monkeypatch):
+    service = GeminiService()
+    service.model = object()
+    single = []
+
+    async def tracked(call, coro):
+        return await coro
+
+    async def analyze_many(image_paths, *args):
+        return [{"category": "shirt"}, None, {"category": "shoes"}]
+
+    async def analyze_one(image_path, **kwargs):
+        single.append(image_path)
+        return {"category": "jeans"}
+
+    monkeypatch.setattr(service, "_tracked", tracked)
+    monkeypatch.setattr(service, "_analyze_clothing_images", analyze_many)
+    monkeypatch.setattr(service, "analyze_clothing_image", analyze_one)
+
+    results = asyncio.run(service.analyze_clothing_images(["a", "b", "c"]))
+
+    assert [r["category"] for r in results] == ["shirt", "jeans", "shoes"]
+    assert single == ["b"]
@@ -0,0 +1,19 @@
+"""
+Версия анализа: не зависит от модели (переанализ и failover идут через
+другие модели), меняется вместе с тегом.
+"""
+from app.core.config import settings
+from app.services.gemini_service import gemini_service
+
+
+def test_version_does_not_depend_on_model(monkeypatch):
+    version = gemini_service.analysis_version
+    monkeypatch.setattr(gemini_service, "model_name", "some-other-model")
+    assert gemini_service.analysis_version == version
+    assert "some-other-model" not in version
+
+
+def test_tag_changes_version(monkeypatch):
+    version = gemini_service.analysis_version
+    monkeypatch.setattr(settings, "GEMINI_ANALYSIS_VERSION_TAG", "m2")
+    assert gemini_service.analysis_version == f"{version}:m2"
@@ -0,0 +1,52 @@
+"""
+Юнит-тесты досоздания колонок в старой базе (sqlite в памяти).
+"""
+from sqlalchemy import create_engine, inspect, text
+
+from app.db.session import Base, add_missing_columns
+from app.models import ai_analysis, clothing  # noqa: F401 — регистрация моделей в Base
+
+
+def model_columns(table_name):
+    return {column.name for column in Base.metadata.tables[table_name].columns}
+
+
+def test_missing_nullable_columns_and_indexes_are_added():
+    engine = create_engine("sqlite://")
+    with engine.begin() as conn:
+        # Схема до новых колонок: create_all такую таблицу не трогает
+        conn.execute(text(
+            "CREATE TABLE ai_analyses (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, "
+            "clothing_item_id INTEGER, prompt TEXT NOT NULL, response TEXT NOT NULL, "
+            "analysis_data JSON, model_used VARCHAR(100), created_at DATETIME NOT NULL)"
+        ))
+        conn.execute(text(
+            "INSERT INTO ai_analyses (id, user_id, prompt, response, created_at) "
+            "VALUES (1, 1, 'p', 'r', '2025-01-01')"
+        ))
+
+        added = add_missing_columns(conn)
+        # Повторный запуск ничего не меняет
+        assert add_missing_columns(conn) == []
+
+    assert "ai_analyses.image_phash" in added
+    inspector = inspect(engine)
+    assert {c["name"] for c in inspector.get_columns("ai_analyses")} == model_columns("ai_analyses")
+    assert any(i["column_names"] == ["image_phash"] for i in inspector.get_indexes("ai_analyses"))
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT image_phash FROM ai_analyses")).scalar() is None
+
+
+def test_not_null_columns_left_for_manual_migration():
+    engine = create_engine("sqlite://")
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE clothing_items (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, "
+            "category VARCHAR(100), color VARCHAR(100), brand VARCHAR(100), description TEXT, "
+            "created_at DATETIME NOT NULL, updated_at DATETIME)"
+        ))
+        added = add_missing_columns(conn)
+
+    assert "clothing_items.image_url" not in added
+    present = {c["name"] for c in inspect(engine).get_columns("clothing_items")}
+    assert present == model_columns("clothing_items") - {"image_url"}
@@ -0,0 +1,140 @@
+"""
+Юнит-тесты кэша find-similar.
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from app.api.v1 import ai
+from app.schemas.ai import FindSimilarRequest
+from app.services.find_similar_cache import FindSimilarCache, FindSimilarEntry
+
+
+def make_key(item_id=1, analysis_id=10, fields=("jacket", "black", None, "d")):
+    return FindSimilarCache.make_key(item_id, analysis_id, fields, ["asos", "hm"], 15)
+
+
+def test_key_changes_with_analysis_and_item_fields():
+    assert make_key() == make_key()
+    assert make_key(analysis_id=11) != make_key()
+    assert make_key(fields=("coat", "black", None, "d")) != make_key()
+
+
+def test_entries_are_copies_and_expire():
+    cache = FindSimilarCache(ttl_seconds=60, max_entries=10)
+    entry = FindSimilarEntry(search_query="q", products=[{"url": "u", "similarity_score": 50}], fallback_used=False)
+    cache.put(make_key(), entry)
+
+    cached = cache.get(make_key())
+    cached.products[0]["similarity_score"] = 0
+    assert cache.get(make_key()).products[0]["similarity_score"] == 50
+
+    cache.ttl_seconds = 0
+    assert cache.get(make_key()) is None
+    assert cache.stats()["hits"] == 2
+
+
+def test_invalidate_item_drops_only_that_item():
+    cache = FindSimilarCache(ttl_seconds=60, max_entries=10)
+    entry = FindSimilarEntry(search_query="q", products=[], fallback_used=False)
+    cache.put(make_key(item_id=1), entry)
+    cache.put(make_key(item_id=1, analysis_id=11), entry)
+    cache.put(make_key(item_id=12), entry)
+
+    assert cache.invalidate_item(1) == 2
+    assert cache.get(make_key(item_id=12)) is not None
+
+
+def test_alternates_are_kept_per_threshold_in_new_entries():
+    cache = FindSimilarCache(ttl_seconds=60, max_entries=10)
+    cache.put(make_key(), FindSimilarEntry(search_query="q", products=[], fallback_used=False))
+    before = cache.get(make_key())
+
+    # Два запроса с разными порогами — ни один не затирает выдачу другого
+    cache.put_alternates(make_key(), 60.0, [{"url": "a"}])
+    cache.put_alternates(make_key(), 80.0, [{"url": "b"}])
+    cache.put_alternates(make_key(item_id=2), 60.0, [{"url": "c"}])
+
+    assert cache.get(make_key()).alternate_products == {60.0: [{"url": "a"}], 80.0: [{"url": "b"}]}
+    assert before.alternate_products == {}
+    assert cache.get(make_key(item_id=2)) is None
+
+
+PRODUCT = {
+    "name": "Jacket", "price": 10.0, "currency": "USD", "url": "https://shop/1",
+    "image_url": "https://shop/1.jpg", "brand": "B", "marketplace": "asos", "similarity_score": 80.0,
+}
+
+
+@pytest.fixture
+def endpoint(monkeypatch):
+    """find-similar с готовым анализом вещи 7 и кэшем в памяти (без БД и поиска)."""
+    item = SimpleNamespace(
+        id=7, category="jacket", color="black", brand=None, description="d", image_url="/x.jpg",
+    )
+    analysis = SimpleNamespace(id=10, analysis_version="old", analysis_data={"category": "jacket", "tags": ["jacket"]})
+
+    class FakeDb:
+        async def execute(self, query):
+            return SimpleNamespace(scalar_one_or_none=lambda: item)
+
+    async def latest_item_analysis(db, item_id):
+        return analysis
+
+    async def auto_analyze_item(*args, **kwargs):
+        raise AssertionError("cache hit must not analyze")
+
+    state = SimpleNamespace(cache=FindSimilarCache(ttl_seconds=60, max_entries=10), enqueued=[], db=FakeDb())
+    monkeypatch.setattr(ai, "find_similar_cache", state.cache)
+    monkeypatch.setattr(ai, "latest_item_analysis", latest_item_analysis)
+    monkeypatch.setattr(ai, "auto_analyze_item", auto_analyze_item)
+    monkeypatch.setattr(ai, "gemini_service", SimpleNamespace(model=object(), analysis_version="new"))
+    monkeypatch.setattr(
+        ai.item_analysis_service, "enqueue",
+        lambda item_id, user_id, reanalysis=False: state.enqueued.append((item_id, user_id, reanalysis)),
+    )
+
+    def cache_entry(products, **request_fields):
+        request = FindSimilarRequest(item_id=item.id, **request_fields)
+        key = state.cache.make_key(
+            item.id, analysis.id, (item.category, item.color, item.brand, item.description),
+            request.marketplaces, request.max_results_per_marketplace,
+        )
+        state.cache.put(key, FindSimilarEntry(search_query="black jacket", products=products, fallback_used=False))
+
+    def call(**request_fields):
+        request = FindSimilarRequest(item_id=item.id, **request_fields)
+        return asyncio.run(ai.find_similar_products(request, SimpleNamespace(id=3), state.db))
+
+    state.cache_entry = cache_entry
+    state.call = call
+    return state
+
+
+def test_cache_hit_enqueues_reanalysis_of_outdated_analysis(endpoint):
+    endpoint.cache_entry([PRODUCT])
+
+    response = endpoint.call()
+
+    assert [p.url for p in response.similar_products] == ["https://shop/1"]
+    assert endpoint.enqueued == [(7, 3, True)]
+
+
+def test_alternate_search_reused_only_for_its_threshold(endpoint, monkeypatch):
+    searches = []
+
+    async def search_alternate_queries(queries, min_score, **kwargs):
+        searches.append(min_score)
+        return []
+
+    monkeypatch.setattr(ai, "search_alternate_queries", search_alternate_queries)
+    endpoint.cache_entry([{**PRODUCT, "similarity_score": 10.0}])
+
+    for threshold in (60, 80, 60):
+        response = endpoint.call(min_similarity_score=threshold)
+        # Никто не прошёл порог — отдаются лучшие с ослабленным порогом
+        assert response.fallback_used and response.min_score_filter == 0.0
+
+    # Выдача, остановленная на пороге 60, не годится для порога 80
+    assert searches == [60.0, 80.0]
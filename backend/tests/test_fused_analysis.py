@@ -0,0 +1,118 @@
+"""
+Юнит-тесты совмещённого анализа вещи и плана образов одним вызовом
+(модель Gemini — заглушка, отдающая заданный JSON кусками).
+"""
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import pytest
+
+from app.api.v1.ai import outfit_params_from_analysis
+from app.services import gemini_service as module
+from app.services.gemini_service import GeminiService
+from app.services.image_service import PreparedImage
+
+ANALYSIS = {"category": "jacket", "colors": ["black"], "target_audience": "Women", "style": "smart"}
+OUTFIT = {
+    "outfit_name": "City",
+    "description": "",
+    "slots": [
+        {"slot_type": "bottom", "search_query": "black trousers"},
+        {"slot_type": "shoes", "search_query": "loafers"},
+    ],
+}
+
+
+class FakeModel:
+    """Модель-заглушка: стримит text кусками по chunk символов."""
+
+    def __init__(self, text, chunk=16):
+        self.text = text
+        self.chunk = chunk
+        self.calls = []
+
+    async def generate_content_async(self, contents, generation_config=None, stream=False):
+        self.calls.append((contents, generation_config))
+
+        async def chunks():
+            for i in range(0, len(self.text), self.chunk):
+                yield SimpleNamespace(text=self.text[i:i + self.chunk])
+
+        return chunks()
+
+
+@pytest.fixture
+def service(monkeypatch):
+    service = GeminiService()
+    service.model = object()
+
+    @asynccontextmanager
+    async def slot(user_id, priority):
+        yield 0.0
+
+    async def prepare_for_gemini(image_path):
+        return PreparedImage(b"jpeg", "image/jpeg", 10, 10, 4)
+
+    async def image_part(image_path, prepared):
+        return "image"
+
+    noop = lambda *args, **kwargs: None
+    monkeypatch.setattr(module, "gemini_scheduler", SimpleNamespace(slot=slot))
+    monkeypatch.setattr(module, "gemini_key_pool", SimpleNamespace(start=noop, finish=noop, add_tokens=noop))
+    monkeypatch.setattr(module.model_router, "report_success", noop)
+    monkeypatch.setattr(module.image_service, "prepare_for_gemini", prepare_for_gemini)
+    monkeypatch.setattr(service, "_image_part", image_part)
+    monkeypatch.setattr(service, "_pick_model", lambda *args: ("test-model", SimpleNamespace(label="key")))
+    return service
+
+
+def stream(service, monkeypatch, payload):
+    model = FakeModel(json.dumps(payload))
+
+    async def get_model(model_name, instruction, key):
+        assert instruction == "analysis_outfit_plan"
+        return model
+
+    monkeypatch.setattr(service, "_get_model", get_model)
+
+    async def run():
+        return [
+            event async for event in service.stream_outfit_plan(
+                style=None, gender=None, outfits_count=1, base_image_path="item.jpg",
+            )
+        ]
+
+    return asyncio.run(run()), model
+
+
+def test_fused_stream_emits_analysis_before_slots(service, monkeypatch):
+    events, model = stream(service, monkeypatch, {"analysis": ANALYSIS, "outfits": [OUTFIT]})
+
+    assert [e[0] for e in events] == ["analysis", "slot", "slot", "plan"]
+    assert events[0][1]["category"] == "jacket"
+    assert events[0][1]["tags"] == []
+    assert events[-1][1]["outfits"][0]["outfit_name"] == "City"
+    # Картинка уходит в тот же запрос, что и промпт плана
+    assert model.calls[0][0][1] == "image"
+
+
+def test_analysis_written_after_outfits_taken_from_full_response(service, monkeypatch):
+    events, _ = stream(service, monkeypatch, {"outfits": [OUTFIT], "analysis": ANALYSIS})
+
+    assert [e[0] for e in events] == ["slot", "slot", "analysis", "plan"]
+    assert events[2][1]["category"] == "jacket"
+
+
+def test_invalid_fused_analysis_dropped_but_plan_kept(service, monkeypatch):
+    events, _ = stream(service, monkeypatch, {"analysis": {"colors": ["red"]}, "outfits": [OUTFIT]})
+
+    assert [e[0] for e in events] == ["slot", "slot", "plan"]
+    assert service._parse_fused_analysis("jacket") is None
+
+
+def test_outfit_params_follow_analysis_unless_style_requested():
+    assert outfit_params_from_analysis(None, ANALYSIS) == ("smart", None, "women")
+    assert outfit_params_from_analysis("sport", {**ANALYSIS, "season": "winter"}) == ("sport", "winter", "women")
+    assert outfit_params_from_analysis(None, {"category": "jacket"}) == ("casual", None, "men")
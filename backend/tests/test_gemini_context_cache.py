@@ -0,0 +1,109 @@
+"""
+Юнит-тесты серверного кэша системных инструкций Gemini (без сети).
+"""
+import asyncio
+
+from app.services import gemini_context_cache as module
+from app.services.gemini_context_cache import GeminiContextCache
+
+
+class FakeCachedContent:
+    created = []
+
+    def __init__(self, model, system_instruction):
+        self.name = f"cachedContents/{len(self.created)}"
+        self.model = model
+        self.system_instruction = system_instruction
+        self.updates = 0
+
+    @classmethod
+    def create(cls, model, display_name=None, system_instruction=None, ttl=None):
+        if "tiny" in model:
+            raise ValueError("Cached content is too small")
+        cached = cls(model, system_instruction)
+        cls.created.append(cached)
+        return cached
+
+    def update(self, ttl=None):
+        self.updates += 1
+
+    def delete(self):
+        pass
+
+
+def patch_sdk(monkeypatch):
+    FakeCachedContent.created = []
+    monkeypatch.setattr(module.caching, "CachedContent", FakeCachedContent)
+    monkeypatch.setattr(
+        module.genai.GenerativeModel,
+        "from_cached_content",
+        staticmethod(lambda cached: ("model", cached.name)),
+    )
+
+
+def test_cache_created_once_per_model_and_instruction(monkeypatch):
+    patch_sdk(monkeypatch)
+    cache = GeminiContextCache(ttl=3600, refresh_margin=300, retry_after=3600)
+
+    async def run():
+        models = await asyncio.gather(*(cache.get_model("m", "analysis", "static") for _ in range(5)))
+        other = await cache.get_model("m2", "analysis", "static")
+        return models, other
+
+    models, other = asyncio.run(run())
+    assert len(set(models)) == 1
+    assert other != models[0]
+    assert len(FakeCachedContent.created) == 2
+    assert FakeCachedContent.created[0].model == "models/m"
+
+
+def test_cache_refreshed_before_expiry(monkeypatch):
+    patch_sdk(monkeypatch)
+    cache = GeminiContextCache(ttl=100, refresh_margin=200, retry_after=3600)
+
+    async def run():
+        first = await cache.get_model("m", "analysis", "static")
+        # TTL меньше запаса: каждый запрос продлевает, а не пересоздаёт кэш
+        second = await cache.get_model("m", "analysis", "static")
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first == second
+    assert len(FakeCachedContent.created) == 1
+    assert FakeCachedContent.created[0].updates == 1
+
+
+def test_unsupported_model_falls_back_without_retrying(monkeypatch):
+    patch_sdk(monkeypatch)
+    cache = GeminiContextCache(ttl=3600, refresh_margin=300, retry_after=3600)
+
+    async def run():
+        return [await cache.get_model("tiny", "analysis", "static") for _ in range(3)]
+
+    assert asyncio.run(run()) == [None, None, None]
+    assert cache.failures == 1
+
+
+def test_instruction_below_minimum_is_not_cached(monkeypatch):
+    patch_sdk(monkeypatch)
+    counted = []
+
+    def count_tokens(self, contents):
+        counted.append(contents)
+        return type("Count", (), {"total_tokens": len(contents.split())})()
+
+    monkeypatch.setattr(module.genai.GenerativeModel, "count_tokens", count_tokens)
+    cache = GeminiContextCache(ttl=3600, refresh_margin=300, retry_after=0, min_tokens=3)
+
+    async def run():
+        short = [await cache.get_model("m", "short", "static") for _ in range(3)]
+        long = await cache.get_model("m", "long", "long enough static instruction")
+        return short, long
+
+    short, long = asyncio.run(run())
+    assert short == [None, None, None]
+    assert long is not None
+    # Размер каждой инструкции считается один раз, короткая в кэш не уходит
+    assert len(counted) == 2
+    assert [c.system_instruction for c in FakeCachedContent.created] == ["long enough static instruction"]
+    assert cache.stats()["too_small"] == {"m:short": 1}
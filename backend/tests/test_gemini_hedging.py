@@ -0,0 +1,46 @@
+"""
+Юнит-тесты хеджирования запросов Gemini (задержка по перцентилю и бюджет).
+"""
+
+from app.services.gemini_hedging import GeminiHedger
+
+
+def make_hedger(**overrides):
+    params = dict(enabled=True, percentile=0.9, min_delay=0.5, min_samples=5, budget_ratio=0.1)
+    params.update(overrides)
+    return GeminiHedger(**params)
+
+
+def test_no_hedging_until_enough_samples():
+    hedger = make_hedger()
+    for _ in range(4):
+        hedger.observe("analysis", "m", 1.0)
+    assert hedger.delay("analysis", "m") is None
+    hedger.observe("analysis", "m", 1.0)
+    assert hedger.delay("analysis", "m") == 1.0
+    assert hedger.delay("outfit_plan", "m") is None
+    assert make_hedger(enabled=False).delay("analysis", "m") is None
+
+
+def test_delay_is_percentile_with_floor():
+    hedger = make_hedger()
+    for latency in [0.1] * 9 + [3.0]:
+        hedger.observe("analysis", "m", latency)
+    assert hedger.delay("analysis", "m") == 3.0
+
+    fast = make_hedger()
+    for _ in range(10):
+        fast.observe("analysis", "m", 0.1)
+    assert fast.delay("analysis", "m") == 0.5
+
+
+def test_budget_limits_hedge_rate():
+    hedger = make_hedger(budget_ratio=0.05)
+    fired = 0
+    for _ in range(200):
+        hedger.record_request()
+        if hedger.try_acquire():
+            fired += 1
+    assert fired == 10
+    assert hedger.denied == 190
+    assert hedger.stats()["hedge_rate"] == 0.05
@@ -0,0 +1,104 @@
+"""
+Юнит-тесты пула ключей Gemini (без сети).
+"""
+
+import asyncio
+
+from app.services.gemini_key_pool import GeminiKeyPool
+
+
+def make_pool(rpm_limit=0, tpm_limit=0):
+    return GeminiKeyPool(
+        ["key-aaaa", "key-bbbb", "key-cccc"], quota_cooldown=60, rpm_limit=rpm_limit, tpm_limit=tpm_limit,
+    )
+
+
+def test_least_loaded_key_is_picked():
+    pool = make_pool()
+    first = pool.pick("m")
+    pool.start(first)
+    second = pool.pick("m")
+    pool.start(second)
+    third = pool.pick("m")
+    pool.start(third)
+    assert len({first.index, second.index, third.index}) == 3
+
+    pool.finish(first)
+    # Запросов за минуту у всех поровну — решает число запросов в полёте
+    assert pool.pick("m") is first
+
+
+def test_quota_cools_key_only_for_that_model():
+    pool = make_pool()
+    key = pool.keys[0]
+    pool.report_quota(key, "m")
+    assert pool.pick("m").index != 0
+    assert pool.pick("other") is key
+    assert not pool.exhausted("m")
+
+    for other in pool.keys[1:]:
+        pool.report_quota(other, "m")
+    assert pool.pick("m") is None
+    assert pool.exhausted("m")
+    assert pool.pick("m2") is not None
+
+
+def test_rpm_limit_spreads_load_without_marking_exhausted():
+    pool = make_pool(rpm_limit=1)
+    for _ in range(3):
+        key = pool.pick("m")
+        pool.start(key)
+        pool.finish(key)
+    assert pool.pick("m") is None
+    assert not pool.exhausted("m")
+    assert pool.pick("m", default_only=True) is None
+    assert list(pool.stats()["keys"]) == ["key0", "key1", "key2"]
+    assert pool.stats()["keys"]["key0"]["requests_last_minute"] == 1
+
+
+def test_token_usage_ranks_keys_and_tpm_limit_skips_them():
+    pool = make_pool(tpm_limit=1_000)
+    for key, tokens in zip(pool.keys, (900, 200, 1_000)):
+        pool.start(key)
+        pool.finish(key)
+        pool.add_tokens(key, tokens)
+
+    # Запросов поровну — берём ключ с наибольшим запасом токенов; key2 исчерпал TPM
+    assert pool.pick("m") is pool.keys[1]
+    assert pool.pick("m", exclude=pool.keys[1]) is pool.keys[0]
+    pool.add_tokens(pool.keys[0], 100)
+    assert pool.pick("m", exclude=pool.keys[1]) is None
+    assert not pool.exhausted("m")
+
+
+def test_non_default_key_sends_requests_with_its_own_client():
+    from google.generativeai import protos
+
+    class FakeClient:
+        def __init__(self):
+            self.requests = []
+
+        async def generate_content(self, request):
+            self.requests.append(request)
+            return protos.GenerateContentResponse(candidates=[{
+                "content": {"parts": [{"text": '{"ok": true}'}], "role": "model"},
+                "finish_reason": "STOP",
+            }])
+
+    key = make_pool().keys[1]
+    client = FakeClient()
+    key._async_client = client
+    model = key.generative_model("gemini-x", "static instruction")
+
+    response = asyncio.run(model.generate_content_async(
+        ["describe", "this"],
+        generation_config={"response_mime_type": "application/json", "temperature": 0.2},
+    ))
+
+    assert response.text == '{"ok": true}'
+    (request,) = client.requests
+    assert request.model == "models/gemini-x"
+    assert request.system_instruction.parts[0].text == "static instruction"
+    assert request.contents[-1].role == "user"
+    assert [p.text for p in request.contents[0].parts] == ["describe", "this"]
+    assert request.generation_config.response_mime_type == "application/json"
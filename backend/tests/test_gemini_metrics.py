@@ -0,0 +1,130 @@
+"""
+Юнит-тесты учёта вызовов Gemini: токены, стоимость, попытки и агрегаты.
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from app.api.v1 import ai
+from app.core.config import settings
+from app.services import gemini_service as service_module
+from app.services.gemini_metrics import (
+    GeminiCall,
+    GeminiMetrics,
+    current_endpoint,
+    estimate_cost,
+    set_current_endpoint,
+)
+from app.services.gemini_scheduler import GeminiOverloadedError
+from app.services.gemini_service import GeminiService
+
+
+@pytest.fixture
+def prices(monkeypatch):
+    monkeypatch.setattr(settings, "GEMINI_PRICES_PER_1M_TOKENS", {"flash": [1.0, 4.0]})
+    monkeypatch.setattr(settings, "GEMINI_CACHED_INPUT_PRICE_RATIO", 0.25)
+
+
+def usage(prompt, response, cached=0):
+    return SimpleNamespace(usage_metadata=SimpleNamespace(
+        prompt_token_count=prompt, candidates_token_count=response, cached_content_token_count=cached,
+    ))
+
+
+def test_cost_counts_cached_prompt_tokens_at_discount(prices):
+    assert estimate_cost("flash", 1_000_000, 0) == pytest.approx(1.0)
+    assert estimate_cost("flash", 1_000_000, 500_000, cached_tokens=400_000) == pytest.approx(0.6 + 0.1 + 2.0)
+    # Кэш не может быть больше промпта; неизвестная модель — 0
+    assert estimate_cost("flash", 100, 0, cached_tokens=1_000) == pytest.approx(25 / 1_000_000)
+    assert estimate_cost("unknown", 1_000_000, 1_000_000) == 0.0
+
+
+def test_call_sums_usage_and_attempts_and_shares_tokens(prices):
+    call = GeminiCall(operation="analyze_image", model="flash")
+    with call.attempt(queue_wait=0.5):
+        call.add_usage(usage(100, 20))
+    with call.attempt():
+        call.add_usage(usage(300, 40, cached=200))
+    call.add_usage(SimpleNamespace())
+
+    assert (call.attempts, call.retries) == (2, 1)
+    assert (call.prompt_tokens, call.response_tokens, call.cached_tokens) == (400, 60, 200)
+    assert call.queue_wait_ms == pytest.approx(500.0)
+
+    part = call.share(3)
+    assert (part.prompt_tokens, part.response_tokens, part.cached_tokens) == (133, 20, 66)
+    assert part.attempts == 2 and call.prompt_tokens == 400
+    assert call.as_dict()["cost_usd"] == pytest.approx(call.cost_usd, abs=1e-6)
+
+
+def test_metrics_aggregate_by_group_and_keep_recent_users(prices):
+    metrics = GeminiMetrics(max_users=2)
+
+    async def record(user_id, model, outcome, method="POST", path="/api/v1/ai/analyze/15"):
+        set_current_endpoint(method, path)
+        call = metrics.start("analyze_image", model, user_id)
+        call.add_usage(usage(1_000, 100))
+        metrics.finish(call, outcome)
+        return call
+
+    # Каждый asyncio.run — свой контекст, как у отдельного HTTP-запроса
+    caller = asyncio.run(record(1, "flash", "ok"))
+    asyncio.run(record(2, "flash", "error"))
+    asyncio.run(record(1, "lite", "ok", method="GET", path="/api/v1/ai/items/7/similar"))
+    asyncio.run(record(3, "flash", "ok"))
+
+    stats = metrics.stats(include_users=True)
+    assert stats["total"]["calls"] == 4
+    assert stats["total"]["outcomes"] == {"ok": 3, "error": 1}
+    assert stats["by_model"]["flash"]["calls"] == 3
+    assert stats["by_endpoint"]["POST /api/v1/ai/analyze/{id}"]["calls"] == 3
+    assert "GET /api/v1/ai/items/{id}/similar" in stats["by_endpoint"]
+    # Пользователь 2 вытеснен как давно не активный
+    assert list(stats["by_user"]) == ["1", "3"]
+    assert metrics.user_stats(1)["prompt_tokens"] == 2_000
+    assert metrics.user_stats(2)["calls"] == 0
+    assert "by_user" not in metrics.stats()
+    assert caller.outcome == "ok" and caller.latency_ms >= 0
+    assert current_endpoint() is None
+
+
+def test_tracked_records_outcome_of_each_call(monkeypatch):
+    metrics = GeminiMetrics(max_users=10)
+    monkeypatch.setattr(service_module, "gemini_metrics", metrics)
+    service = GeminiService()
+
+    async def returns(value):
+        return value
+
+    async def raises(error):
+        raise error
+
+    async def run():
+        await service._tracked(metrics.start("a", "m"), returns({"category": "jacket"}))
+        await service._tracked(metrics.start("a", "m"), returns(None))
+        await service._tracked(metrics.start("a", "m"), returns([None, {"category": "shoes"}]))
+        for error in (GeminiOverloadedError("busy"), ValueError("bad")):
+            with pytest.raises(type(error)):
+                await service._tracked(metrics.start("a", "m"), raises(error))
+
+    asyncio.run(run())
+
+    assert metrics.total.outcomes == {"ok": 2, "failed": 1, "overloaded": 1, "error": 1}
+    assert metrics.by_endpoint["background"].calls == 5
+
+
+def test_stats_endpoint_shows_global_metrics_only_to_admins(monkeypatch):
+    metrics = GeminiMetrics(max_users=10)
+    monkeypatch.setattr(ai, "gemini_metrics", metrics)
+    monkeypatch.setattr(settings, "GEMINI_STATS_ADMIN_USER_IDS", [7])
+    monkeypatch.setattr(settings, "GEMINI_METRICS_EXPOSE_USERS", True)
+    metrics.finish(metrics.start("analyze_image", "flash", 1), "ok")
+
+    mine = asyncio.run(ai.get_gemini_stats(current_user=SimpleNamespace(id=1)))
+    admin = asyncio.run(ai.get_gemini_stats(current_user=SimpleNamespace(id=7)))
+
+    assert mine == {"my_usage": metrics.user_stats(1)}
+    assert mine["my_usage"]["calls"] == 1
+    assert {"scheduler", "api_keys", "usage"} <= admin.keys()
+    assert list(admin["usage"]["by_user"]) == ["1"]
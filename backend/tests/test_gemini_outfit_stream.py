@@ -0,0 +1,285 @@
+"""
+Юнит-тесты потоковой генерации плана образов: слияние потоков частей
+параллельного режима и стрим одного вызова (модель и потоки частей —
+заглушки, без сети).
+"""
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import pytest
+
+from app.services import gemini_service as module
+from app.services.gemini_hedging import GeminiHedger
+from app.services.gemini_scheduler import GeminiOverloadedError, Priority
+from app.services.gemini_service import GeminiService
+
+
+def slot(name):
+    return {"slot_type": name, "search_query": name}
+
+
+def outfit(name, *slot_names):
+    return {"outfit_name": name, "description": "", "slots": [slot(s) for s in slot_names]}
+
+
+def stream_parts(service, monkeypatch, scripts):
+    """
+    Подменяет поток одного образа: scripts[part] — шаги (пауза, событие);
+    событие-исключение поднимается из потока части.
+    """
+    hints = service._concept_hints(len(scripts))
+
+    async def stream_outfit_plan(*args, parallel=True, concept_hint=None, **kwargs):
+        assert not parallel
+        for delay, event in scripts[hints.index(concept_hint)]:
+            await asyncio.sleep(delay)
+            if isinstance(event, BaseException):
+                raise event
+            yield event
+
+    monkeypatch.setattr(service, "stream_outfit_plan", stream_outfit_plan)
+
+
+def collect(service, outfits_count):
+    async def run():
+        return [
+            event async for event in service._stream_outfit_plan_parallel(
+                "casual", "men", None, outfits_count, None, None, 1, None, Priority.INTERACTIVE,
+            )
+        ]
+
+    return asyncio.run(run())
+
+
+def part(name, delays, *slot_names):
+    """Поток образа: слоты через паузы delays (число — одна пауза на все), затем план."""
+    if not isinstance(delays, (list, tuple)):
+        delays = [delays] * (len(slot_names) + 1)
+    steps = [(delays[i], ("slot", 0, i, slot(s))) for i, s in enumerate(slot_names)]
+    steps.append((delays[-1], ("plan", {"outfits": [outfit(name, *slot_names)]})))
+    return steps
+
+
+def test_parts_interleave_and_are_numbered_by_first_slot(monkeypatch):
+    service = GeminiService()
+    stream_parts(service, monkeypatch, [
+        part("slow", [0.03, 0.06, 0.0], "top", "shoes"),
+        part("fast", [0.0, 0.04, 0.0], "bottom", "belt"),
+        part("medium", [0.015, 0.04, 0.0], "coat", "hat"),
+    ])
+
+    events = collect(service, 3)
+
+    slots = [event[1:3] + (event[3]["slot_type"],) for event in events if event[0] == "slot"]
+    # Слоты разных образов приходят вперемешку, по мере готовности
+    assert slots == [
+        (0, 0, "bottom"), (1, 0, "coat"), (2, 0, "top"),
+        (0, 1, "belt"), (1, 1, "hat"), (2, 1, "shoes"),
+    ]
+    assert events[-1][0] == "plan"
+    assert [o["outfit_name"] for o in events[-1][1]["outfits"]] == ["fast", "medium", "slow"]
+
+
+def test_part_failing_before_first_slot_drops_out(monkeypatch):
+    service = GeminiService()
+    stream_parts(service, monkeypatch, [
+        part("first", 0.01, "top"),
+        [(0.0, RuntimeError("boom"))],
+        part("third", 0.02, "shoes"),
+    ])
+
+    events = collect(service, 3)
+
+    assert [e[1] for e in events if e[0] == "slot"] == [0, 1]
+    assert [o["outfit_name"] for o in events[-1][1]["outfits"]] == ["first", "third"]
+
+
+def test_part_failing_after_slots_is_assembled_from_received_slots(monkeypatch):
+    service = GeminiService()
+    stream_parts(service, monkeypatch, [
+        part("first", 0.0, "top", "shoes"),
+        [
+            (0.01, ("slot", 0, 0, slot("coat"))),
+            (0.0, ("slot", 0, 1, slot("scarf"))),
+            (0.0, ("slot", 0, 3, slot("hat"))),
+            (0.0, RuntimeError("stream cut")),
+        ],
+    ])
+
+    events = collect(service, 2)
+
+    plan = events[-1][1]
+    assert plan["outfits"][0]["outfit_name"] == "first"
+    # Из упавшего образа — только непрерывный префикс слотов
+    assert plan["outfits"][1] == {
+        "outfit_name": "Look 2",
+        "description": "",
+        "slots": [slot("coat"), slot("scarf")],
+    }
+
+
+def test_overload_raised_only_when_every_part_fails(monkeypatch):
+    service = GeminiService()
+    overloaded = [(0.0, GeminiOverloadedError("busy"))]
+
+    stream_parts(service, monkeypatch, [overloaded, part("ok", 0.01, "top")])
+    assert [o["outfit_name"] for o in collect(service, 2)[-1][1]["outfits"]] == ["ok"]
+
+    stream_parts(service, monkeypatch, [overloaded, [(0.0, RuntimeError("boom"))]])
+    with pytest.raises(GeminiOverloadedError):
+        collect(service, 2)
+
+    stream_parts(service, monkeypatch, [[(0.0, RuntimeError("boom"))], [(0.0, ("plan", None))]])
+    assert collect(service, 2) == [("plan", None)]
+
+
+class SlowModel:
+    """
+    Модель-заглушка: стримит text кусками по chunk символов с паузой pause,
+    перед первым куском — пауза first.
+    """
+
+    def __init__(self, text, chunk=16, pause=0.0, first=0.0):
+        self.text = text
+        self.chunk = chunk
+        self.pause = pause
+        self.first = first
+        self.finished = False
+
+    async def generate_content_async(self, contents, generation_config=None, stream=False):
+        async def chunks():
+            await asyncio.sleep(self.first)
+            for i in range(0, len(self.text), self.chunk):
+                await asyncio.sleep(self.pause)
+                yield SimpleNamespace(text=self.text[i:i + self.chunk])
+            self.finished = True
+
+        return chunks()
+
+
+@pytest.fixture
+def single_stream(monkeypatch):
+    """Стрим одного вызова: слот планировщика и ключ пишут в log."""
+    service = GeminiService()
+    service.model = object()
+    log = []
+
+    @asynccontextmanager
+    async def slot(user_id, priority):
+        log.append("slot")
+        try:
+            yield 0.0
+        finally:
+            log.append("released")
+
+    pool = SimpleNamespace(
+        start=lambda key: log.append("key start"),
+        finish=lambda key: log.append("key finish"),
+        add_tokens=lambda key, tokens: None,
+    )
+    monkeypatch.setattr(module, "gemini_scheduler", SimpleNamespace(slot=slot))
+    monkeypatch.setattr(module, "gemini_key_pool", pool)
+    monkeypatch.setattr(module.model_router, "report_success", lambda model, latency: log.append("success"))
+    monkeypatch.setattr(service, "_pick_model", lambda *args: ("test-model", SimpleNamespace(label="key")))
+
+    def use(model):
+        """model — одна модель-заглушка или словарь имя модели -> заглушка."""
+        async def get_model(model_name, instruction, key):
+            return model[model_name] if isinstance(model, dict) else model
+
+        monkeypatch.setattr(service, "_get_model", get_model)
+
+    return SimpleNamespace(service=service, log=log, use=use)
+
+
+def plan_stream(service):
+    return service.stream_outfit_plan("casual", outfits_count=1, parallel=False)
+
+
+def test_slot_released_when_stream_ends_not_when_consumer_does(single_stream):
+    single_stream.use(SlowModel(json.dumps({"outfits": [outfit("City", "top", "shoes")]})))
+
+    async def run():
+        events = []
+        async for event in plan_stream(single_stream.service):
+            events.append(event)
+            if len(events) == 1:
+                # Медленный потребитель: модель тем временем дописывает ответ
+                await asyncio.sleep(0.05)
+                assert single_stream.log == ["slot", "key start", "key finish", "released", "success"]
+        return events
+
+    events = asyncio.run(run())
+    assert [event[0] for event in events] == ["slot", "slot", "plan"]
+
+
+def test_abandoned_stream_does_not_hold_slot(single_stream):
+    single_stream.use(SlowModel(json.dumps({"outfits": [outfit("City", "top", "shoes")]}), pause=0.01))
+
+    async def run():
+        stream = plan_stream(single_stream.service)
+        async for event in stream:
+            assert event[0] == "slot"
+            break
+        # Генератор брошен без aclose и ещё жив — слот всё равно освобождается с концом стрима
+        await asyncio.sleep(0.2)
+        log = list(single_stream.log)
+        await stream.aclose()
+        return log
+
+    assert asyncio.run(run()) == ["slot", "key start", "key finish", "released", "success"]
+
+
+@pytest.fixture
+def hedging(single_stream, monkeypatch):
+    """Хедж через 20 мс без первого куска от "primary" — на "hedge" другим ключом."""
+    hedger = GeminiHedger(enabled=True, percentile=0.5, min_delay=0.02, min_samples=1, budget_ratio=1.0)
+    hedger.observe("outfit_plan", "primary", 0.02)
+    monkeypatch.setattr(module, "gemini_hedger", hedger)
+    monkeypatch.setattr(single_stream.service, "_pick_model", lambda *args: ("primary", SimpleNamespace(label="key0")))
+    monkeypatch.setattr(
+        single_stream.service, "_hedge_target", lambda *args: ("hedge", SimpleNamespace(label="key1"))
+    )
+    return hedger
+
+
+def plan_text(name):
+    return json.dumps({"outfits": [outfit(name, "top", "shoes")]})
+
+
+def test_stream_without_first_chunk_is_hedged_and_first_emitter_wins(single_stream, hedging):
+    models = {"primary": SlowModel(plan_text("Slow"), first=0.3), "hedge": SlowModel(plan_text("Fast"))}
+    single_stream.use(models)
+    call = module.GeminiCall()
+
+    async def run():
+        return [event async for event in single_stream.service.stream_outfit_plan(
+            "casual", outfits_count=1, parallel=False, call_info=call,
+        )]
+
+    events = asyncio.run(run())
+
+    assert events[-1][1]["outfits"][0]["outfit_name"] == "Fast"
+    assert (hedging.hedges, hedging.hedge_wins, call.hedges, call.model) == (1, 1, 1, "hedge")
+    # Проигравший стрим отменён и отдал свой слот
+    assert not models["primary"].finished
+    assert single_stream.log.count("slot") == single_stream.log.count("released") == 2
+
+
+def test_primary_emitting_first_cancels_the_hedge(single_stream, hedging):
+    models = {
+        "primary": SlowModel(plan_text("Primary"), first=0.04, pause=0.01),
+        "hedge": SlowModel(plan_text("Hedge"), first=0.3),
+    }
+    single_stream.use(models)
+
+    async def run():
+        return [event async for event in plan_stream(single_stream.service)]
+
+    events = asyncio.run(run())
+
+    assert events[-1][1]["outfits"][0]["outfit_name"] == "Primary"
+    assert (hedging.hedges, hedging.hedge_wins) == (1, 0)
+    assert not models["hedge"].finished
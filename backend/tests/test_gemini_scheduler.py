@@ -0,0 +1,91 @@
+"""
+Юнит-тесты планировщика вызовов Gemini (без сети).
+"""
+import asyncio
+
+import pytest
+
+from app.services.gemini_scheduler import (
+    GeminiOverloadedError,
+    GeminiScheduler,
+    Priority,
+)
+
+
+def make_scheduler(concurrency: int = 1, max_wait: float = 5.0) -> GeminiScheduler:
+    scheduler = GeminiScheduler(
+        max_concurrency=concurrency,
+        max_queue_wait={Priority.INTERACTIVE: max_wait, Priority.BACKGROUND: max_wait},
+    )
+    # Быстрые "вызовы", чтобы оценка ожидания не срабатывала раньше времени
+    scheduler._avg_service_time = 0.01
+    return scheduler
+
+
+async def run_calls(scheduler, calls, order):
+    """calls: список (user_id, priority); первый вызов держит слот, пока все встанут в очередь."""
+    gate = asyncio.Event()
+
+    async def call(user_id, priority, label, hold):
+        async with scheduler.slot(user_id, priority):
+            order.append(label)
+            if hold:
+                await gate.wait()
+
+    tasks = [asyncio.create_task(call(u, p, f"{u}:{i}", i == 0)) for i, (u, p) in enumerate(calls)]
+    await asyncio.sleep(0.01)
+    gate.set()
+    await asyncio.gather(*tasks)
+
+
+class TestScheduler:
+    def test_round_robin_between_users(self):
+        scheduler = make_scheduler()
+        order = []
+        calls = [(1, Priority.INTERACTIVE)] * 4 + [(2, Priority.INTERACTIVE)] * 2
+        asyncio.run(run_calls(scheduler, calls, order))
+        # После первого вызова пользователи 1 и 2 чередуются
+        assert [label.split(":")[0] for label in order] == ["1", "1", "2", "1", "2", "1"]
+
+    def test_interactive_before_background(self):
+        scheduler = make_scheduler()
+        order = []
+        calls = [
+            (1, Priority.INTERACTIVE),
+            (2, Priority.BACKGROUND),
+            (3, Priority.BACKGROUND),
+            (4, Priority.INTERACTIVE),
+        ]
+        asyncio.run(run_calls(scheduler, calls, order))
+        assert [label.split(":")[0] for label in order] == ["1", "4", "2", "3"]
+
+    def test_sheds_when_estimated_wait_too_long(self):
+        scheduler = make_scheduler(max_wait=1.0)
+        scheduler._avg_service_time = 10.0
+
+        async def scenario():
+            async with scheduler.slot(1):
+                with pytest.raises(GeminiOverloadedError):
+                    async with scheduler.slot(2):
+                        pass
+
+        asyncio.run(scenario())
+        assert scheduler.stats()["priorities"]["interactive"]["shed"] == 1
+        assert scheduler.stats()["active"] == 0
+
+    def test_sheds_when_queue_wait_exceeded(self):
+        scheduler = make_scheduler(max_wait=0.05)
+        scheduler._avg_service_time = 0.001
+
+        async def scenario():
+            async with scheduler.slot(1):
+                with pytest.raises(GeminiOverloadedError):
+                    async with scheduler.slot(2):
+                        pass
+            # Отвалившийся по таймауту не должен занимать слот
+            async with scheduler.slot(3):
+                pass
+
+        asyncio.run(scenario())
+        assert scheduler.stats()["queued"]["interactive"] == 0
+        assert scheduler.stats()["active"] == 0
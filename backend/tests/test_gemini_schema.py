@@ -0,0 +1,56 @@
+"""
+Юнит-тесты разбора ответов Gemini по схеме (без сети).
+"""
+import json
+
+from app.services.gemini_schema import parse_outfit_plan
+
+PLAN = {
+    "outfits": [
+        {
+            "outfit_name": "Smart casual",
+            "slots": [
+                {"slot_type": "top", "search_query": "white oxford shirt"},
+                {"slot_type": "shoes", "search_query": "brown loafers"},
+            ],
+        },
+        {
+            "outfit_name": "Weekend",
+            "slots": [
+                {"slot_type": "bottom", "search_query": "navy chinos"},
+                {"slot_type": "shoes", "description": "white sneakers", "search_query": "white leather sneakers"},
+            ],
+        },
+    ]
+}
+
+
+def test_complete_plan_is_parsed_as_is():
+    plan = parse_outfit_plan(json.dumps(PLAN))
+    assert [o.outfit_name for o in plan.outfits] == ["Smart casual", "Weekend"]
+
+
+def test_plan_truncated_mid_slot_keeps_complete_slots():
+    text = json.dumps(PLAN)
+    # Обрыв внутри второго слота второго образа: search_query ещё не написан
+    plan = parse_outfit_plan(text[: text.index('"search_query": "white leather')])
+    assert [o.outfit_name for o in plan.outfits] == ["Smart casual", "Weekend"]
+    assert [s.search_query for s in plan.outfits[0].slots] == ["white oxford shirt", "brown loafers"]
+    assert [s.search_query for s in plan.outfits[1].slots] == ["navy chinos"]
+
+
+def test_plan_truncated_before_first_slot_of_outfit_drops_outfit():
+    text = json.dumps(PLAN)
+    plan = parse_outfit_plan(text[: text.index('"slot_type": "bottom"')])
+    assert [o.outfit_name for o in plan.outfits] == ["Smart casual"]
+
+
+def test_plan_truncated_mid_value_drops_partial_query():
+    text = json.dumps(PLAN)
+    plan = parse_outfit_plan(text[: text.index("brown loafers") + len("brown lo")])
+    assert [s.search_query for s in plan.outfits[0].slots] == ["white oxford shirt"]
+
+
+def test_plan_without_complete_outfits_is_none():
+    assert parse_outfit_plan('{"outfits": [{"outfit_name": "A", "slots": [{"slot_type": "to') is None
+    assert parse_outfit_plan("") is None
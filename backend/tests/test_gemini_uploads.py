@@ -0,0 +1,106 @@
+"""
+Юнит-тесты загрузок в Gemini Files API: переиспользование хэндлов и
+загрузки, которые перестали ждать (без сети).
+"""
+import asyncio
+import threading
+import time
+
+import pytest
+
+from app.services import gemini_service as module
+from app.services.gemini_service import GeminiService
+from app.services.image_service import PreparedImage
+
+
+class FakeFile:
+    def __init__(self, name):
+        self.name = name
+        self.expiration_time = None
+
+
+@pytest.fixture
+def uploads(monkeypatch):
+    """Фейковый Files API: считает загрузки и удаления."""
+    state = {"uploaded": [], "deleted": [], "delay": 0.0, "fail": 0}
+    lock = threading.Lock()
+
+    def upload_file(*args, **kwargs):
+        time.sleep(state["delay"])
+        with lock:
+            if state["fail"]:
+                state["fail"] -= 1
+                raise RuntimeError("upload failed")
+            name = f"files/{len(state['uploaded'])}"
+            state["uploaded"].append(name)
+        return FakeFile(name)
+
+    def delete_file(name):
+        state["deleted"].append(name)
+
+    monkeypatch.setattr(module.genai, "upload_file", upload_file)
+    monkeypatch.setattr(module.genai, "delete_file", delete_file)
+    return state
+
+
+def prepared(data=b"image-bytes"):
+    return PreparedImage(data=data, mime_type="image/jpeg", width=10, height=10, original_bytes=len(data))
+
+
+def test_concurrent_requests_upload_same_content_once(uploads):
+    service = GeminiService()
+    uploads["delay"] = 0.05
+
+    async def main():
+        files = await asyncio.gather(
+            *(service._get_uploaded_file("a.jpg", prepared()) for _ in range(5))
+        )
+        again = await service._get_uploaded_file("b.jpg", prepared())
+        return files, again
+
+    files, again = asyncio.run(main())
+    assert uploads["uploaded"] == ["files/0"]
+    assert {f.name for f in files} == {"files/0"}
+    assert again is files[0]
+
+
+def test_upload_finished_after_cancellation_is_kept(uploads):
+    service = GeminiService()
+    uploads["delay"] = 0.1
+
+    async def main():
+        task = asyncio.create_task(service._get_uploaded_file("a.jpg", prepared()))
+        await asyncio.sleep(0.03)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # Загрузка в потоке завершается уже без ожидающего запроса
+        await asyncio.sleep(0.2)
+        return await service._get_uploaded_file("a.jpg", prepared())
+
+    reused = asyncio.run(main())
+    assert uploads["uploaded"] == ["files/0"]
+    assert reused.name == "files/0"
+    assert uploads["deleted"] == []
+
+
+def test_new_caller_waits_on_lock_held_by_queued_waiter(uploads):
+    service = GeminiService()
+    uploads["delay"] = 0.05
+    uploads["fail"] = 1
+
+    async def main():
+        first = asyncio.create_task(service._get_uploaded_file("a.jpg", prepared()))
+        await asyncio.sleep(0.01)
+        second = asyncio.create_task(service._get_uploaded_file("a.jpg", prepared()))
+        with pytest.raises(RuntimeError):
+            await first
+        # Лок только что освобождён, второй запрос ещё не проснулся:
+        # новый запрос должен встать в ту же очередь, а не грузить параллельно
+        third = asyncio.create_task(service._get_uploaded_file("a.jpg", prepared()))
+        return await asyncio.gather(second, third)
+
+    files = asyncio.run(main())
+    assert uploads["uploaded"] == ["files/0"]
+    assert [f.name for f in files] == ["files/0", "files/0"]
+    assert service._upload_locks == {}
@@ -0,0 +1,60 @@
+"""
+Юнит-тесты подготовки изображений для Gemini (Pillow, временные файлы).
+"""
+import io
+
+from PIL import Image
+
+from app.services.image_service import prepare_image
+
+
+def save(tmp_path, img, name, **kwargs):
+    path = tmp_path / name
+    img.save(path, **kwargs)
+    return str(path)
+
+
+def test_large_photo_downscaled_to_max_edge_as_jpeg(tmp_path):
+    path = save(tmp_path, Image.new("RGB", (4000, 3000), "navy"), "big.jpg", quality=95)
+
+    prepared = prepare_image(path, max_edge=1024, image_format="jpeg", quality=85)
+
+    assert (prepared.width, prepared.height) == (1024, 768)
+    assert prepared.mime_type == "image/jpeg"
+    assert len(prepared.data) < prepared.original_bytes
+    with Image.open(io.BytesIO(prepared.data)) as img:
+        assert img.format == "JPEG"
+        assert img.size == (1024, 768)
+
+
+def test_small_photo_is_not_upscaled(tmp_path):
+    path = save(tmp_path, Image.new("RGB", (300, 200), "white"), "small.png")
+    prepared = prepare_image(path, max_edge=1024, image_format="JPEG", quality=85)
+    assert (prepared.width, prepared.height) == (300, 200)
+
+
+def test_exif_orientation_applied_before_resize(tmp_path):
+    img = Image.new("RGB", (2000, 1000), "red")
+    exif = img.getexif()
+    # 6 — снято с поворотом на 90°: после поворота фото вертикальное
+    exif[0x0112] = 6
+    path = save(tmp_path, img, "rotated.jpg", exif=exif.tobytes())
+
+    prepared = prepare_image(path, max_edge=1000, image_format="JPEG", quality=85)
+
+    assert (prepared.width, prepared.height) == (500, 1000)
+
+
+def test_transparency_flattened_on_white_for_jpeg_and_kept_for_webp(tmp_path):
+    path = save(tmp_path, Image.new("RGBA", (100, 100), (255, 0, 0, 0)), "clear.png")
+
+    jpeg = prepare_image(path, max_edge=1024, image_format="JPEG", quality=90)
+    with Image.open(io.BytesIO(jpeg.data)) as img:
+        assert img.mode == "RGB"
+        assert all(channel > 240 for channel in img.getpixel((50, 50)))
+
+    webp = prepare_image(path, max_edge=1024, image_format="webp", quality=90)
+    assert webp.mime_type == "image/webp"
+    with Image.open(io.BytesIO(webp.data)) as img:
+        assert img.mode == "RGBA"
+        assert img.getpixel((50, 50))[3] == 0
@@ -0,0 +1,281 @@
+"""
+Юнит-тесты фонового анализа вещей: воркер, claim/release, analyze_now,
+перезапуск и перегрузка Gemini (временная sqlite, анализ — заглушка).
+"""
+import asyncio
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+
+from app.db.session import Base
+from app.models.ai_analysis import AIAnalysis
+from app.models.clothing import ClothingItem
+from app.services import item_analysis_service as module
+from app.services.gemini_scheduler import GeminiOverloadedError, Priority
+from app.services.item_analysis_service import (
+    ANALYSIS_DONE,
+    ANALYSIS_FAILED,
+    ANALYSIS_PENDING,
+    ANALYSIS_PROCESSING,
+    ItemAnalysisError,
+    ItemAnalysisService,
+    find_near_duplicate_analysis,
+)
+
+ANALYSIS = {"category": "jacket", "tags": ["jacket"]}
+
+
+@pytest.fixture
+def db(monkeypatch, tmp_path):
+    """Фабрика сессий на временной sqlite вместо async_session сервиса."""
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'items.db'}", poolclass=NullPool)
+    factory = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    monkeypatch.setattr(module, "async_session", factory)
+
+    async def create_all():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+
+    asyncio.run(create_all())
+    return factory
+
+
+@pytest.fixture
+def analyses(monkeypatch):
+    """Заглушка analyze_item: по очереди отдаёт заданные исходы, пишет вызовы."""
+    state = {"calls": [], "outcomes": [], "gate": None}
+
+    async def analyze_item(db, item, user_id, priority=Priority.INTERACTIVE, task="analysis", current_only=False):
+        state["calls"].append((item.id, priority, task))
+        if state["gate"] is not None:
+            await state["gate"].wait()
+        outcome = state["outcomes"].pop(0) if state["outcomes"] else ANALYSIS
+        if isinstance(outcome, Exception):
+            raise outcome
+        item.analysis_status = ANALYSIS_DONE
+        await db.commit()
+        return outcome
+
+    monkeypatch.setattr(module, "analyze_item", analyze_item)
+    return state
+
+
+async def add_items(factory, *statuses):
+    """Вещи с заданными analysis_status; pending/processing подхватит start() сервиса."""
+    async with factory() as session:
+        items = [
+            ClothingItem(user_id=1, image_url=f"/img/{i}.jpg", analysis_status=status)
+            for i, status in enumerate(statuses)
+        ]
+        session.add_all(items)
+        await session.commit()
+        return [item.id for item in items]
+
+
+async def status_of(factory, item_id):
+    async with factory() as session:
+        result = await session.execute(select(ClothingItem.analysis_status).where(ClothingItem.id == item_id))
+        return result.scalar_one()
+
+
+async def wait_for(predicate, timeout=2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+def test_worker_analyzes_enqueued_item_in_background(db, analyses):
+    async def run():
+        service = ItemAnalysisService(workers=1)
+        (item_id,) = await add_items(db, None)
+        assert service.enqueue(item_id, 1)
+        # Повторная постановка той же вещи игнорируется
+        assert not service.enqueue(item_id, 1)
+        result = await service._jobs[item_id].future
+        status = await status_of(db, item_id)
+        await service.shutdown()
+        return result, status, service
+
+    result, status, service = asyncio.run(run())
+    assert result == ANALYSIS
+    assert status == ANALYSIS_DONE
+    assert analyses["calls"] == [(1, Priority.BACKGROUND, "analysis")]
+    assert service.completed == 1
+
+
+def test_start_requeues_pending_and_processing_items(db, analyses):
+    async def run():
+        service = ItemAnalysisService(workers=2)
+        ids = await add_items(db, ANALYSIS_PENDING, ANALYSIS_PROCESSING, ANALYSIS_DONE, None)
+        service.start()
+        await wait_for(lambda: service.completed == 2)
+        statuses = [await status_of(db, item_id) for item_id in ids]
+        await service.shutdown()
+        return ids, statuses
+
+    ids, statuses = asyncio.run(run())
+    assert sorted(item_id for item_id, _, _ in analyses["calls"]) == ids[:2]
+    assert statuses == [ANALYSIS_DONE, ANALYSIS_DONE, ANALYSIS_DONE, None]
+
+
+def test_overload_requeues_with_delay_instead_of_failing(db, analyses):
+    analyses["outcomes"] = [GeminiOverloadedError("busy", retry_after=0.0)]
+
+    async def run():
+        service = ItemAnalysisService(workers=1, overload_retry_seconds=0.05)
+        (item_id,) = await add_items(db, None)
+        service.enqueue(item_id, 1)
+        first = await service._jobs[item_id].future
+        status_after_overload = await status_of(db, item_id)
+        assert service.stats()["waiting_retry"] == 1
+        await wait_for(lambda: service.completed == 1)
+        status = await status_of(db, item_id)
+        await service.shutdown()
+        return first, status_after_overload, status, service
+
+    first, status_after_overload, status, service = asyncio.run(run())
+    # Ждущие не висят всю паузу: получают None и анализируют сами
+    assert first is None
+    assert status_after_overload == ANALYSIS_PENDING
+    assert status == ANALYSIS_DONE
+    assert len(analyses["calls"]) == 2
+    assert service.failed == 0
+    assert service.requeued == 1
+
+
+def test_overload_fails_after_max_retries(db, analyses):
+    analyses["outcomes"] = [GeminiOverloadedError("busy", retry_after=0.0) for _ in range(3)]
+
+    async def run():
+        service = ItemAnalysisService(workers=1, overload_retry_seconds=0.01, overload_max_retries=2)
+        (item_id,) = await add_items(db, None)
+        service.enqueue(item_id, 1)
+        await wait_for(lambda: service.failed == 1)
+        status = await status_of(db, item_id)
+        await service.shutdown()
+        return status, service
+
+    status, service = asyncio.run(run())
+    assert status == ANALYSIS_FAILED
+    assert len(analyses["calls"]) == 3
+    assert service.requeued == 2
+
+
+def test_claim_takes_only_jobs_not_started_by_worker(db, analyses):
+    async def run():
+        service = ItemAnalysisService(workers=1)
+        analyses["gate"] = asyncio.Event()
+        first, second = await add_items(db, None, None)
+        service.enqueue(first, 1)
+        service.enqueue(second, 1)
+        await wait_for(lambda: service.is_running(first))
+
+        assert service.claim(first) is None
+        job = service.claim(second)
+        assert job is not None
+        assert service.claim(second) is None
+        service.release(job, {"category": "shirt"})
+        released = await job.future
+
+        analyses["gate"].set()
+        await service._queue.join()
+        await service.shutdown()
+        return released, service
+
+    released, service = asyncio.run(run())
+    assert released == {"category": "shirt"}
+    # Забранную задачу воркер пропустил
+    assert [item_id for item_id, _, _ in analyses["calls"]] == [1]
+    assert service.claimed == 1
+
+
+def test_analyze_now_awaits_running_job_and_claims_queued_one(db, analyses):
+    async def run():
+        service = ItemAnalysisService(workers=1)
+        analyses["gate"] = asyncio.Event()
+        first, second = await add_items(db, None, None)
+        service.enqueue(first, 1)
+        service.enqueue(second, 1)
+        await wait_for(lambda: service.is_running(first))
+
+        async def analyze_now(item_id):
+            async with db() as session:
+                item = await session.get(ClothingItem, item_id)
+                return await service.analyze_now(session, item, 1)
+
+        waiting = asyncio.create_task(analyze_now(first))
+        claiming = asyncio.create_task(analyze_now(second))
+        await wait_for(lambda: len(analyses["calls"]) == 2)
+        assert not waiting.done()
+        analyses["gate"].set()
+        awaited, claimed = await asyncio.gather(waiting, claiming)
+        await service._queue.join()
+        await service.shutdown()
+        return awaited, claimed
+
+    awaited, claimed = asyncio.run(run())
+    assert awaited == ANALYSIS
+    assert claimed == ANALYSIS
+    # Первую вещь проанализировал воркер, вторую — запрос, с интерактивным приоритетом
+    assert sorted(analyses["calls"]) == [(1, Priority.BACKGROUND, "analysis"), (2, Priority.INTERACTIVE, "analysis")]
+
+
+def test_jobs_without_gemini_keep_or_fail_instead_of_crashing(db, analyses, monkeypatch):
+    monkeypatch.setattr(module, "gemini_service", None)
+    analyses["outcomes"] = [ItemAnalysisError("Gemini AI service not available", status_code=503)]
+
+    async def run():
+        service = ItemAnalysisService(workers=1)
+        analyzed, new = await add_items(db, ANALYSIS_DONE, None)
+        async with db() as session:
+            session.add(AIAnalysis(
+                user_id=1, clothing_item_id=analyzed, prompt="p", response="r",
+                analysis_data=ANALYSIS, analysis_version="old",
+            ))
+            await session.commit()
+
+        service.enqueue(analyzed, 1, reanalysis=True)
+        service.enqueue(new, 1)
+        kept = await service._jobs[analyzed].future
+        await wait_for(lambda: service.failed == 1)
+        statuses = [await status_of(db, analyzed), await status_of(db, new)]
+        await service.shutdown()
+        return kept, statuses
+
+    kept, statuses = asyncio.run(run())
+    # Переанализ без Gemini невозможен — остаётся прежний анализ
+    assert kept == ANALYSIS
+    assert statuses == [ANALYSIS_DONE, ANALYSIS_FAILED]
+    assert [item_id for item_id, _, _ in analyses["calls"]] == [2]
+
+
+def test_near_duplicate_reused_only_with_matching_colors(db):
+    navy, green = "1a1a3c" * 9, "2e8b57" * 9
+
+    async def run():
+        async with db() as session:
+            rows = [
+                AIAnalysis(
+                    user_id=42, prompt="p", response="r", image_phash="00ff00ff00ff00ff",
+                    analysis_data={**ANALYSIS, "colors": [name]}, image_colors=colors,
+                )
+                for name, colors in (("legacy", None), ("navy", navy), ("green", green))
+            ]
+            session.add_all(rows)
+            await session.commit()
+
+            found = [
+                await find_near_duplicate_analysis(session, 42, "00ff00ff00ff00fe", colors)
+                for colors in ("1c1a3e" * 9, green, "ffffff" * 9, None)
+            ]
+        return [match and (match[0].analysis_data["colors"], match[1]) for match in found]
+
+    navy_match, green_match, white, unknown = asyncio.run(run())
+    # Хэш у всех трёх рядом; решает цвет, а анализ без подписи не годится
+    assert navy_match == (["navy"], 1)
+    assert green_match == (["green"], 1)
+    assert white is None and unknown is None
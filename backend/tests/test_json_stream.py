@@ -0,0 +1,73 @@
+"""
+Юнит-тесты потокового парсера JSON (без БД и Gemini).
+"""
+import json
+
+from app.services.json_stream import ANY_INDEX, IncrementalJSONParser, repair_truncated_json
+
+SLOT_PATTERN = [["outfits", ANY_INDEX, "slots", ANY_INDEX]]
+
+PLAN = {
+    "outfits": [
+        {
+            "outfit_name": "A {tricky} \"name\"",
+            "slots": [
+                {"slot_type": "top", "must_have": ["wool"], "search_query": "shirt [white]"},
+                {"slot_type": "shoes", "must_have": [], "search_query": "loafers"},
+            ],
+        },
+        {"outfit_name": "B", "slots": [{"slot_type": "bottom", "search_query": "chinos"}]},
+    ]
+}
+
+
+def feed_in_chunks(parser, text, size):
+    events = []
+    for i in range(0, len(text), size):
+        events.extend(parser.feed(text[i:i + size]))
+    return events
+
+
+def test_slots_emitted_with_indices_for_any_chunking():
+    text = "```json\n" + json.dumps(PLAN, ensure_ascii=False) + "\n```"
+    for size in (1, 3, 17, len(text)):
+        parser = IncrementalJSONParser(SLOT_PATTERN)
+        events = feed_in_chunks(parser, text, size)
+        assert [(path[1], path[3]) for path, _ in events] == [(0, 0), (0, 1), (1, 0)]
+        assert events[0][1] == PLAN["outfits"][0]["slots"][0]
+        assert parser.done
+
+
+def test_slot_emitted_before_document_ends():
+    text = json.dumps(PLAN)
+    cut = text.index("loafers")
+    parser = IncrementalJSONParser(SLOT_PATTERN)
+    events = parser.feed(text[:cut])
+    assert len(events) == 1
+    assert events[0][1]["slot_type"] == "top"
+    assert not parser.done
+
+
+def test_truncated_output_keeps_completed_slots():
+    text = json.dumps(PLAN)
+    parser = IncrementalJSONParser(SLOT_PATTERN)
+    events = parser.feed(text[: text.index("chinos")])
+    assert [e[1]["slot_type"] for e in events] == ["top", "shoes"]
+    assert not parser.done
+
+
+def test_repair_any_truncation_yields_valid_json():
+    text = json.dumps(PLAN, ensure_ascii=False)
+    for cut in range(1, len(text) + 1):
+        repaired = repair_truncated_json("```json\n" + text[:cut])
+        json.loads(repaired)
+    assert json.loads(repair_truncated_json(text + "\n```")) == PLAN
+
+
+def test_repair_drops_partial_string_value_and_dangling_key():
+    # Обрезанное значение не должно попасть в анализ и кэш
+    assert json.loads(repair_truncated_json('{"category": "jacket", "color": "bl')) == {"category": "jacket"}
+    assert json.loads(repair_truncated_json('{"colors": ["black", "whi')) == {"colors": ["black"]}
+    assert json.loads(repair_truncated_json('{"category": "jacket", "col')) == {"category": "jacket"}
+    assert json.loads(repair_truncated_json('{"category": "jacket", "size": 4')) == {"category": "jacket"}
+    assert repair_truncated_json("no json here") is None
@@ -0,0 +1,43 @@
+"""
+Юнит-тесты маршрутизатора моделей Gemini (без сети).
+"""
+
+from app.services.model_router import ModelRouter, is_quota_error
+
+
+def make_router():
+    return ModelRouter(
+        routes={"analysis": ["a", "b", "c"], "reanalysis": ["cheap", "a"]},
+        quota_cooldown=60,
+        error_cooldown=10,
+        error_threshold=2,
+    )
+
+
+def test_quota_moves_traffic_to_next_model():
+    router = make_router()
+    assert router.pick("analysis") == "a"
+    router.report_quota("a", Exception("429 quota exceeded"))
+    assert router.pick("analysis") == "b"
+    assert router.pick("analysis", exclude=["b"]) == "c"
+    # a в cool-down и для других маршрутов
+    router.report_quota("cheap", Exception("429"))
+    assert router.pick("reanalysis") is None
+    assert router.retry_after("reanalysis") > 50
+
+
+def test_consecutive_errors_open_cooldown_and_success_resets():
+    router = make_router()
+    router.report_error("a", Exception("500"))
+    router.report_success("a", 0.2)
+    router.report_error("a", Exception("500"))
+    assert router.pick("analysis") == "a"
+    router.report_error("a", Exception("500"))
+    assert router.pick("analysis") == "b"
+    assert router.stats()["models"]["a"]["errors"] == 3
+
+
+def test_unknown_task_uses_analysis_route():
+    assert make_router().route("outfit_plan") == ["a", "b", "c"]
+    assert is_quota_error(Exception("Resource exhausted"))
+    assert not is_quota_error(Exception("deadline exceeded"))
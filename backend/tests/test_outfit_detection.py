@@ -0,0 +1,92 @@
+"""
+Юнит-тесты разбора фото образа на вещи: вырезка рамок и разбор ответа
+детекции (Gemini — заглушка, картинки — временные файлы).
+"""
+import asyncio
+import json
+from types import SimpleNamespace
+
+from PIL import Image
+
+from app.services import gemini_service as module
+from app.services.gemini_service import GeminiService
+from app.services.image_service import PreparedImage, crop_boxes
+
+
+def test_crop_boxes_maps_normalized_coordinates_with_padding(tmp_path):
+    path = tmp_path / "outfit.jpg"
+    Image.new("RGB", (2000, 1000), "white").save(path)
+    out = tmp_path / "crops"
+    out.mkdir()
+
+    crops = crop_boxes(str(path), [[100, 200, 500, 400], [0, 0, 1000, 1000]], str(out), padding=0.1, quality=90)
+
+    # ymin/xmin/ymax/xmax в 0-1000 -> пиксели, рамка расширена на 10% с каждой стороны
+    with Image.open(crops[0]) as img:
+        assert img.size == (480, 480)
+    with Image.open(crops[1]) as img:
+        assert img.size == (2000, 1000)
+
+
+def test_crop_boxes_skips_invalid_boxes(tmp_path):
+    path = tmp_path / "outfit.jpg"
+    Image.new("RGB", (200, 100), "white").save(path)
+
+    crops = crop_boxes(
+        str(path),
+        [None, [1, 2, 3], [500, 500, 400, 600], [0, 0, 1, 1], [-50, -50, 1200, 1200]],
+        str(tmp_path), padding=0.0, quality=90,
+    )
+
+    assert crops[:4] == [None, None, None, None]
+    # Координаты за пределами 0-1000 обрезаются по краю фото
+    with Image.open(crops[4]) as img:
+        assert img.size == (200, 100)
+
+
+def test_crop_boxes_use_exif_rotated_coordinates(tmp_path):
+    img = Image.new("RGB", (2000, 1000), "white")
+    exif = img.getexif()
+    exif[0x0112] = 6
+    path = tmp_path / "rotated.jpg"
+    img.save(path, exif=exif.tobytes())
+
+    (crop,) = crop_boxes(str(path), [[0, 0, 500, 1000]], str(tmp_path), padding=0.0, quality=90)
+
+    # Модель видит вертикальное фото 1000x2000: верхняя половина — 1000x1000
+    with Image.open(crop) as img:
+        assert img.size == (1000, 1000)
+
+
+def test_detection_keeps_valid_items_up_to_limit(monkeypatch, tmp_path):
+    path = tmp_path / "outfit.jpg"
+    path.write_bytes(b"jpeg")
+    payload = {"items": [
+        {"category": "jacket", "colors": ["black"], "box_2d": [0, 0, 500, 500]},
+        {"category": "no box"},
+        "garbage",
+        {"category": "jeans", "box_2d": [500, 0, 1000, 500]},
+        {"category": "sneakers", "box_2d": [900, 0, 1000, 500]},
+    ]}
+    service = GeminiService()
+    service.model = object()
+
+    async def prepare_for_gemini(image_path):
+        return PreparedImage(b"jpeg", "image/jpeg", 10, 10, 4)
+
+    async def image_part(image_path, prepared):
+        return "image"
+
+    async def generate(task, instruction, contents, generation_config, call, user_id, priority):
+        return SimpleNamespace(text=json.dumps(payload))
+
+    monkeypatch.setattr(module.image_service, "prepare_for_gemini", prepare_for_gemini)
+    monkeypatch.setattr(service, "_image_part", image_part)
+    monkeypatch.setattr(service, "_generate", generate)
+
+    items = asyncio.run(service.detect_clothing_items(str(path), max_items=2))
+
+    # Битые элементы не роняют остальные; лимит max_items соблюдается
+    assert [i["category"] for i in items] == ["jacket", "jeans"]
+    assert items[1]["colors"] == [] and items[1]["tags"] == []
+    assert items[0]["box_2d"] == [0, 0, 500, 500]
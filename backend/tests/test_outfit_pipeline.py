@@ -0,0 +1,60 @@
+"""
+Юнит-тесты движка пайплайна образов: лимиты и замеры этапов.
+"""
+import asyncio
+
+from app.services.outfit_pipeline import PipelineMetrics, PipelineRun
+
+
+def test_stage_limit_bounds_concurrency_and_tracks_wall_vs_busy():
+    run = PipelineRun("test", limits={"search": 2})
+    state = {"current": 0, "peak": 0}
+
+    async def search(i):
+        async with run.stage("search", items_in=1) as span:
+            state["current"] += 1
+            state["peak"] = max(state["peak"], state["current"])
+            await asyncio.sleep(0.05)
+            state["current"] -= 1
+            span.items_out = i
+
+    async def main():
+        await asyncio.gather(*(search(i) for i in range(6)))
+
+    asyncio.run(main())
+
+    timings = run.timings()["search"]
+    assert state["peak"] == 2
+    assert timings["calls"] == 6
+    assert timings["items_out"] == sum(range(6))
+    # Три волны по два вызова: занятость вдвое больше wall-clock
+    assert timings["wall_ms"] >= 140
+    assert timings["busy_ms"] >= 1.8 * timings["wall_ms"]
+
+
+def test_stage_counters_errors_and_run_outcome():
+    run = PipelineRun("test")
+    metrics = PipelineMetrics()
+
+    with run.stage("filter", items_in=3) as span:
+        span.items_out = 1
+        span.counters["fallbacks"] += 1
+    try:
+        with run.stage("filter"):
+            raise ValueError("boom")
+    except ValueError:
+        pass
+    with run.stage("plan"):
+        pass
+
+    timings = run.timings()
+    assert list(timings) == ["plan", "filter"]
+    assert timings["filter"]["calls"] == 2
+    assert timings["filter"]["fallbacks"] == 1
+    assert timings["filter"]["errors"] == 1
+
+    metrics.record("test", "ok", 10.0, timings)
+    metrics.record("test", "error", 30.0, {})
+    stats = metrics.stats()["test"]
+    assert stats["runs"] == {"ok": 1, "error": 1}
+    assert stats["stages"]["filter"]["totals"]["items_in"] == 3
@@ -0,0 +1,88 @@
+"""
+Юнит-тесты кэша планов образов.
+"""
+from app.services import outfit_plan_cache as module
+from app.services.outfit_plan_cache import OutfitPlanCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def plan(name):
+    return {"outfits": [{"outfit_name": name, "slots": []}]}
+
+
+def names(plans):
+    return [p["outfits"][0]["outfit_name"] for p in plans]
+
+
+def test_plans_served_round_robin_once_pool_is_full():
+    cache = OutfitPlanCache(ttl_seconds=60, variety=2, max_keys=10)
+    cache.put("k", plan("A"))
+    # Пул не заполнен — вызывающий генерирует новый план ради разнообразия
+    assert cache.get("k") is None
+    cache.put("k", plan("B"))
+    assert names(cache.get("k") for _ in range(4)) == ["A", "B", "A", "B"]
+
+    served = cache.get("k")
+    served["outfits"][0]["outfit_name"] = "mutated"
+    assert names([cache.get("k"), cache.get("k")]) == ["B", "A"]
+    assert cache.stats()["hits"] == 7
+
+
+def test_partial_pool_served_only_when_allowed():
+    cache = OutfitPlanCache(ttl_seconds=60, variety=3, max_keys=10)
+    assert cache.get("k", allow_partial=True) is None
+    cache.put("k", plan("A"))
+    assert cache.get("k") is None
+    assert names([cache.get("k", allow_partial=True)]) == ["A"]
+
+
+def test_expired_plans_leave_the_pool(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(module.time, "monotonic", clock)
+    cache = OutfitPlanCache(ttl_seconds=60, variety=2, max_keys=10)
+    cache.put("k", plan("A"))
+    clock.now += 30
+    cache.put("k", plan("B"))
+    assert cache.get("k") is not None
+
+    # Истёк только первый план — пул снова неполный
+    clock.now += 40
+    assert cache.get("k") is None
+    assert names([cache.get("k", allow_partial=True)]) == ["B"]
+
+    clock.now += 60
+    assert cache.get("k", allow_partial=True) is None
+    assert cache.stats()["keys"] == 0
+
+
+def test_key_normalizes_inputs_and_fingerprints_base_item():
+    make_key = OutfitPlanCache.make_key
+    base = {"category": "jacket", "colors": ["black"], "description": "wool", "style": "smart"}
+
+    assert make_key("v1", "  Old   Money ", "Men", None, 3, None) == make_key("v1", "old money", "men", "", 3, "mid")
+    assert make_key("v1", None, None, None, 3, None) == make_key("v1", "casual", "men", "any", 3, "mid")
+    assert make_key("v1", "casual", "men", None, 3, None) != make_key("v2", "casual", "men", None, 3, None)
+    assert make_key("v1", "casual", "men", None, 3, None) != make_key("v1", "casual", "men", None, 2, None)
+
+    with_base = make_key("v1", "casual", "men", None, 3, None, base)
+    assert with_base != make_key("v1", "casual", "men", None, 3, None)
+    # Поля анализа, которых нет в промпте, на ключ не влияют
+    assert with_base == make_key("v1", "casual", "men", None, 3, None, {**base, "tags": ["x"], "brand": "Y"})
+    assert with_base != make_key("v1", "casual", "men", None, 3, None, {**base, "colors": ["navy"]})
+
+
+def test_least_recently_used_key_evicted():
+    cache = OutfitPlanCache(ttl_seconds=60, variety=1, max_keys=2)
+    cache.put("a", plan("A"))
+    cache.put("b", plan("B"))
+    cache.get("a")
+    cache.put("c", plan("C"))
+    assert cache.get("b") is None
+    assert names([cache.get("a"), cache.get("c")]) == ["A", "C"]
@@ -0,0 +1,94 @@
+"""
+Юнит-тесты перцептивного хэша и BK-дерева (без БД и Gemini).
+"""
+import random
+
+from PIL import Image, ImageDraw
+
+from app.services.image_service import (
+    color_difference,
+    compute_color_signature,
+    compute_dhash,
+    hamming_distance,
+)
+from app.services.phash_index import BKTree
+
+
+def make_image(path: str, size=(640, 480), quality: int = 95, fill: str = "navy") -> None:
+    img = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(img)
+    draw.rectangle([size[0] // 4, size[1] // 5, size[0] * 3 // 4, size[1] * 4 // 5], fill=fill)
+    draw.ellipse([size[0] // 3, size[1] // 3, size[0] // 2, size[1] // 2], fill="red")
+    img.save(path, "JPEG", quality=quality)
+
+
+class TestDHash:
+    def test_recompressed_and_resized_is_close(self, tmp_path):
+        original = str(tmp_path / "a.jpg")
+        recompressed = str(tmp_path / "b.jpg")
+        make_image(original)
+        make_image(recompressed, size=(320, 240), quality=40)
+
+        distance = hamming_distance(compute_dhash(original), compute_dhash(recompressed))
+        assert distance <= 6
+
+    def test_different_image_is_far(self, tmp_path):
+        original = str(tmp_path / "a.jpg")
+        other = str(tmp_path / "c.jpg")
+        make_image(original)
+        img = Image.new("RGB", (640, 480), "white")
+        draw = ImageDraw.Draw(img)
+        for x in range(0, 640, 80):
+            draw.rectangle([x, 0, x + 40, 480], fill="black")
+        img.save(other, "JPEG")
+
+        assert hamming_distance(compute_dhash(original), compute_dhash(other)) > 6
+
+
+class TestColorSignature:
+    def test_recompressed_keeps_colors(self, tmp_path):
+        original = str(tmp_path / "a.jpg")
+        recompressed = str(tmp_path / "b.jpg")
+        make_image(original)
+        make_image(recompressed, size=(320, 240), quality=40)
+
+        difference = color_difference(compute_color_signature(original), compute_color_signature(recompressed))
+        assert difference <= 32
+
+    def test_same_cut_in_other_color_differs_only_by_color(self, tmp_path):
+        navy = str(tmp_path / "navy.jpg")
+        green = str(tmp_path / "green.jpg")
+        make_image(navy)
+        make_image(green, fill="#2e8b57")
+
+        # Яркость почти та же — dHash считает фото одной вещью
+        assert hamming_distance(compute_dhash(navy), compute_dhash(green)) <= 6
+        assert color_difference(compute_color_signature(navy), compute_color_signature(green)) > 32
+
+
+class TestBKTree:
+    def test_search_matches_bruteforce(self):
+        rng = random.Random(42)
+        hashes = [rng.getrandbits(64) for _ in range(2000)]
+        tree = BKTree()
+        for idx, h in enumerate(hashes):
+            tree.add(h, idx)
+
+        query = hashes[123] ^ 0b1011  # 3 бита отличия
+        expected = sorted(
+            (hamming_distance(query, h), idx)
+            for idx, h in enumerate(hashes)
+            if hamming_distance(query, h) <= 6
+        )
+        assert tree.search(query, 6) == expected
+        assert tree.search(query, 6)[0] == (3, 123)
+
+    def test_duplicates_kept(self):
+        tree = BKTree()
+        tree.add(0xFF, 1)
+        tree.add(0xFF, 2)
+        assert len(tree) == 2
+        assert tree.search(0xFF, 0) == [(0, 1), (0, 2)]
+
+    def test_empty(self):
+        assert BKTree().search(0, 10) == []
@@ -0,0 +1,37 @@
+"""
+Юнит-тесты предсказания пустого поиска для спекулятивного fallback.
+"""
+
+from app.services.search_fallback import SearchFallbackPredictor, query_shape
+
+
+def test_query_shape_buckets_words_and_minus_terms():
+    assert query_shape("black boots") == "w1-2"
+    assert query_shape("black leather chelsea boots -kids") == "w3-4-minus"
+    assert query_shape("a b c d e f g") == "w7+"
+
+
+def test_speculates_only_after_enough_empty_results():
+    predictor = SearchFallbackPredictor(enabled=True, threshold=0.5, min_samples=4)
+    for _ in range(3):
+        predictor.record("outfit_slot", "shoes", "white canvas sneakers", empty=True)
+    assert not predictor.should_speculate("outfit_slot", "shoes", "white leather sneakers")
+
+    predictor.record("outfit_slot", "shoes", "white canvas sneakers", empty=True)
+    assert predictor.should_speculate("outfit_slot", "shoes", "white leather sneakers")
+    # Та же форма запроса в категории без истории — по общей статистике формы
+    assert predictor.should_speculate("outfit_slot", "bag", "small leather bag")
+    assert not predictor.should_speculate("outfit_slot", "shoes", "sneakers")
+    assert not predictor.should_speculate("find_similar", "shoes", "white leather sneakers")
+
+
+def test_low_empty_rate_and_disabled_do_not_speculate():
+    predictor = SearchFallbackPredictor(enabled=True, threshold=0.5, min_samples=4)
+    for empty in [True, False, False, False]:
+        predictor.record("find_similar", "jacket", "black bomber jacket", empty=empty)
+    assert predictor.probability("find_similar", "jacket", "black bomber jacket") == 0.25
+    assert not predictor.should_speculate("find_similar", "jacket", "black bomber jacket")
+
+    disabled = SearchFallbackPredictor(enabled=False, threshold=0.0, min_samples=1)
+    disabled.record("find_similar", "jacket", "black bomber jacket", empty=True)
+    assert not disabled.should_speculate("find_similar", "jacket", "black bomber jacket")
@@ -0,0 +1,148 @@
+"""
+Юнит-тесты поисков по маркетплейсам из ai.py: лимит и общие запросы
+SlotSearches, альтернативные запросы find-similar (поиск — заглушки).
+"""
+import asyncio
+from types import SimpleNamespace
+
+from app.api.v1 import ai
+from app.api.v1.ai import OutfitStages, SlotSearches, search_alternate_queries
+from app.services.outfit_pipeline import PipelineRun
+
+
+class FakeSearch:
+    """Поиск-заглушка: считает вызовы, одновременность и отмены."""
+
+    def __init__(self, delay=0.02, gate=None):
+        self.delay = delay
+        self.gate = gate
+        self.calls = []
+        self.active = 0
+        self.max_active = 0
+        self.cancelled = []
+
+    async def __call__(self, search_query, marketplaces=None, max_results_per_marketplace=10):
+        self.calls.append(search_query)
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            if self.gate is not None:
+                await self.gate.wait()
+            await asyncio.sleep(self.delay)
+            return [{"name": search_query, "url": f"https://shop/{search_query}"}]
+        except asyncio.CancelledError:
+            self.cancelled.append(search_query)
+            raise
+        finally:
+            self.active -= 1
+
+
+def slot_searches(search, limit=2):
+    run = PipelineRun("test", limits={"search": limit})
+    return SlotSearches("men", None, ["asos"], 5, run, stages=OutfitStages(search=search)), run
+
+
+def test_concurrent_searches_bounded_by_stage_limit():
+    search = FakeSearch()
+
+    async def run():
+        searches, pipeline = slot_searches(search, limit=2)
+        results = await asyncio.gather(*(searches.search(f"query {i}", ["asos"]) for i in range(6)))
+        return results, pipeline.timings()
+
+    results, timings = asyncio.run(run())
+    assert len(search.calls) == 6
+    assert search.max_active == 2
+    assert [r[0]["name"] for r in results] == [f"query {i}" for i in range(6)]
+    assert timings["search"]["calls"] == 6
+
+
+def test_identical_queries_share_one_search():
+    search = FakeSearch()
+
+    async def run():
+        searches, _ = slot_searches(search)
+        return await asyncio.gather(
+            searches.search("white  Sneakers", ["asos"]),
+            searches.search("white sneakers", ["asos"]),
+            searches.search("WHITE sneakers ", ["asos"]),
+            # Другие маркетплейсы — другой поиск
+            searches.search("white sneakers", ["hm"]),
+        )
+
+    results = asyncio.run(run())
+    assert len(search.calls) == 2
+    assert results[0] == results[1] == results[2]
+    # Каждый ждущий получает свой список
+    assert results[0] is not results[1]
+
+
+def test_search_cancelled_only_when_last_waiter_leaves():
+    gate = asyncio.Event()
+    search = FakeSearch(gate=gate)
+
+    async def run():
+        searches, _ = slot_searches(search)
+        first = asyncio.create_task(searches.search("loafers", ["asos"]))
+        second = asyncio.create_task(searches.search("loafers", ["asos"]))
+        await asyncio.sleep(0.01)
+
+        first.cancel()
+        await asyncio.sleep(0.01)
+        # Второй слот ещё ждёт — поиск продолжается
+        assert search.cancelled == []
+
+        second.cancel()
+        await asyncio.sleep(0.01)
+        assert search.cancelled == ["loafers"]
+
+        # Отменённый поиск не переиспользуется: новый запрос ищет заново
+        gate.set()
+        return await searches.search("loafers", ["asos"])
+
+    result = asyncio.run(run())
+    assert result[0]["name"] == "loafers"
+    assert search.calls == ["loafers", "loafers"]
+
+
+def test_alternate_queries_stop_early_and_merge_in_query_order(monkeypatch):
+    delays = {"slow": 0.05, "fast": 0.0, "never": 5.0}
+    scores = {"slow": 90.0, "fast": 80.0, "never": 95.0}
+    cancelled = []
+
+    async def search_similar(search_query, marketplaces, max_results_per_marketplace):
+        try:
+            await asyncio.sleep(delays[search_query])
+        except asyncio.CancelledError:
+            cancelled.append(search_query)
+            raise
+        return [{"name": f"{search_query} {i}", "query": search_query} for i in range(2)]
+
+    monkeypatch.setattr(ai.marketplace_service, "search_similar", search_similar)
+    monkeypatch.setattr(ai, "calculate_similarity_score", lambda p, analysis, item: scores[p["query"]])
+
+    async def run():
+        return await search_alternate_queries(
+            ["slow", "fast", "never"], ["asos"], 10, {}, SimpleNamespace(), min_score=50, enough=4,
+        )
+
+    products = asyncio.run(run())
+    # Быстрый пришёл первым, но в выдаче — порядок запросов
+    assert [p["name"] for p in products] == ["slow 0", "slow 1", "fast 0", "fast 1"]
+    assert cancelled == ["never"]
+    assert all(p["similarity_score"] >= 50 for p in products)
+
+
+def test_alternate_queries_survive_a_failed_provider(monkeypatch):
+    async def search_similar(search_query, marketplaces, max_results_per_marketplace):
+        if search_query == "broken":
+            raise RuntimeError("provider down")
+        return [{"name": search_query}]
+
+    monkeypatch.setattr(ai.marketplace_service, "search_similar", search_similar)
+    monkeypatch.setattr(ai, "calculate_similarity_score", lambda p, analysis, item: 10.0)
+
+    products = asyncio.run(search_alternate_queries(
+        ["broken", "ok"], ["asos"], 10, {}, SimpleNamespace(), min_score=50, enough=5,
+    ))
+    assert [p["name"] for p in products] == ["ok"]